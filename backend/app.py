@@ -1,14 +1,9 @@
-from app import app
-from flask_cors import CORS
+from wsgi import app, start_background_workers
 import os
 
-# Enable CORS
-CORS(app)
-
-# Register Blueprints or Routes
-from app import login_routes, reddit_routes, chatbot_routes
-
 if __name__ == "__main__":
+    # Development server. In production run: gunicorn -c gunicorn.conf.py asgi:app
+    start_background_workers()
     # Get the port from the environment variable or default to 8000
     port = int(os.environ.get("PORT", 8000))
     # Bind to all interfaces
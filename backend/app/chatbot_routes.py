@@ -1,23 +1,21 @@
-from flask import Flask, jsonify, request,redirect
+from flask import Flask, Response, jsonify, request,redirect, stream_with_context
+import asyncio
+import json
 import os,sys
 from store.data_access_layer import upsert_user_data,delete_conversation_data
-from langchain_openai import ChatOpenAI
 
 
 
 
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 from app import app
-from store.initialize_database import supabase
-from services import chatbot,tool
+from services.ingestion import record_subreddit_activity
+from services.memory import conversation_memory
+from services.registry import get_llm
 from store import data_access_layer
 
-
-
-llm = ChatOpenAI(
-    openai_api_key=os.getenv("OPENAI_API_KEY"),  # Correct parameter name
-    temperature=0.2,
-)
+## the chat agent (langchain) and the answer cache (chromadb) are imported inside the routes that use them,
+## so the process can start serving the other routes before that stack has loaded
 
 
 @app.route('/chat', methods=['POST'])  # Define API endpoint
@@ -30,19 +28,101 @@ def chat_with_bot():
     subreddit_name = request.json.get("subreddit")  # Get subreddit from JSON request
     user_id = request.json.get("user_id")  # Get user input from JSON request
     
-    subreddit_search_tool = tool.create_subreddit_search_tool(subreddit_name)
-    agent = chatbot.initialize_chat_agent(llm, subreddit_search_tool)
-
-    
     if not user_input:
         return jsonify({"error": "No message provided"}), 400  # Error if no message
     if not subreddit_name:
         return jsonify({"error": "No subreddit provided"}), 400  # Error if no message
+    if not user_id:
+        return jsonify({"error": "No user_id provided"}), 400  # the conversation is saved under it
     
-    response = chatbot.start_chat_session(subreddit_name,user_input,user_id,agent)  # Start a new session
+    from services import chatbot
+
+    try:
+        mode = chatbot.resolve_chat_mode(request.json.get("mode"))  # "agent" or "direct", defaults to CHAT_MODE
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    record_subreddit_activity(subreddit_name)
+    if mode == "direct":
+        response = chatbot.start_direct_chat_session(subreddit_name,user_input,user_id,get_llm())
+    else:
+        agent = chatbot.get_chat_agent(get_llm(), subreddit_name)  # Reused across requests for the same subreddit
+        response = chatbot.start_chat_session(subreddit_name,user_input,user_id,agent)  # Start a new session
     return jsonify({"response": response})  # Return response as JSON
 
 
+def _iterate_async(async_generator):
+    """Drive an async generator from a regular (WSGI) generator on a private event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_generator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_generator.aclose())
+        loop.close()
+
+
+@app.route('/chat/stream', methods=['POST'])  # Define API endpoint
+def stream_chat_with_bot():
+    """
+    Same as /chat, but streams progress updates and the answer token by token as Server-Sent Events.
+
+    Under a WSGI server the stream runs on its own event loop and holds a thread until it ends. In
+    production this route is served by asgi.py instead, where streams share the worker's event loop.
+    """
+    user_input = request.json.get("message")  # Get user input from JSON request
+    subreddit_name = request.json.get("subreddit")  # Get subreddit from JSON request
+    user_id = request.json.get("user_id")  # Get user input from JSON request
+
+    if not user_input:
+        return jsonify({"error": "No message provided"}), 400  # Error if no message
+    if not subreddit_name:
+        return jsonify({"error": "No subreddit provided"}), 400  # Error if no message
+    if not user_id:
+        return jsonify({"error": "No user_id provided"}), 400  # the conversation is saved under it
+
+    from services import chatbot
+
+    try:
+        mode = chatbot.resolve_chat_mode(request.json.get("mode"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    record_subreddit_activity(subreddit_name)
+    if mode == "direct":
+        session = chatbot.astream_direct_chat_session(subreddit_name, user_input, user_id, get_llm())
+    else:
+        agent = chatbot.get_chat_agent(get_llm(), subreddit_name)
+        session = chatbot.astream_chat_session(subreddit_name, user_input, user_id, agent)
+
+    def events():
+        try:
+            for event, data in _iterate_async(session):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            print("An error occurred while streaming:", e)
+            yield f"event: error\ndata: {json.dumps('Something went wrong, please try again')}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route('/answer_cache/stats', methods=['GET'])
+def answer_cache_stats():
+    """
+    Hit/miss statistics of the semantic answer cache.
+    """
+    from services.answer_cache import answer_cache
+
+    return jsonify(answer_cache.stats())
+
+
 # if there is history it returns it and puts it in the convo.
 # Otherwise it is blank.
 @app.route('/chat_history', methods=['POST'])  # Define API endpoint
@@ -69,6 +149,7 @@ def delete_conversation():
         return jsonify({"error": "user_id parameter is required"}), 400
 
     response = delete_conversation_data(subreddit_name,user_id)
+    conversation_memory.clear(subreddit_name, user_id)
     if response["status_code"] == 200:
         return jsonify({"success":response["message"]  })
     else:
@@ -5,13 +5,13 @@ from store.data_access_layer import upsert_user_data
 
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 from app import app
-from store.initialize_database import supabase
+from services.registry import get_supabase
 
 
 @app.route("/signin/google")
 def signin_with_google():
     redirect_to_url = f"https://reddit-search-production.up.railway.app/callback"
-    res = supabase.auth.sign_in_with_oauth(
+    res = get_supabase().auth.sign_in_with_oauth(
         {
             "provider": "google",
             "options": {
@@ -28,7 +28,7 @@ def callback():
     next_url = request.args.get("next", "https://reddit-search-tau.vercel.app/search")  # Update as needed
 
     if code:
-        res = supabase.auth.exchange_code_for_session({"auth_code": code})
+        res = get_supabase().auth.exchange_code_for_session({"auth_code": code})
 
     user_data = {
         "google_id": res.user.id,  # Replace with actual field
@@ -0,0 +1,41 @@
+from flask import Response, g, request
+import os,sys
+import time
+
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from app import app
+from services.metrics import REQUEST_DURATION, end_trace, render_metrics, start_trace
+
+
+@app.before_request
+def start_request_trace():
+    # keep the caller's trace id if it sent one, so our logs line up with theirs
+    trace = start_trace(request.headers.get("X-Trace-Id"))
+    g.trace_id = trace.trace_id
+    g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # for streamed responses (/chat/stream) this is the time to the first byte
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_DURATION.observe(
+        time.perf_counter() - g.request_start_time,
+        method=request.method, route=route, status=response.status_code,
+    )
+    response.headers["X-Trace-Id"] = g.trace_id
+    return response
+
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    end_trace()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    Request, stage and API call metrics in the Prometheus text format, added up over all workers when
+    METRICS_MULTIPROC_DIR is set.
+    """
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
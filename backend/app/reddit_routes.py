@@ -1,11 +1,10 @@
 from flask import Flask, jsonify, request,redirect
 import os,sys
-from store.data_access_layer import upsert_user_data
 
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 from app import app
-from store.initialize_database import supabase
 from services import search_reddit
+from services.ingestion import record_subreddit_activity
 
 @app.route('/search_subreddits', methods=['GET'])
 def search_reddit_route():
@@ -15,6 +14,9 @@ def search_reddit_route():
         return jsonify({"error": "Query parameter is required"}), 400
     
     subreddits = search_reddit.search_subreddits(query)  # Now returns a list
+    if subreddits:
+        # the best match is a weak hint of where the user is heading next
+        record_subreddit_activity(subreddits[0]["display_name"], weight=0.25)
     print(subreddits)
     
     return jsonify(subreddits)   # Flask jsonify will serialize the list correctly
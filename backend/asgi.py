@@ -0,0 +1,118 @@
+import asyncio
+import importlib
+import json
+import time
+import warnings
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+with warnings.catch_warnings():
+    # deprecated in favour of a2wsgi, which we don't ship. It still works and runs Flask in a thread pool
+    warnings.simplefilter("ignore", DeprecationWarning)
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+from wsgi import app as flask_app
+from services.ingestion import record_subreddit_activity
+from services.metrics import REQUEST_DURATION, end_trace, start_trace
+from services.registry import get_llm
+
+"""
+The ASGI entry point, for serving /chat/stream to many users at once:
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+/chat/stream is served natively here. Every stream is a task on the worker's event loop, and the
+blocking parts of a chat turn (Supabase, Chroma, the answer cache) run in short-lived calls on the
+default thread pool, so an open stream doesn't hold a thread while it waits on the LLM. Every other
+route is the Flask app from wsgi.py, run in a thread pool.
+"""
+
+
+ROUTE = "/chat/stream"
+
+
+def _error(message, started, status=400):
+    REQUEST_DURATION.observe(time.perf_counter() - started, method="POST", route=ROUTE, status=status)
+    return JSONResponse({"error": message}, status_code=status, headers={"X-Trace-Id": end_trace().trace_id})
+
+
+async def stream_chat_with_bot(request):
+    """
+    Same as /chat, but streams progress updates and the answer token by token as Server-Sent Events.
+    """
+    started = time.perf_counter()
+    # keep the caller's trace id if it sent one, so our logs line up with theirs
+    trace = start_trace(request.headers.get("X-Trace-Id"))
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        return _error("No message provided", started)
+
+    user_input = body.get("message")
+    subreddit_name = body.get("subreddit")
+    user_id = body.get("user_id")
+
+    if not user_input:
+        return _error("No message provided", started)
+    if not subreddit_name:
+        return _error("No subreddit provided", started)
+    if not user_id:
+        return _error("No user_id provided", started)
+
+    try:
+        # the first request of a worker imports langchain and builds the agent, keep that off the event loop
+        chatbot = await asyncio.to_thread(importlib.import_module, "services.chatbot")
+
+        try:
+            mode = chatbot.resolve_chat_mode(body.get("mode"))
+        except ValueError as e:
+            return _error(str(e), started)
+
+        record_subreddit_activity(subreddit_name)
+        llm = await asyncio.to_thread(get_llm)
+        if mode == "direct":
+            session = chatbot.astream_direct_chat_session(subreddit_name, user_input, user_id, llm)
+        else:
+            agent = await asyncio.to_thread(chatbot.get_chat_agent, llm, subreddit_name)
+            session = chatbot.astream_chat_session(subreddit_name, user_input, user_id, agent)
+    except Exception as e:
+        # the stream never started, so its trace ends here rather than in events()
+        print("An error occurred while starting the stream:", e)
+        return _error("Something went wrong, please try again", started, status=500)
+
+    async def events():
+        try:
+            async for event, data in session:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            print("An error occurred while streaming:", e)
+            yield f"event: error\ndata: {json.dumps('Something went wrong, please try again')}\n\n"
+        finally:
+            await session.aclose()
+            end_trace()
+
+    # as with the Flask route, this is the time to the first byte
+    REQUEST_DURATION.observe(time.perf_counter() - started, method="POST", route=ROUTE, status=200)
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Trace-Id": trace.trace_id},
+    )
+
+
+## the Flask app sets its CORS headers with flask_cors, this route has to set its own
+stream_app = Starlette(
+    routes=[Route(ROUTE, stream_chat_with_bot, methods=["POST"])],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+)
+
+app = Starlette(routes=[
+    Route(ROUTE, stream_app),
+    Mount("/", WSGIMiddleware(flask_app)),
+])
@@ -0,0 +1,11 @@
+"""
+Offline benchmarks for the RAG and chat path.
+
+Reddit, OpenAI and Supabase are replaced by local stand-ins with configurable latency, so the numbers
+measure our own code (plus the simulated network time) and runs need no credentials:
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --scenarios rag_search_pipeline,chat --baseline results.json
+
+Run it from the backend directory.
+"""
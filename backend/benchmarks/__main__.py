@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from benchmarks.harness import BenchmarkConfig, configure_environment
+
+"""
+Command line entry point: python -m benchmarks --help
+"""
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _change(current, previous):
+    if not previous:
+        return "     n/a"
+    return f"{100 * (current - previous) / previous:+7.1f}%"
+
+
+def print_report(results, baseline=None):
+    baseline_scenarios = (baseline or {}).get("scenarios", {})
+    header = f"{'scenario':<24} {'req/s':>9} {'p50 ms':>10} {'p99 ms':>10} {'peak MB':>9} {'errors':>7}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results["scenarios"].items():
+        print(
+            f"{name:<24} {result['throughput_per_second']:>9.2f} {result['latency_ms']['p50']:>10.1f} "
+            f"{result['latency_ms']['p99']:>10.1f} {result['peak_memory_mb']:>9.1f} {result['errors']:>7}"
+        )
+        previous = baseline_scenarios.get(name)
+        if previous:
+            print(
+                f"{'  vs baseline':<24} {_change(result['throughput_per_second'], previous['throughput_per_second']):>9} "
+                f"{_change(result['latency_ms']['p50'], previous['latency_ms']['p50']):>10} "
+                f"{_change(result['latency_ms']['p99'], previous['latency_ms']['p99']):>10} "
+                f"{_change(result['peak_memory_mb'], previous['peak_memory_mb']):>9}"
+            )
+        if result["first_error"]:
+            print(f"  first error: {result['first_error']}")
+
+
+def main():
+    defaults = BenchmarkConfig()
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline benchmarks of the RAG and chat path.")
+    parser.add_argument("--scenarios", default="search_within_subreddit,upload_reddit_content,rag_search_pipeline,chat,vector_query",
+                        help="Comma separated scenarios to run")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--chat-concurrency", type=int, default=8, help="Requests in flight at once for the chat scenario")
+    parser.add_argument("--reddit-latency", type=float, default=defaults.reddit_latency)
+    parser.add_argument("--embedding-latency", type=float, default=defaults.embedding_latency)
+    parser.add_argument("--llm-latency", type=float, default=defaults.llm_latency)
+    parser.add_argument("--supabase-latency", type=float, default=defaults.supabase_latency)
+    parser.add_argument("--posts-per-search", type=int, default=defaults.posts_per_search)
+    parser.add_argument("--comments-per-post", type=int, default=defaults.comments_per_post)
+    parser.add_argument("--chat-mode", choices=["agent", "direct"], default=defaults.chat_mode or None,
+                        help="How the chat scenario is answered, defaults to the server's CHAT_MODE")
+    parser.add_argument("--vector-backend", choices=["chroma", "numpy"], default=defaults.vector_backend)
+    parser.add_argument("--vector-count", type=int, default=defaults.vector_count,
+                        help="How many vectors the vector_query scenario searches")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--output", default="benchmark-results.json", help="Where to write the results as JSON")
+    parser.add_argument("--baseline", help="An earlier results file to compare against")
+    args = parser.parse_args()
+
+    config = BenchmarkConfig(
+        seed=args.seed,
+        reddit_latency=args.reddit_latency,
+        embedding_latency=args.embedding_latency,
+        llm_latency=args.llm_latency,
+        supabase_latency=args.supabase_latency,
+        posts_per_search=args.posts_per_search,
+        comments_per_post=args.comments_per_post,
+        chat_mode=args.chat_mode or "",
+        vector_backend=args.vector_backend,
+        vector_count=args.vector_count,
+    )
+
+    # the environment has to be set before the backend is imported
+    workdir = configure_environment(vector_backend=config.vector_backend)
+    from benchmarks.harness import install_fakes
+    from benchmarks.scenarios import SCENARIOS, run_scenario
+    fakes = install_fakes(config)
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios {unknown}, expected some of {sorted(SCENARIOS)}")
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": config.to_dict(),
+        "tokenizer": fakes.tokenizer,
+        "scenarios": {},
+    }
+    for name in names:
+        concurrency = args.chat_concurrency if name == "chat" else args.concurrency
+        print(f"Running {name} ({args.requests} requests, concurrency {concurrency})...", file=sys.stderr)
+        started = time.perf_counter()
+        results["scenarios"][name] = run_scenario(SCENARIOS[name](config), args.requests, concurrency)
+        print(f"  done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    # flush the conversation rows still queued behind /chat, so the run ends cleanly
+    from store.data_access_layer import conversation_writer
+    conversation_writer.stop()
+    # ru_maxrss is in kilobytes on Linux
+    results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    results["workdir"] = workdir
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
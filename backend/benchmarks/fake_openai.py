@@ -0,0 +1,146 @@
+import asyncio
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from store.embeddings import HashingEmbeddingProvider
+
+"""
+Deterministic stand-ins for the OpenAI embedding and chat models, with simulated latency, and for
+the tokenizer when tiktoken can't download its encoding.
+"""
+
+
+class WordEncoding:
+    """
+    An offline stand-in for a tiktoken encoding: every word, with the whitespace after it, is one token.
+    Real BPE tokens are shorter, so chunks hold somewhat more text than they would with cl100k_base.
+    """
+
+    name = "words"
+    _pattern = re.compile(r"\S+\s*|\s+")
+
+    def __init__(self):
+        self._ids = {}
+        self._pieces = []
+        self._lock = threading.Lock()
+
+    def encode(self, text, disallowed_special=()):
+        tokens = []
+        for piece in self._pattern.findall(text):
+            token = self._ids.get(piece)
+            if token is None:
+                with self._lock:
+                    token = self._ids.get(piece)
+                    if token is None:
+                        token = self._ids[piece] = len(self._pieces)
+                        self._pieces.append(piece)
+            tokens.append(token)
+        return tokens
+
+    def encode_batch(self, texts, num_threads=1, disallowed_special=()):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(self._pieces[token] for token in tokens)
+
+
+class FakeEmbeddingProvider(HashingEmbeddingProvider):
+    """
+    The hashing embedder, plus the time a call to a remote embedding API would take.
+
+    :param latency: Seconds per call.
+    :param latency_per_text: Extra seconds per text in the batch.
+    """
+
+    name = "fake"
+
+    def __init__(self, dimension=256, latency=0.05, latency_per_text=0.0005, max_concurrency=8):
+        super().__init__(dimension)
+        self.max_concurrency = max_concurrency
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency + self.latency_per_text * len(texts))
+        return super().embed(texts)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model that plays the ReAct agent's part: the first call asks for a Reddit search, and once the
+    scratchpad holds an observation it gives a final answer quoting it. Prompts without a "Question:"
+    (summaries, for example) get a plain answer.
+
+    ``latency`` is the time to the first token and ``token_latency`` the time between streamed tokens.
+    """
+
+    latency: float = 0.3
+    token_latency: float = 0.002
+    answer_words: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, prompt: str) -> str:
+        # the agent's scratchpad (its actions and their observations) follows the last "Question:"
+        head, _, scratchpad = prompt.rpartition("Question:")
+        question = scratchpad.split("\n", 1)[0].strip() or "the question"
+        if not head:
+            # not an agent prompt: a summary or a direct answer
+            return "About that: " + " ".join(prompt.split()[-self.answer_words:])
+        if "Observation:" not in scratchpad:
+            return f"Thought: I should search the subreddit.\nAction: Reddit Information Search\nAction Input: {question}"
+        observation = scratchpad.rsplit("Observation:", 1)[-1]
+        words = observation.split()[:self.answer_words] or ["Nothing", "found."]
+        return f"Thought: I now know the final answer\nFinal Answer: About {question}: " + " ".join(words)
+
+    def _usage(self, messages: List[BaseMessage], text: str):
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        return {"input_tokens": prompt_tokens, "output_tokens": len(text) // 4,
+                "total_tokens": prompt_tokens + len(text) // 4}
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        prompt = "\n".join(str(message.content) for message in messages)
+        text = self._reply(prompt)
+        time.sleep(self.latency)
+        pieces = re.findall(r"\S+\s*", text)
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(self.token_latency)
+            usage = self._usage(messages, text) if index == len(pieces) - 1 else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece, usage_metadata=usage))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        # like the real client, waiting on the model doesn't hold a thread
+        prompt = "\n".join(str(message.content) for message in messages)
+        text = self._reply(prompt)
+        await asyncio.sleep(self.latency)
+        pieces = re.findall(r"\S+\s*", text)
+        for index, piece in enumerate(pieces):
+            if index:
+                await asyncio.sleep(self.token_latency)
+            usage = self._usage(messages, text) if index == len(pieces) - 1 else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece, usage_metadata=usage))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        text = self._reply(prompt)
+        time.sleep(self.latency + self.token_latency * len(text.split()))
+        message = AIMessage(content=text, usage_metadata=self._usage(messages, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,199 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services.reddit_client import MAX_WORKERS, RedditPool, TokenBucket
+from store.cache import SingleFlight
+
+"""
+praw-compatible stand-ins for Reddit: subreddits, submissions and comment trees generated from a seed,
+with a simulated round-trip on every "API call".
+
+Only the attributes our code reads are implemented. A submission's whole comment tree arrives in one
+call, there are no "more comments" stubs.
+"""
+
+
+WORDS = (
+    "apartment rent visa job salary market beach metro food coffee brunch thrift clothes mall weekend "
+    "summer heat desert car license bank school doctor insurance gym park museum flight airport taxi "
+    "neighbourhood friends expat tourist price cheap expensive recommend avoid best worst quiet busy "
+    "weather traffic hospital pharmacy grocery delivery restaurant bar hotel visit moving family"
+).split()
+
+
+def _sentence(rng, min_words=6, max_words=30):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize() + "."
+
+
+class FakeComment:
+    def __init__(self, id, body, score, created_utc, replies=()):
+        self.id = id
+        self.body = body
+        self.score = score
+        self.created_utc = created_utc
+        self.replies = list(replies)
+
+
+class FakeSubredditRef:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakeSubmission:
+    """
+    Like praw's submissions, the comments are only fetched (one more API call) when first accessed.
+
+    :param load_comments: Builds the comment forest.
+    :param client: The FakeRedditClient to charge the comment fetch to.
+    """
+
+    def __init__(self, id, subreddit_name, title, selftext, score, created_utc, load_comments, client=None):
+        self.id = id
+        self.subreddit = FakeSubredditRef(subreddit_name)
+        self.title = title
+        self.selftext = selftext
+        self.score = score
+        self.created_utc = created_utc
+        self.comment_sort = "confidence"
+        self._load_comments = load_comments
+        self._client = client
+        self._comments = None
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            if self._client is not None:
+                self._client.api_call()
+            self._comments = self._load_comments()
+        return self._comments
+
+
+class FakeSubredditInfo:
+    """A /subreddits/search result. Our code reads it with vars(), like praw's lazy objects."""
+
+    def __init__(self, display_name, rng):
+        self.display_name = display_name
+        self.public_description = _sentence(rng)
+        self.icon_img = ""
+        self.community_icon = ""
+        self.subscribers = rng.randint(100, 2000000)
+        self.id = f"t5_{rng.randrange(16 ** 6):06x}"
+
+
+class FakeRedditData:
+    """
+    Generates submissions deterministically from the subreddit, query and position, so a benchmark run
+    can be repeated exactly.
+
+    :param comments_per_post: Top-level comments per submission.
+    :param reply_depth: How deep each top-level comment's chain of replies goes.
+    """
+
+    def __init__(self, seed=0, comments_per_post=20, reply_depth=2):
+        self.seed = seed
+        self.comments_per_post = comments_per_post
+        self.reply_depth = reply_depth
+
+    def _rng(self, *parts):
+        return random.Random(f"{self.seed}:" + ":".join(str(part) for part in parts))
+
+    def submission(self, subreddit_name, key, index, client=None):
+        rng = self._rng(subreddit_name.lower(), key, index)
+        submission_id = f"{rng.randrange(36 ** 6):06x}"
+        now = time.time()
+
+        def comment(path, depth):
+            comment_rng = self._rng(submission_id, path)
+            replies = [comment(f"{path}.0", depth + 1)] if depth < self.reply_depth else []
+            return FakeComment(
+                id=f"{submission_id}_{path}",
+                body=" ".join(_sentence(comment_rng) for _ in range(comment_rng.randint(1, 4))),
+                score=comment_rng.randint(-5, 500),
+                created_utc=now - comment_rng.randint(0, 86400 * 30),
+                replies=replies,
+            )
+
+        return FakeSubmission(
+            id=submission_id,
+            subreddit_name=subreddit_name,
+            title=_sentence(rng, 4, 12),
+            selftext=" ".join(_sentence(rng) for _ in range(rng.randint(0, 5))),
+            score=rng.randint(0, 5000),
+            created_utc=now - rng.randint(0, 86400 * 30),
+            load_comments=lambda: [comment(str(i), 0) for i in range(self.comments_per_post)],
+            client=client,
+        )
+
+    def subreddits(self, query, limit):
+        rng = self._rng("subreddits", query)
+        return [FakeSubredditInfo(f"{query}{suffix}", rng) for suffix in [""] + [str(i) for i in range(1, limit)]]
+
+
+class FakeSubreddit:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def search(self, query, limit=3):
+        self.client.api_call()
+        return [self.client.data.submission(self.name, query, i, self.client) for i in range(limit)]
+
+    def top(self, time_filter="week", limit=10):
+        self.client.api_call()
+        return [self.client.data.submission(self.name, f"top:{time_filter}", i, self.client) for i in range(limit)]
+
+    def new(self, limit=10):
+        self.client.api_call()
+        return [self.client.data.submission(self.name, "new", i, self.client) for i in range(limit)]
+
+    def hot(self, limit=10):
+        self.client.api_call()
+        return [self.client.data.submission(self.name, "hot", i, self.client) for i in range(limit)]
+
+
+class FakeSubreddits:
+    def __init__(self, client):
+        self.client = client
+
+    def search(self, query, limit=20):
+        self.client.api_call()
+        return self.client.data.subreddits(query, limit)
+
+
+class FakeRedditClient:
+    """
+    Stands in for praw.Reddit.
+
+    :param latency: Seconds each API call takes.
+    """
+
+    def __init__(self, data=None, latency=0.05):
+        self.data = data or FakeRedditData()
+        self.latency = latency
+        self.subreddits = FakeSubreddits(self)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def api_call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def submission(self, id):
+        return self.data.submission("unknown", id, 0, self)
+
+
+class FakeRedditPool(RedditPool):
+    """A RedditPool whose clients are FakeRedditClients. Coalescing and the worker pool are the real ones."""
+
+    def __init__(self, clients, max_workers=MAX_WORKERS):
+        self.clients = list(clients)
+        self.buckets = [TokenBucket() for _ in self.clients]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reddit")
+        self.single_flight = SingleFlight()
@@ -0,0 +1,124 @@
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+
+"""
+An in-memory stand-in for the parts of the Supabase client that store/data_access_layer.py uses:
+table(...).insert / upsert / select / delete, with eq, gt, order and limit, then execute().
+"""
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    def __init__(self, database, table):
+        self.database = database
+        self.table = table
+        self.action = "select"
+        self.columns = None
+        self.rows = None
+        self.on_conflict = None
+        self.filters = []
+        self.order_by = None
+        self.descending = False
+        self.max_rows = None
+
+    def select(self, columns="*"):
+        self.action = "select"
+        self.columns = None if columns.strip() == "*" else [column.strip() for column in columns.split(",")]
+        return self
+
+    def insert(self, rows):
+        self.action = "insert"
+        self.rows = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.action = "upsert"
+        self.rows = rows if isinstance(rows, list) else [rows]
+        self.on_conflict = on_conflict
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, lambda stored: stored == value))
+        return self
+
+    def gt(self, column, value):
+        self.filters.append((column, lambda stored: stored is not None and stored > value))
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = column
+        self.descending = desc
+        return self
+
+    def limit(self, count):
+        self.max_rows = count
+        return self
+
+    def _matches(self, row):
+        return all(condition(row.get(column)) for column, condition in self.filters)
+
+    def execute(self):
+        return FakeResponse(self.database.execute(self))
+
+
+class FakeSupabase:
+    """
+    :param latency: Seconds each execute() takes, like a round-trip to the database.
+    :param primary_keys: The columns (comma separated) upserts match rows on, per table, unless the upsert
+        names them with on_conflict. Defaults to "id".
+    """
+
+    def __init__(self, latency=0.02, primary_keys=None):
+        self.latency = latency
+        self.primary_keys = {"users": "google_id", **(primary_keys or {})}
+        self.tables = {}
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def execute(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            rows = self.tables.setdefault(query.table, [])
+
+            if query.action in ("insert", "upsert"):
+                written = []
+                for row in query.rows:
+                    row = dict(row)
+                    row.setdefault("id", next(self._ids))
+                    row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+                    if query.action == "upsert":
+                        keys = (query.on_conflict or self.primary_keys.get(query.table, "id")).split(",")
+                        rows[:] = [existing for existing in rows
+                                   if any(existing.get(key.strip()) != row.get(key.strip()) for key in keys)]
+                    rows.append(row)
+                    written.append(row)
+                return written
+
+            matching = [row for row in rows if query._matches(row)]
+            if query.action == "delete":
+                rows[:] = [row for row in rows if not query._matches(row)]
+                return matching
+
+            if query.order_by:
+                matching.sort(key=lambda row: row.get(query.order_by) or "", reverse=query.descending)
+            if query.max_rows is not None:
+                matching = matching[:query.max_rows]
+            if query.columns:
+                matching = [{column: row.get(column) for column in query.columns} for row in matching]
+            return [dict(row) for row in matching]
@@ -0,0 +1,105 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from dataclasses import asdict, dataclass
+
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+"""
+Wires the local stand-ins into the backend, in place of Reddit, OpenAI and Supabase.
+
+configure_environment has to run before any backend module is imported, since modules read their
+settings from the environment at import time. install_fakes then hands the fakes to the service registry.
+"""
+
+
+@dataclass
+class BenchmarkConfig:
+    """
+    :param reddit_latency: Seconds per Reddit API call (a search, or fetching a thread's comments).
+    :param embedding_latency: Seconds per embedding API call.
+    :param llm_latency: Seconds to the first token of each LLM call.
+    :param supabase_latency: Seconds per Supabase query.
+    :param chat_mode: The "mode" the chat scenario asks for, "agent" or "direct". Empty means the server's CHAT_MODE.
+    :param vector_backend: VECTOR_BACKEND for the run, "chroma" or "numpy".
+    :param vector_count: How many vectors the vector_query scenario searches.
+    """
+    seed: int = 0
+    reddit_latency: float = 0.05
+    embedding_latency: float = 0.05
+    llm_latency: float = 0.3
+    supabase_latency: float = 0.02
+    posts_per_search: int = 3
+    comments_per_post: int = 20
+    chat_mode: str = ""
+    vector_backend: str = "chroma"
+    vector_count: int = 5000
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def configure_environment(workdir=None, vector_backend="chroma"):
+    """
+    Point every backend setting that could reach a real service at a local or disabled one.
+
+    :param workdir: Where the run keeps its files. By default a temporary directory, deleted when the process exits.
+    """
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="reddit-search-bench-")
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    # a throwaway local vector store, whatever the shell has configured
+    os.environ["VECTOR_BACKEND"] = vector_backend
+    os.environ["CHROMA_HOST"] = ""
+    os.environ["CHROMA_PERSIST_DIRECTORY"] = ""
+    os.environ["NUMPY_STORE_DIRECTORY"] = ""
+    # a fresh embedding cache per run, so runs start equally cold
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embeddings.sqlite3")
+    os.environ["EMBEDDING_PROVIDER"] = "hashing"
+    os.environ["INGESTION_ENABLED"] = "0"
+    os.environ["CHROMA_WARM_UP"] = "0"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("METRICS_SLOW_REQUEST_SECONDS", "3600")
+    return workdir
+
+
+@dataclass
+class Fakes:
+    reddit: object
+    embeddings: object
+    llm: object
+    supabase: object
+    tokenizer: str
+
+
+def install_fakes(config: BenchmarkConfig) -> Fakes:
+    from benchmarks.fake_openai import FakeChatModel, FakeEmbeddingProvider, WordEncoding
+    from benchmarks.fake_reddit import FakeRedditClient, FakeRedditData, FakeRedditPool
+    from benchmarks.fake_supabase import FakeSupabase
+    from services.registry import registry
+    from store.chunking import CHUNK_ENCODING, get_encoding, set_encoding
+    from store.embeddings import set_embedding_provider
+
+    # use the real tokenizer when its encoding is available (tiktoken downloads it once, then caches it)
+    try:
+        get_encoding()
+        tokenizer = CHUNK_ENCODING
+    except Exception:
+        set_encoding(WordEncoding())
+        tokenizer = WordEncoding.name
+
+    fakes = Fakes(
+        reddit=FakeRedditClient(FakeRedditData(config.seed, config.comments_per_post), config.reddit_latency),
+        embeddings=FakeEmbeddingProvider(latency=config.embedding_latency),
+        llm=FakeChatModel(latency=config.llm_latency),
+        supabase=FakeSupabase(config.supabase_latency),
+        tokenizer=tokenizer,
+    )
+    set_embedding_provider(fakes.embeddings)
+    registry.set("reddit", FakeRedditPool([fakes.reddit]))
+    registry.set("llm", fakes.llm)
+    registry.set("summary_llm", fakes.llm)
+    registry.set("supabase", fakes.supabase)
+    return fakes
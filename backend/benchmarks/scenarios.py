@@ -0,0 +1,236 @@
+import gc
+import math
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from services.metrics import API_CALLS, CACHE_REQUESTS, STAGE_DURATION
+
+"""
+The benchmark scenarios, and the runner that times them.
+
+A scenario builds one input per request up front (untimed), then each request is timed on its own.
+Inputs are unique per request, so results measure cold paths rather than caches, except where
+a scenario deliberately repeats them.
+"""
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _stage_totals():
+    with STAGE_DURATION._lock:
+        return {key[0]: total for key, (_, total) in STAGE_DURATION.values.items()}
+
+
+def _counter_totals(counter):
+    with counter._lock:
+        return {"/".join(key): value for key, value in counter.values.items()}
+
+
+def _delta(after, before):
+    return {key: round(value - before.get(key, 0), 6) for key, value in after.items() if value != before.get(key, 0)}
+
+
+def _run_requests(run, inputs, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(prepared):
+        start = time.perf_counter()
+        try:
+            run(prepared)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, inputs))
+    return latencies, errors, time.perf_counter() - start
+
+
+def run_scenario(scenario, requests, concurrency, memory_requests=3, warmup_requests=1):
+    """
+    Time ``requests`` requests of a scenario, ``concurrency`` at a time, then measure its peak memory.
+
+    A few untimed warm-up requests go first, so one-off costs (opening collections, loading models)
+    don't land in the percentiles. Peak memory is measured on a separate, shorter pass, since tracing
+    allocations slows everything down.
+    """
+    _run_requests(scenario.run, [scenario.prepare(-1 - i) for i in range(warmup_requests)], 1)
+    inputs = [scenario.prepare(i) for i in range(requests)]
+    stages_before = _stage_totals()
+    api_calls_before = _counter_totals(API_CALLS)
+    cache_before = _counter_totals(CACHE_REQUESTS)
+
+    latencies, errors, wall_seconds = _run_requests(scenario.run, inputs, concurrency)
+
+    stages = _delta(_stage_totals(), stages_before)
+    api_calls = _delta(_counter_totals(API_CALLS), api_calls_before)
+    cache = _delta(_counter_totals(CACHE_REQUESTS), cache_before)
+
+    memory_inputs = [scenario.prepare(requests + i) for i in range(memory_requests)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        _run_requests(scenario.run, memory_inputs, min(concurrency, memory_requests))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_per_second": round(len(latencies) / wall_seconds, 3) if wall_seconds else 0.0,
+        "latency_ms": {
+            "mean": round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p50": round(1000 * percentile(latencies, 0.50), 2),
+            "p90": round(1000 * percentile(latencies, 0.90), 2),
+            "p99": round(1000 * percentile(latencies, 0.99), 2),
+            "max": round(1000 * max(latencies), 2) if latencies else 0.0,
+        },
+        "peak_memory_mb": round(peak / (1024 * 1024), 2),
+        "stage_seconds": stages,
+        "api_calls": api_calls,
+        "cache_requests": cache,
+        "details": scenario.details() if hasattr(scenario, "details") else {},
+    }
+
+
+class SearchWithinSubreddit:
+    """Search a subreddit and fetch the comments of each result."""
+
+    name = "search_within_subreddit"
+
+    def __init__(self, config):
+        self.config = config
+
+    def prepare(self, i):
+        return f"benchsearch{i % 4}", f"best brunch spot {i}"
+
+    def run(self, prepared):
+        from services.search_reddit import search_within_subreddit
+        subreddit_name, query = prepared
+        search_within_subreddit(subreddit_name, query, self.config.posts_per_search)
+
+
+class UploadRedditContent:
+    """Chunk, embed and index a search's worth of already-fetched posts."""
+
+    name = "upload_reddit_content"
+
+    def __init__(self, config):
+        self.config = config
+
+    def prepare(self, i):
+        from benchmarks.fake_reddit import FakeRedditData
+        from services.search_reddit import process_post
+        data = FakeRedditData(self.config.seed, self.config.comments_per_post)
+        subreddit_name = f"benchupload{i % 4}"
+        posts = [process_post(data.submission(subreddit_name, f"upload {i}", n)) for n in range(self.config.posts_per_search)]
+        return posts, subreddit_name
+
+    def run(self, prepared):
+        from store.chroma_db import upload_reddit_content
+        posts, subreddit_name = prepared
+        upload_reddit_content(posts, subreddit_name)
+
+
+class RagSearchPipeline:
+    """The tool the agent calls: search Reddit, ingest what it finds and retrieve the best chunks."""
+
+    name = "rag_search_pipeline"
+
+    def __init__(self, config):
+        self.config = config
+
+    def prepare(self, i):
+        return f"benchrag{i % 4}", f"where do people go for {i} weekend brunch"
+
+    def run(self, prepared):
+        from services.RAG import rag_search_pipeline
+        subreddit_name, query = prepared
+        rag_search_pipeline(subreddit_name, query, self.config.posts_per_search)
+
+
+class Chat:
+    """POST /chat through the Flask app: agent, tool, LLM and the conversation write, one user per request."""
+
+    name = "chat"
+
+    def __init__(self, config):
+        import wsgi
+        self.config = config
+        self.app = wsgi.app
+        self._local = threading.local()
+
+    def prepare(self, i):
+        prepared = {"message": f"What is the best area to rent an apartment {i}?", "subreddit": f"benchchat{i % 4}",
+                    "user_id": f"bench-user-{i}"}
+        if self.config.chat_mode:
+            prepared["mode"] = self.config.chat_mode
+        return prepared
+
+    def run(self, prepared):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post("/chat", json=prepared)
+        if response.status_code != 200:
+            raise RuntimeError(f"/chat returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+
+class VectorQuery:
+    """Nearest neighbour search over one subreddit's collection, filled with ``vector_count`` random vectors."""
+
+    name = "vector_query"
+    subreddit_name = "benchvectors"
+
+    def __init__(self, config):
+        import numpy as np
+        from store.chroma_db import get_collection
+        from store.embeddings import get_embedding_provider
+        self.config = config
+        self.dimension = get_embedding_provider().dimension
+        self.collection = get_collection(self.subreddit_name)
+        rng = np.random.default_rng(config.seed)
+        for start in range(0, config.vector_count, 1000):
+            count = min(1000, config.vector_count - start)
+            self.collection.add(
+                ids=[f"vector-{start + i}" for i in range(count)],
+                embeddings=rng.normal(size=(count, self.dimension)).astype("float32").tolist(),
+                documents=[f"document {start + i}" for i in range(count)],
+                metadatas=[{"subreddit": self.subreddit_name, "ingested_at": 0} for _ in range(count)],
+            )
+
+    def prepare(self, i):
+        import numpy as np
+        return np.random.default_rng(self.config.seed + 1000 + i).normal(size=self.dimension).tolist()
+
+    def run(self, prepared):
+        from store.chroma_db import query_subreddit
+        query_subreddit(self.subreddit_name, prepared, 10)
+
+    def details(self):
+        # only the numpy store can tell how much memory its vectors take
+        return {"vectors": self.collection.count(), "vector_bytes": getattr(self.collection, "nbytes", None)}
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (SearchWithinSubreddit, UploadRedditContent, RagSearchPipeline, Chat, VectorQuery)
+}
@@ -0,0 +1,100 @@
+import os
+
+from dotenv import load_dotenv
+
+"""
+Gunicorn settings for the production serving mode:
+
+    gunicorn -c gunicorn.conf.py asgi:app
+
+The app is imported once in the master (preload_app) and workers fork from it. Clients and the heavy
+libraries behind them (langchain, chromadb, supabase) are only built inside each worker, on first use,
+through the service registry, so a fresh worker is ready to serve almost immediately.
+
+Workers run uvicorn, so /chat/stream is served on the worker's event loop (see asgi.py) and one worker
+holds many streams at once, while the other routes run in its thread pool. The plain WSGI app still
+works with GUNICORN_WORKER_CLASS=gthread and wsgi:app, but then every open stream holds one of the
+worker's GUNICORN_THREADS threads until it ends.
+
+State that has to be shared between workers lives outside of them:
+- the embedding cache is a sqlite file on the host (EMBEDDING_CACHE_PATH),
+- the vector store and the answer cache should be a Chroma server (CHROMA_HOST). A local store on disk
+  (CHROMA_PERSIST_DIRECTORY, or NUMPY_STORE_DIRECTORY with VECTOR_BACKEND=numpy) can only be opened by
+  a single worker, so several workers without CHROMA_HOST are refused and WEB_CONCURRENCY defaults to 1,
+- conversations are in Supabase, and per-worker memory caches are kept short-lived (see below).
+
+Everything else is per worker: the keyword indexes, subreddit popularity, the ingestion scheduler and
+the Reddit rate limit. The Reddit budget (REDDIT_REQUESTS_PER_SECOND, REDDIT_BURST) is for the whole
+OAuth client, so it is split between the workers below. Metrics are kept per worker too, and added up
+over all of them on /metrics through METRICS_MULTIPROC_DIR.
+"""
+
+
+## the app reads .env too, so the checks below see the same settings it does
+load_dotenv()
+
+## only a Chroma server is shared, local stores belong to one process (see store/chroma_db.py)
+vector_backend = os.environ.get("VECTOR_BACKEND", "chroma")
+shared_store = vector_backend == "chroma" and bool(os.environ.get("CHROMA_HOST"))
+
+
+def _usable_cpus():
+    # the CPUs this process may run on, which can be fewer than the machine has (containers, taskset)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+## uvicorn workers are async and mostly wait on the network, one per usable CPU is enough
+workers = int(os.environ.get("WEB_CONCURRENCY", _usable_cpus() if shared_store else 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn.workers.UvicornWorker")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))  # gthread workers only
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+keepalive = 5
+# recycle workers now and then so slow leaks can't build up
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+accesslog = "-"
+
+if workers > 1:
+    # A user's next message may land on another worker, so a worker can't trust its cached conversation
+    # window for long. The window is re-read from Supabase once it is older than this.
+    os.environ.setdefault("CHAT_MEMORY_CACHE_TTL", "10")
+    # workers share their metrics through this directory, so /metrics shows all of them (services/metrics.py)
+    os.environ.setdefault(
+        "METRICS_MULTIPROC_DIR", os.path.join(os.path.abspath(os.path.dirname(__file__)), ".cache", "metrics")
+    )
+    if not shared_store:
+        local_store = {"chroma": "CHROMA_PERSIST_DIRECTORY", "numpy": "NUMPY_STORE_DIRECTORY"}.get(vector_backend)
+        what = f"{local_store} can't be shared" if os.environ.get(local_store or "") else "Throwaway vector stores can't be shared"
+        raise RuntimeError(
+            f"{what} between {workers} workers. Run a Chroma server and set CHROMA_HOST, or set WEB_CONCURRENCY=1."
+        )
+    # Every worker has its own token bucket, give each one its share of the client's Reddit budget.
+    # The client's totals are kept aside, so reloading this file (gunicorn's HUP) doesn't split them again
+    rate = float(os.environ.setdefault("REDDIT_CLIENT_REQUESTS_PER_SECOND", os.environ.get("REDDIT_REQUESTS_PER_SECOND", "1.6")))
+    burst = float(os.environ.setdefault("REDDIT_CLIENT_BURST", os.environ.get("REDDIT_BURST", "10")))
+    os.environ["REDDIT_REQUESTS_PER_SECOND"] = str(rate / workers)
+    os.environ["REDDIT_BURST"] = str(max(1.0, burst / workers))
+
+
+def on_starting(server):
+    from services.metrics import clear_multiproc_dir
+
+    clear_multiproc_dir()
+
+
+def child_exit(server, worker):
+    from services.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    from wsgi import reset_after_fork, start_background_workers
+
+    reset_after_fork()
+    start_background_workers()
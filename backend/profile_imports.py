@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+
+"""
+Report which modules make the backend slow to import.
+
+    python profile_imports.py                       # what importing the app costs
+    python profile_imports.py services.chatbot -n 30
+
+The module is imported in a fresh interpreter with `python -X importtime`, and the slowest imports are
+listed by cumulative time (the module plus everything it imported first) and by self time.
+"""
+
+
+BACKEND_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def profile_imports(module):
+    """
+    Import ``module`` in a fresh interpreter.
+
+    :return: A list of (module name, self microseconds, cumulative microseconds), one per imported module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"import {module} failed")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if name == " site":
+            # everything so far was imported by the interpreter's own startup, not by the module
+            timings = []
+            continue
+        timings.append((name.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the slowest imports of a backend module.")
+    parser.add_argument("module", nargs="?", default="wsgi", help="The module to import (default: wsgi)")
+    parser.add_argument("-n", "--top", type=int, default=20, help="How many modules to list")
+    args = parser.parse_args()
+
+    try:
+        timings = profile_imports(args.module)
+    except RuntimeError as e:
+        sys.exit(f"Could not import {args.module}: {e}")
+    total = sum(self_us for _, self_us, _ in timings)
+    print(f"import {args.module}: {total / 1000:.1f} ms, {len(timings)} modules\n")
+
+    for title, column in (("cumulative", 2), ("self", 1)):
+        print(f"Slowest by {title} time:")
+        for timing in sorted(timings, key=lambda timing: timing[column], reverse=True)[:args.top]:
+            print(f"  {timing[column] / 1000:9.1f} ms  {timing[0]}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,150 @@
 import sys,os
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 
-from .search_reddit import search_within_subreddit
-from store.chroma_db import get_embedding,get_embeddings,upload_reddit_content,collection
+from .retrieval import DENSE_CANDIDATES, hybrid_search
+from .metrics import in_current_context, stage
+from .search_reddit import iter_subreddit_posts
+from store.chroma_db import get_embedding,get_embeddings,upload_reddit_content,query_subreddit
 """
 The RAG pipeline that will take in a given search term, find the results online, store it in chroma db,
 then return the most relevant information to the user depending on cosine similarity.
 """
 
 
+import threading
 import time
-
-
-
-## takes in a subreddit name and a query, then returns the relevant information from the subreddits, to a given query. 
-## returns the ingotmation as a giant string.
-def rag_search_pipeline(subreddit_name, query, limit=3):
-    print("Entering rag_search_pipeline...")
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+
+
+## retrieval-first mode: answer from the subreddit's existing index when it already holds a chunk that is
+## similar enough to the query and was ingested recently enough, and only hit Reddit otherwise.
+RETRIEVAL_FIRST = os.getenv("RAG_RETRIEVAL_FIRST", "1") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("RAG_SIMILARITY_THRESHOLD", 0.85))
+FRESHNESS_TTL = float(os.getenv("RAG_FRESHNESS_TTL", 6 * 60 * 60))
+
+
+def has_fresh_hit(similar_results, similarity_threshold=SIMILARITY_THRESHOLD, freshness_ttl=FRESHNESS_TTL):
+    """
+    Check whether a query result contains a chunk that is both relevant and fresh.
+
+    The collections use cosine distance, so similarity is 1 - distance.
+    """
+    now = time.time()
+    for distance, metadata in zip(similar_results['distances'][0], similar_results['metadatas'][0]):
+        ingested_at = (metadata or {}).get("ingested_at", 0)
+        if 1 - distance >= similarity_threshold and now - ingested_at <= freshness_ttl:
+            return True
+    return False
+
+
+@dataclass
+class RAGResult:
+    """
+    The outcome of a single rag_search_pipeline run.
+
+    :param context: The retrieved chunks joined into a single string, ready to hand to the LLM.
+    :param source: "index" when the answer came straight from the local index, "reddit" when we fetched.
+    :param documents: The retrieved chunks.
+    :param metadatas: The metadata stored alongside each retrieved chunk.
+    :param posts_fetched: How many Reddit posts were fetched and ingested.
+    :param timings: Seconds spent in each stage. Stages overlap, so they don't add up to "total".
+    """
+    context: str
+    source: str
+    documents: List[str] = field(default_factory=list)
+    metadatas: List[Dict] = field(default_factory=list)
+    posts_fetched: int = 0
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+## shared by every pipeline run, so concurrent chats don't each spin up their own threads
+_pipeline_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_PIPELINE_WORKERS", 16)))
+_timings_lock = threading.Lock()
+
+
+def _timed(timings, stage_name, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs), add its duration to timings[stage_name] and record it as the "rag.<stage_name>" stage."""
+    stage_start_time = time.time()
+    try:
+        with stage(f"rag.{stage_name}"):
+            return fn(*args, **kwargs)
+    finally:
+        with _timings_lock:
+            timings[stage_name] = timings.get(stage_name, 0.0) + time.time() - stage_start_time
+
+
+def _build_result(documents, metadatas, source, posts_fetched, timings):
+    return RAGResult(
+        context=' '.join(documents),
+        source=source,
+        documents=documents,
+        metadatas=metadatas,
+        posts_fetched=posts_fetched,
+        timings=timings,
+    )
+
+
+def run_rag_pipeline(subreddit_name, query, limit=3, retrieval_first=RETRIEVAL_FIRST) -> RAGResult:
+    """
+    Retrieve the chunks of a subreddit that are most relevant to a query, fetching from Reddit when needed.
+    The final retrieval is hybrid (vector + keyword) and reranked, see services/retrieval.py.
+
+    The stages run concurrently: the query is embedded while Reddit is searched, and each post is
+    chunked and embedded as soon as its comments arrive instead of after every post has loaded.
+    """
     start_time = time.time()
-
-    # Timing search_within_subreddit
+    timings = {}
+    embedding_future = _pipeline_executor.submit(
+        in_current_context(_timed), timings, "embed_query", get_embedding, query
+    )
+
+    if retrieval_first:
+        # we need the query embedding to know whether the index can answer on its own. The same results
+        # are the dense half of the hybrid search, so the collection is only queried once
+        query_embedding = embedding_future.result()
+        similar_results = _timed(
+            timings, "query_index", query_subreddit, subreddit_name, query_embedding, DENSE_CANDIDATES
+        )
+        if has_fresh_hit(similar_results):
+            documents, metadatas = _timed(
+                timings, "retrieve", hybrid_search, subreddit_name, query, query_embedding, dense=similar_results
+            )
+            timings["total"] = time.time() - start_time
+            return _build_result(documents, metadatas, "index", 0, timings)
+
+    upload_futures = []
     search_start_time = time.time()
-    print("Calling search_within_subreddit...")
-    results = search_within_subreddit(subreddit_name, query, limit)
-    search_end_time = time.time()
-    print("search_within_subreddit returned with", len(results), "results")  
-    print(f"search_within_subreddit execution time: {search_end_time - search_start_time:.2f} seconds")
-
-    # Timing upload_reddit_content
-    upload_start_time = time.time()
-    print("Uploading content to Chroma DB...")
-    upload_reddit_content(results)
-    upload_end_time = time.time()
-    print("upload_reddit_content done")
-    print(f"upload_reddit_content execution time: {upload_end_time - upload_start_time:.2f} seconds")
+    for post in iter_subreddit_posts(subreddit_name, query, limit):
+        upload_futures.append(
+            _pipeline_executor.submit(
+                in_current_context(_timed), timings, "upload", upload_reddit_content, [post], subreddit_name
+            )
+        )
+    timings["reddit_search"] = time.time() - search_start_time
 
-    # Timing get_embedding
-    embedding_start_time = time.time()
-    print("Creating embedding for query...")
-    query_embedding = get_embedding(query)
-    embedding_end_time = time.time()
-    print("Embedding done, querying collection...")
-    print(f"get_embedding execution time: {embedding_end_time - embedding_start_time:.2f} seconds")
+    query_embedding = embedding_future.result()
+    for future in upload_futures:
+        future.result()
 
-    # Timing collection.query
-    query_start_time = time.time()
-    similar_results = collection.query(query_embeddings=[query_embedding], n_results=10)
-    query_end_time = time.time()
-    print("Collection query complete")
-    print(f"collection.query execution time: {query_end_time - query_start_time:.2f} seconds")
+    documents, metadatas = _timed(timings, "retrieve", hybrid_search, subreddit_name, query, query_embedding)
+    timings["total"] = time.time() - start_time
+    return _build_result(documents, metadatas, "reddit", len(upload_futures), timings)
 
-    end_time = time.time()
-    print(f"Total execution time: {end_time - start_time:.2f} seconds")
-    similar_result_string = ' '.join(similar_results['documents'][0])
 
-    return similar_result_string
+## takes in a subreddit name and a query, then returns the relevant information from the subreddits, to a given query. 
+## returns the ingotmation as a giant string.
+def rag_search_pipeline(subreddit_name, query, limit=3, retrieval_first=RETRIEVAL_FIRST):
+    return run_rag_pipeline(subreddit_name, query, limit, retrieval_first).context
 
 
 
 
 if __name__ == "__main__":
-    rag_search_pipeline("dubai","where to thrift clothes?")
+    result = run_rag_pipeline("dubai","where to thrift clothes?")
+    print(result.source, result.timings)
     print("Finished!")
 
 
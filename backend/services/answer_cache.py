@@ -0,0 +1,158 @@
+import sys,os
+import hashlib
+import threading
+import time
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from services.metrics import CACHE_REQUESTS, stage
+from services.registry import get_chroma_client
+from store.chroma_db import get_embedding
+from store.embeddings import get_embedding_provider
+from store.embedding_cache import normalize_text
+
+"""
+A semantic cache of chatbot answers.
+
+Users often ask near-identical questions of the same subreddit. Each answered question is stored in
+its own vector collection, keyed by its embedding. A new question that is similar enough to one
+already answered for that subreddit, recently enough, gets the cached answer. That skips the
+agent, the Reddit search and the LLM.
+"""
+
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_COLLECTION = "answer_cache"
+## how often expired answers are deleted from the collection, in seconds
+ANSWER_CACHE_PURGE_INTERVAL = float(os.getenv("ANSWER_CACHE_PURGE_INTERVAL", 10 * 60))
+
+
+class SemanticAnswerCache:
+    """
+    Maps (subreddit, question) to an answer, matching questions by cosine similarity of their embeddings.
+
+    :param threshold: The minimum cosine similarity between two questions to reuse an answer.
+    :param ttl: Seconds a cached answer stays valid. Expired answers are deleted every purge_interval seconds.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, collection_name=ANSWER_CACHE_COLLECTION,
+                 purge_interval=ANSWER_CACHE_PURGE_INTERVAL):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = time.time()
+        self.collection_name = collection_name
+        self._collection = None
+        self._lock = threading.Lock()
+        self._collection_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            # concurrent first lookups would otherwise all try to create the collection
+            with self._collection_lock:
+                if self._collection is None:
+                    provider = get_embedding_provider()
+                    # tagged like the subreddit collections, so questions embedded by different models never mix
+                    self._collection = get_chroma_client().get_or_create_collection(
+                        name=f"{self.collection_name}__{provider.tag}",
+                        metadata={
+                            "hnsw:space": "cosine",
+                            "embedding_provider": provider.key,
+                            "embedding_dimension": provider.dimension,
+                        }
+                    )
+        return self._collection
+
+    def reset(self):
+        """Forget the open collection, so the next use opens it through the current Chroma client."""
+        self._collection = None
+
+    def _count(self, hit):
+        CACHE_REQUESTS.inc(cache="answer", result="hit" if hit else "miss")
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, subreddit_name, question):
+        """Return the cached answer for a question, or None."""
+        with stage("answer_cache.lookup"):
+            return self._lookup(subreddit_name, question)
+
+    def _lookup(self, subreddit_name, question):
+        subreddit = subreddit_name.strip().lower()
+        try:
+            if self.collection.count() == 0:
+                self._count(False)
+                return None
+            results = self.collection.query(
+                query_embeddings=[get_embedding(question)],
+                n_results=1,
+                # only answers that are still fresh, so an expired near-duplicate can't hide a valid one
+                where={"$and": [{"subreddit": subreddit}, {"created_at": {"$gte": time.time() - self.ttl}}]},
+                include=["metadatas", "distances"]
+            )
+        except Exception as e:
+            print("An error occurred while looking up the answer cache:", e)
+            self._count(False)
+            return None
+
+        if results["ids"][0]:
+            metadata = results["metadatas"][0][0]
+            similarity = 1 - results["distances"][0][0]
+            if similarity >= self.threshold:
+                self._count(True)
+                return metadata["answer"]
+        self._count(False)
+        return None
+
+    def store(self, subreddit_name, question, answer):
+        """Cache the answer to a question, replacing any earlier answer to the same question."""
+        if not answer:
+            return
+        subreddit = subreddit_name.strip().lower()
+        entry_id = hashlib.sha1(f"{subreddit}\0{normalize_text(question).lower()}".encode("utf-8")).hexdigest()
+        try:
+            self.collection.upsert(
+                ids=[entry_id],
+                embeddings=[get_embedding(question)],
+                documents=[question],
+                metadatas=[{"subreddit": subreddit, "answer": answer, "created_at": time.time()}]
+            )
+            with self._lock:
+                self.stores += 1
+        except Exception as e:
+            print("An error occurred while storing in the answer cache:", e)
+        self.purge_expired()
+
+    def purge_expired(self, force=False):
+        """Delete the answers that are past the TTL, at most once every purge_interval seconds unless forced."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_purge < self.purge_interval:
+                return
+            self._last_purge = now
+        try:
+            self.collection.delete(where={"created_at": {"$lt": now - self.ttl}})
+        except Exception as e:
+            print("An error occurred while purging the answer cache:", e)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+answer_cache = SemanticAnswerCache()
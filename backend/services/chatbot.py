@@ -1,22 +1,81 @@
 from dotenv import load_dotenv
+import asyncio
 import os,sys
+import time
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 
 from langchain.agents import initialize_agent, AgentType
-from langchain.llms import OpenAI
-from langchain.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate
 from langchain.schema import SystemMessage
-from langchain.memory import ConversationBufferMemory
-# Remove old search import:
-# from tool import search
-
+from langchain_core.callbacks import BaseCallbackHandler
 # Import your new tool-creation function:
-
+from services import direct_chat, tool
+from services.answer_cache import ANSWER_CACHE_ENABLED, answer_cache
+from services.memory import conversation_memory
+from services.metrics import LLM_TOKENS, STAGE_ERRORS, record_stage, stage
 from store import data_access_layer
+from store.cache import LRUCache
 
 load_dotenv()
 
 
+CHAT_PROMPT_SUFFIX = """Conversation so far:
+{chat_history}
+
+Question: {input}
+Thought:{agent_scratchpad}"""
+
+## how /chat answers when the request doesn't say: "agent" lets the ReAct agent decide whether to search,
+## "direct" always searches and answers with a single LLM call (see services/direct_chat.py)
+CHAT_MODES = ("agent", "direct")
+CHAT_MODE = os.getenv("CHAT_MODE", "agent")
+
+## agents only depend on the subreddit, so they are built once and reused across requests and users
+AGENT_CACHE_SIZE = int(os.getenv("CHAT_AGENT_CACHE_SIZE", 128))
+_agent_cache = LRUCache(maxsize=AGENT_CACHE_SIZE)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Times every call the agent makes to the LLM as the "llm" stage, and counts the tokens it used.
+    Use a new handler per request.
+    """
+
+    # run in the request's own thread or task, where its trace is current
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def _finish(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            record_stage("llm", time.perf_counter() - started)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        if not usage:
+            # streamed responses carry their usage on the message instead
+            for generation in response.generations[0] if response.generations else []:
+                usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage_metadata.get("input_tokens", 0)
+                completion_tokens += usage_metadata.get("output_tokens", 0)
+        LLM_TOKENS.inc(prompt_tokens, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, kind="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+        STAGE_ERRORS.inc(stage="llm")
+
+
 def initialize_chat_agent(llm, search_tool):
     """
     Initialize a chat agent with system prompts and configuration.
@@ -41,10 +100,8 @@ def initialize_chat_agent(llm, search_tool):
     )
 )
     
-    system_message_prompt = SystemMessagePromptTemplate.from_template(system_message.content)
-    prompt = ChatPromptTemplate.from_messages([system_message_prompt])
-
-    # Initialize the agent with base configuration
+    # Initialize the agent with base configuration. The conversation history is a prompt variable
+    # rather than agent memory, so one agent can serve many users at once.
     agent = initialize_agent(
         tools=[search_tool],
         llm=llm,
@@ -53,41 +110,215 @@ def initialize_chat_agent(llm, search_tool):
         max_iterations=1,
         early_stopping_method="generate",
         handle_parsing_errors=True,
-        return_intermediate_steps=True
-
+        return_intermediate_steps=True,
+        agent_kwargs={
+            "prefix": system_message.content,
+            "suffix": CHAT_PROMPT_SUFFIX,
+            "input_variables": ["input", "chat_history", "agent_scratchpad"],
+        }
     )
 
     
     return agent
 
 
-def start_chat_session(subreddit_name, query, user_id, agent):
+def get_chat_agent(llm, subreddit_name):
     """
-    Start a new chat session with temporary memory.
+    Return the chat agent for a subreddit, building it (and its search tool) on first use.
     """
-    # Create a new memory instance for this session
-    memory_content = data_access_layer.fetch_conversation_data(subreddit_name, user_id)
+    key = subreddit_name.strip().lower()
+    agent = _agent_cache.get(key)
+    if agent is None:
+        subreddit_search_tool = tool.create_subreddit_search_tool(subreddit_name)
+        agent = initialize_chat_agent(llm, subreddit_search_tool)
+        _agent_cache.set(key, agent)
+    return agent
 
-    memory = ConversationBufferMemory(
-        memory_key="chat_history", 
-        return_messages=True, 
-        input_memory=memory_content
-    )
-    
-    # Attach memory to the agent
-    agent.memory = memory
-    
-    # Now run the query
-    response = agent({"input":query})
 
+def resolve_chat_mode(mode=None):
+    """
+    The chat mode to answer a request with: the one it asked for, or CHAT_MODE.
+    Raises ValueError for an unknown mode.
+    """
+    mode = (mode or CHAT_MODE).strip().lower()
+    if mode not in CHAT_MODES:
+        raise ValueError(f"Unknown chat mode {mode!r}, expected one of {', '.join(CHAT_MODES)}")
+    return mode
+
+
+def _answer_cache_applies(memory):
+    """
+    Only the first question of a conversation goes through the answer cache. A follow-up like "what about
+    prices there?" means something different in every conversation, so another user's answer won't do.
+    """
+    return ANSWER_CACHE_ENABLED and memory.is_empty()
 
 
+def _save_turn(subreddit_name, user_id, query, answer, store_answer=False):
+    """Store a finished turn: the conversation table, the memory window and, if asked, the answer cache."""
     ## save the response in the conversation table
-    data_access_layer.upload_conversation_data(subreddit_name,user_id,{query:response["output"]})
-    
+    uploaded = data_access_layer.upload_conversation_data(subreddit_name,user_id,{query:answer})
+    created_at = (uploaded.get("data") or [{}])[0].get("created_at")
+    conversation_memory.record_turn(subreddit_name, user_id, query, answer, created_at)
+    if store_answer:
+        answer_cache.store(subreddit_name, query, answer)
 
+
+def start_chat_session(subreddit_name, query, user_id, agent):
+    """
+    Answer a single message. The user's history is passed in with the message rather than stored
+    on the agent, so the same agent can safely serve concurrent requests.
+    """
+    memory = conversation_memory.get(subreddit_name, user_id)
+
+    # Someone already asked this of the same subreddit, no need to run the agent again
+    use_cache = _answer_cache_applies(memory)
+    cached_answer = answer_cache.lookup(subreddit_name, query) if use_cache else None
+    if cached_answer is not None:
+        _save_turn(subreddit_name, user_id, query, cached_answer)
+        return cached_answer
+
+    # Now run the query
+    with stage("agent"):
+        response = agent.invoke(
+            {"input": query, "chat_history": memory.prompt_text()},
+            config={"callbacks": [MetricsCallbackHandler()]},
+        )
+
+    _save_turn(subreddit_name, user_id, query, response["output"], store_answer=use_cache)
     return response["output"]
 
+
+def start_direct_chat_session(subreddit_name, query, user_id, llm):
+    """
+    Same as start_chat_session, but answered by the direct engine: one search and one LLM call,
+    instead of an agent deciding whether to search.
+    """
+    memory = conversation_memory.get(subreddit_name, user_id)
+    use_cache = _answer_cache_applies(memory)
+    cached_answer = answer_cache.lookup(subreddit_name, query) if use_cache else None
+    if cached_answer is not None:
+        _save_turn(subreddit_name, user_id, query, cached_answer)
+        return cached_answer
+
+    output = direct_chat.answer(subreddit_name, query, memory, llm, callbacks=[MetricsCallbackHandler()])
+
+    _save_turn(subreddit_name, user_id, query, output, store_answer=use_cache)
+    return output
+
+
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+
+class FinalAnswerFilter:
+    """
+    Picks the user-facing answer out of a stream of ReAct tokens. Everything the model writes before
+    "Final Answer:" (its thoughts and tool calls) is held back, everything after it is passed through.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.emitted = None  # index into buffer up to which text has been emitted, once the marker is seen
+
+    def feed(self, text):
+        self.buffer += text
+        if self.emitted is None:
+            index = self.buffer.find(FINAL_ANSWER_MARKER)
+            if index < 0:
+                return ""
+            self.emitted = index + len(FINAL_ANSWER_MARKER)
+            # drop the space the model puts right after the marker
+            while self.emitted < len(self.buffer) and self.buffer[self.emitted] == " ":
+                self.emitted += 1
+        new_text = self.buffer[self.emitted:]
+        self.emitted = len(self.buffer)
+        return new_text
+
+
+async def astream_chat_session(subreddit_name, query, user_id, agent):
+    """
+    Async version of start_chat_session that yields (event, data) pairs as the agent runs:
+    "status" events for progress, "token" events for each piece of the answer, and a final "done"
+    event carrying the whole answer.
+    """
+    memory = await asyncio.to_thread(conversation_memory.get, subreddit_name, user_id)
+    use_cache = _answer_cache_applies(memory)
+    cached_answer = None
+    if use_cache:
+        cached_answer = await asyncio.to_thread(answer_cache.lookup, subreddit_name, query)
+    if cached_answer is not None:
+        yield "token", cached_answer
+        await asyncio.to_thread(_save_turn, subreddit_name, user_id, query, cached_answer)
+        yield "done", cached_answer
+        return
+    inputs = {"input": query, "chat_history": memory.prompt_text()}
+
+    yield "status", "Thinking..."
+    filters = {}
+    streamed = []
+    output = None
+    agent_start_time = time.perf_counter()
+    async for event in agent.astream_events(inputs, config={"callbacks": [MetricsCallbackHandler()]}, version="v2"):
+        kind = event["event"]
+        if kind == "on_tool_start":
+            yield "status", f"Searching r/{subreddit_name}..."
+        elif kind == "on_tool_end":
+            yield "status", "Reading what Reddit had to say..."
+        elif kind == "on_chat_model_stream":
+            # each LLM call gets its own filter, the answer can come from either the first or the final call
+            answer_filter = filters.setdefault(event["run_id"], FinalAnswerFilter())
+            text = answer_filter.feed(event["data"]["chunk"].content or "")
+            if text:
+                streamed.append(text)
+                yield "token", text
+        elif kind == "on_chain_end" and not event.get("parent_ids"):
+            output = (event["data"].get("output") or {}).get("output")
+
+    record_stage("agent", time.perf_counter() - agent_start_time)
+
+    if not output:
+        if not streamed:
+            # nothing to send or save, the route turns this into an error event
+            raise RuntimeError("The agent finished without an answer")
+        # the answer was streamed, but the agent's end event didn't carry it
+        output = "".join(streamed)
+    elif not streamed:
+        # the model answered without the usual marker, so send the answer in one piece
+        yield "token", output
+
+    await asyncio.to_thread(_save_turn, subreddit_name, user_id, query, output, use_cache)
+    yield "done", output
+
+
+async def astream_direct_chat_session(subreddit_name, query, user_id, llm):
+    """
+    Async version of start_direct_chat_session, yielding the same events as astream_chat_session.
+    """
+    memory = await asyncio.to_thread(conversation_memory.get, subreddit_name, user_id)
+    use_cache = _answer_cache_applies(memory)
+    cached_answer = None
+    if use_cache:
+        cached_answer = await asyncio.to_thread(answer_cache.lookup, subreddit_name, query)
+    if cached_answer is not None:
+        yield "token", cached_answer
+        await asyncio.to_thread(_save_turn, subreddit_name, user_id, query, cached_answer)
+        yield "done", cached_answer
+        return
+
+    pieces = []
+    direct_start_time = time.perf_counter()
+    async for event, data in direct_chat.astream_answer(subreddit_name, query, memory, llm, [MetricsCallbackHandler()]):
+        if event == "token":
+            pieces.append(data)
+        yield event, data
+    record_stage("direct", time.perf_counter() - direct_start_time)
+
+    output = "".join(pieces)
+    if not output:
+        raise RuntimeError("The model finished without an answer")
+    await asyncio.to_thread(_save_turn, subreddit_name, user_id, query, output, use_cache)
+    yield "done", output
+
 # def main():
 #     # 1. Create the subreddit-specific tool (e.g., r/dubai)
 #     subreddit_name = "AskReddit"
@@ -0,0 +1,164 @@
+from dotenv import load_dotenv
+import asyncio
+import os,sys
+import re
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from services.metrics import stage
+from services.RAG import run_rag_pipeline
+from services.retrieval import estimate_tokens
+from store.chunking import count_tokens
+
+load_dotenv()
+
+"""
+The direct chat engine: retrieve, then answer with a single LLM call.
+
+The agent in services/chatbot.py only ever has one tool, so it spends an LLM call deciding to search
+the subreddit before it spends another one answering. Here the search always runs and the model is
+asked for the answer straight away, with the conversation and the retrieved chunks packed into a
+fixed token budget.
+"""
+
+
+## how the question is turned into a search query:
+##   "none"      search for the question as asked
+##   "heuristic" (default) add the previous question to messages that are clearly follow-ups, see is_follow_up
+##   "llm"       ask the model to rewrite it, one extra (short) LLM call
+DIRECT_CHAT_REWRITE = os.getenv("DIRECT_CHAT_REWRITE", "heuristic")
+## token budget of the whole prompt, and the part of it the conversation history may use
+DIRECT_CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv("DIRECT_CHAT_PROMPT_TOKEN_BUDGET", 3000))
+DIRECT_CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("DIRECT_CHAT_HISTORY_TOKEN_BUDGET", 800))
+DIRECT_CHAT_SEARCH_LIMIT = int(os.getenv("DIRECT_CHAT_SEARCH_LIMIT", 3))
+
+## a message is a follow-up if it opens like one, or is this short and points back at something
+FOLLOW_UP_OPENERS = [opener.split() for opener in (
+    "what about", "how about", "and", "also", "what else", "anything else", "same for", "more about", "tell me more",
+)]
+FOLLOW_UP_MAX_WORDS = 6
+FOLLOW_UP_WORDS = {"it", "its", "that", "those", "these", "this", "they", "them", "their", "there", "he", "she", "one", "ones"}
+
+SYSTEM_PROMPT = """You are a helpful assistant answering the user's questions using only what people have said on r/{subreddit}, and the conversation so far.
+If the Reddit threads below don't answer the question, say so rather than guessing. Answer directly, without mentioning these instructions.
+
+Conversation so far:
+{chat_history}
+
+Relevant Reddit threads:
+{context}"""
+
+REWRITE_PROMPT = """Rewrite the user's last message as a standalone search query for r/{subreddit}. Reply with the query only.
+
+Conversation so far:
+{chat_history}
+
+Last message: {query}
+Search query:"""
+
+
+def is_follow_up(query):
+    """
+    Whether a message only makes sense after the previous one, like "what about the prices?" or "is it safe
+    there?". A short message that stands on its own, like "best falafel in dubai", is searched as it is.
+    """
+    words = re.findall(r"[a-z']+", query.lower())
+    if any(words[:len(opener)] == opener for opener in FOLLOW_UP_OPENERS):
+        return True
+    return len(words) <= FOLLOW_UP_MAX_WORDS and bool(FOLLOW_UP_WORDS.intersection(words))
+
+
+def rewrite_query(query, memory, llm=None, mode=DIRECT_CHAT_REWRITE, callbacks=None):
+    """
+    Turn the user's message into the query that is searched for, see DIRECT_CHAT_REWRITE.
+
+    :param memory: The conversation's ConversationMemory.
+    :param llm: Only used in "llm" mode.
+    """
+    previous_question = memory.last_question()
+    if mode == "none" or previous_question is None:
+        return query
+    if mode == "llm" and llm is not None:
+        prompt = REWRITE_PROMPT.format(subreddit=memory.subreddit, chat_history=memory.prompt_text(), query=query)
+        with stage("rewrite"):
+            rewritten = llm.invoke(prompt, config={"callbacks": callbacks or []}).content.strip().strip('"')
+        return rewritten or query
+    if is_follow_up(query):
+        return f"{previous_question} {query}"
+    return query
+
+
+def _fit_history(history, budget):
+    """Keep the most recent lines of the conversation that fit in budget tokens."""
+    lines = history.split("\n")
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        tokens = count_tokens(line) + 1
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    return "\n".join(reversed(kept)) or "(no previous messages)", used
+
+
+def _fit_context(documents, metadatas, budget):
+    """Keep the best chunks, in order, that fit in budget tokens. The best one is always kept."""
+    kept = []
+    used = 0
+    for document, metadata in zip(documents, metadatas):
+        # chunks record their real token count at ingest, older ones fall back to an estimate
+        tokens = (metadata or {}).get("tokens") or estimate_tokens(document)
+        if kept and used + tokens > budget:
+            continue
+        kept.append(document)
+        used += tokens
+    return "\n\n---\n\n".join(kept) or "(nothing relevant was found)"
+
+
+def build_messages(subreddit_name, query, history, documents, metadatas,
+                   token_budget=DIRECT_CHAT_PROMPT_TOKEN_BUDGET, history_budget=DIRECT_CHAT_HISTORY_TOKEN_BUDGET):
+    """
+    The prompt of the answering call. The history gets up to history_budget tokens (most recent first),
+    and the retrieved chunks get what is left of token_budget.
+    """
+    fixed_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(query)
+    chat_history, history_tokens = _fit_history(history, min(history_budget, max(0, token_budget - fixed_tokens)))
+    context = _fit_context(documents, metadatas, token_budget - fixed_tokens - history_tokens)
+    return [
+        SystemMessage(content=SYSTEM_PROMPT.format(subreddit=subreddit_name, chat_history=chat_history, context=context)),
+        HumanMessage(content=query),
+    ]
+
+
+def retrieve(subreddit_name, query, memory, llm=None, rewrite=DIRECT_CHAT_REWRITE, callbacks=None):
+    """Search the subreddit for the message and return the prompt that answers it."""
+    search_query = rewrite_query(query, memory, llm, rewrite, callbacks)
+    result = run_rag_pipeline(subreddit_name, search_query, DIRECT_CHAT_SEARCH_LIMIT)
+    return build_messages(subreddit_name, query, memory.prompt_text(), result.documents, result.metadatas)
+
+
+def answer(subreddit_name, query, memory, llm, callbacks=None):
+    """
+    Answer a message with one retrieval and one LLM call (two with DIRECT_CHAT_REWRITE=llm).
+
+    :param memory: The conversation's ConversationMemory.
+    :return: The answer.
+    """
+    with stage("direct"):
+        messages = retrieve(subreddit_name, query, memory, llm, callbacks=callbacks)
+        return llm.invoke(messages, config={"callbacks": callbacks or []}).content
+
+
+async def astream_answer(subreddit_name, query, memory, llm, callbacks=None):
+    """
+    Async version of answer that yields ("status", message) while it searches, then ("token", text)
+    for each piece of the answer.
+    """
+    yield "status", f"Searching r/{subreddit_name}..."
+    messages = await asyncio.to_thread(retrieve, subreddit_name, query, memory, llm, DIRECT_CHAT_REWRITE, callbacks)
+    yield "status", "Reading what Reddit had to say..."
+    async for chunk in llm.astream(messages, config={"callbacks": callbacks or []}):
+        if chunk.content:
+            yield "token", chunk.content
@@ -0,0 +1,169 @@
+import sys,os
+import math
+import queue
+import threading
+import time
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from services.search_reddit import iter_listing_posts
+from store.chroma_db import upload_reddit_content
+
+"""
+Background pre-ingestion of popular subreddits.
+
+Subreddits that people search for and chat with are tracked with a decaying popularity score. A scheduler
+periodically queues the hottest ones, and a small pool of workers pulls their top and new posts and ingests
+them with upload_reddit_content. Chats about popular subreddits then mostly find a ready-made index.
+
+It spends Reddit requests nobody asked for, so it is off unless INGESTION_ENABLED=1.
+"""
+
+
+INGESTION_ENABLED = os.getenv("INGESTION_ENABLED", "0") == "1"
+INGESTION_HOT_SUBREDDITS = int(os.getenv("INGESTION_HOT_SUBREDDITS", 20))
+INGESTION_INTERVAL = float(os.getenv("INGESTION_INTERVAL", 60))
+INGESTION_REFRESH_TTL = float(os.getenv("INGESTION_REFRESH_TTL", 60 * 60))
+INGESTION_CONCURRENCY = int(os.getenv("INGESTION_CONCURRENCY", 2))
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", 50))
+INGESTION_POSTS_PER_LISTING = int(os.getenv("INGESTION_POSTS_PER_LISTING", 10))
+## a subreddit's popularity halves every INGESTION_HALF_LIFE seconds without traffic
+INGESTION_HALF_LIFE = float(os.getenv("INGESTION_HALF_LIFE", 6 * 60 * 60))
+## only subreddits with at least this decayed score are pre-ingested, one request counts 1
+INGESTION_MIN_SCORE = float(os.getenv("INGESTION_MIN_SCORE", 3))
+
+
+class HotSubredditTracker:
+    """
+    Keeps an exponentially decaying popularity score per subreddit.
+
+    :param min_score: The score a subreddit needs to be among the hottest.
+    :param prune_below: Subreddits whose score has decayed below this are forgotten.
+    """
+
+    def __init__(self, half_life=INGESTION_HALF_LIFE, max_tracked=1000, min_score=INGESTION_MIN_SCORE, prune_below=0.1):
+        self.decay = math.log(2) / half_life
+        self.max_tracked = max_tracked
+        self.min_score = min_score
+        self.prune_below = prune_below
+        self.scores = {}  # subreddit -> (score, last updated)
+        self._lock = threading.Lock()
+
+    def _score(self, entry, now):
+        score, updated_at = entry
+        return score * math.exp(-self.decay * (now - updated_at))
+
+    def record(self, subreddit_name, weight=1.0):
+        now = time.time()
+        subreddit = subreddit_name.strip().lower()
+        with self._lock:
+            entry = self.scores.get(subreddit)
+            score = self._score(entry, now) if entry else 0.0
+            self.scores[subreddit] = (score + weight, now)
+            if len(self.scores) > self.max_tracked:
+                coldest = min(self.scores, key=lambda name: self._score(self.scores[name], now))
+                del self.scores[coldest]
+
+    def hottest(self, n):
+        """Return up to n subreddits with at least ``min_score``, hottest first."""
+        now = time.time()
+        with self._lock:
+            scores = {name: self._score(entry, now) for name, entry in self.scores.items()}
+            # the scheduler calls this every interval, so cold subreddits are dropped here
+            for name, score in scores.items():
+                if score < self.prune_below:
+                    del self.scores[name]
+        ranked = sorted((name for name, score in scores.items() if score >= self.min_score), key=scores.get, reverse=True)
+        return ranked[:n]
+
+
+class IngestionScheduler:
+    """
+    Periodically refreshes the hottest subreddits in the vector store in the background.
+
+    The work queue is bounded and at most ``concurrency`` subreddits are ingested at once, so background work
+    can't crowd out interactive requests for Reddit's rate limit.
+    """
+
+    def __init__(self, tracker, hot_subreddits=INGESTION_HOT_SUBREDDITS, interval=INGESTION_INTERVAL,
+                 refresh_ttl=INGESTION_REFRESH_TTL, concurrency=INGESTION_CONCURRENCY, queue_size=INGESTION_QUEUE_SIZE,
+                 posts_per_listing=INGESTION_POSTS_PER_LISTING):
+        self.tracker = tracker
+        self.hot_subreddits = hot_subreddits
+        self.interval = interval
+        self.refresh_ttl = refresh_ttl
+        self.concurrency = concurrency
+        self.posts_per_listing = posts_per_listing
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queued = set()
+        self.last_ingested = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._schedule, name="ingestion-scheduler", daemon=True)]
+        for i in range(self.concurrency):
+            self._threads.append(threading.Thread(target=self._work, name=f"ingestion-worker-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._threads = []
+
+    def enqueue(self, subreddit):
+        """Queue a subreddit for ingestion unless it is already queued or was refreshed recently."""
+        with self._lock:
+            if subreddit in self.queued:
+                return False
+            if time.time() - self.last_ingested.get(subreddit, 0) < self.refresh_ttl:
+                return False
+            try:
+                self.queue.put_nowait(subreddit)
+            except queue.Full:
+                return False
+            self.queued.add(subreddit)
+            return True
+
+    def _schedule(self):
+        while not self._stop.is_set():
+            for subreddit in self.tracker.hottest(self.hot_subreddits):
+                self.enqueue(subreddit)
+            self._stop.wait(self.interval)
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                subreddit = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.ingest(subreddit)
+            except Exception as e:
+                print(f"An error occurred while ingesting r/{subreddit}:", e)
+            finally:
+                with self._lock:
+                    self.queued.discard(subreddit)
+                    self.last_ingested[subreddit] = time.time()
+                self.queue.task_done()
+
+    def ingest(self, subreddit):
+        start_time = time.time()
+        posts = []
+        for sort in ("top", "new"):
+            posts.extend(iter_listing_posts(subreddit, sort, self.posts_per_listing))
+        upload_reddit_content(posts, subreddit)
+        print(f"Pre-ingested {len(posts)} posts from r/{subreddit} in {time.time() - start_time:.2f} seconds")
+
+
+hot_subreddits = HotSubredditTracker()
+ingestion_scheduler = IngestionScheduler(hot_subreddits)
+
+
+def record_subreddit_activity(subreddit_name, weight=1.0):
+    """Note that someone showed interest in a subreddit, so it gets pre-ingested if it stays popular."""
+    if INGESTION_ENABLED and subreddit_name:
+        hot_subreddits.record(subreddit_name, weight)
@@ -0,0 +1,204 @@
+from dotenv import load_dotenv
+import os,sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from services.metrics import CACHE_REQUESTS, stage
+from services.registry import get_summary_llm
+from store import data_access_layer
+from store.cache import LRUCache
+
+load_dotenv()
+
+"""
+Windowed conversation memory for the chatbot.
+
+Only the last few turns of a conversation are kept verbatim. Older turns are folded into a rolling
+summary a few at a time, so the prompt (and the database read) stays roughly the same size no matter
+how long someone has been chatting. The summary is saved next to the conversation, with the timestamp
+of the newest turn it covers, so a conversation that is loaded again picks up where it left off.
+Conversations are cached in-process, so a follow-up message doesn't touch the database at all.
+"""
+
+
+MEMORY_WINDOW = int(os.getenv("CHAT_MEMORY_WINDOW", 6))
+SUMMARY_BATCH = int(os.getenv("CHAT_MEMORY_SUMMARY_BATCH", 3))
+## at most this many turns go into one summary call, and into the prompt while they wait for it
+SUMMARY_MAX_TURNS = int(os.getenv("CHAT_MEMORY_SUMMARY_MAX_TURNS", 30))
+MEMORY_CACHE_SIZE = int(os.getenv("CHAT_MEMORY_CACHE_SIZE", 2048))
+MEMORY_CACHE_TTL = float(os.getenv("CHAT_MEMORY_CACHE_TTL", 30 * 60))
+
+SUMMARY_PROMPT = """Progressively summarize the conversation between a user and an assistant that answers questions about r/{subreddit}, adding to the previous summary and returning a new, short summary.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+
+
+def _turns_from_rows(rows):
+    """
+    Turn rows of the conversation table ([{"chat_history": {question: answer}, "created_at": ...}, ...])
+    into (question, answer, created_at) turns.
+    """
+    turns = []
+    for row in rows:
+        for question, answer in (row.get("chat_history") or {}).items():
+            turns.append((question, answer, row.get("created_at")))
+    return turns
+
+
+def _format_turns(turns):
+    lines = []
+    for question, answer, _ in turns:
+        lines.append(f"User: {question}")
+        lines.append(f"Assistant: {answer}")
+    return "\n".join(lines)
+
+
+class ConversationMemory:
+    """
+    The memory of one (subreddit, user) conversation: a rolling summary plus the last ``window_size`` turns.
+
+    :param summarized_until: The created_at of the newest turn the summary covers.
+    """
+
+    def __init__(self, subreddit, turns=(), window_size=MEMORY_WINDOW, summary="", summarized_until=None):
+        self.subreddit = subreddit
+        self.window_size = window_size
+        self.summary = summary
+        self.summarized_until = summarized_until
+        self.turns = deque(turns)
+        self.overflow = []  # turns that left the window but haven't been summarized yet
+        self.summarizing = False
+        self.lock = threading.Lock()
+        self._trim()
+
+    def _trim(self):
+        while len(self.turns) > self.window_size:
+            self.overflow.append(self.turns.popleft())
+
+    def add_turn(self, question, answer, created_at=None):
+        with self.lock:
+            self.turns.append((question, answer, created_at))
+            self._trim()
+
+    def prompt_text(self):
+        """The memory as it goes into the prompt."""
+        with self.lock:
+            parts = []
+            if self.summary:
+                parts.append(f"Summary of earlier conversation: {self.summary}")
+            if self.overflow:
+                # a long backlog, e.g. of a conversation from before summaries, is summarized in the background
+                parts.append(_format_turns(self.overflow[-SUMMARY_MAX_TURNS:]))
+            if self.turns:
+                parts.append(_format_turns(self.turns))
+        return "\n".join(parts) or "(no previous messages)"
+
+    def is_empty(self):
+        """Whether the conversation hasn't started yet."""
+        with self.lock:
+            return not (self.summary or self.turns or self.overflow)
+
+    def last_question(self):
+        """The user's most recent question, or None for a new conversation."""
+        with self.lock:
+            if self.turns:
+                return self.turns[-1][0]
+            if self.overflow:
+                return self.overflow[-1][0]
+        return None
+
+    def summarize(self, llm):
+        """
+        Fold the turns that left the window into the summary, once enough of them have piled up.
+
+        :return: True if the summary changed.
+        """
+        with self.lock:
+            if self.summarizing or len(self.overflow) < SUMMARY_BATCH:
+                return False
+            self.summarizing = True
+            pending = self.overflow[:SUMMARY_MAX_TURNS]
+            summary = self.summary
+        try:
+            prompt = SUMMARY_PROMPT.format(
+                subreddit=self.subreddit,
+                summary=summary or "(empty)",
+                new_lines=_format_turns(pending),
+            )
+            new_summary = llm.invoke(prompt).content.strip()
+            with self.lock:
+                self.summary = new_summary
+                self.summarized_until = pending[-1][2] or self.summarized_until
+                self.overflow = self.overflow[len(pending):]
+            return True
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+
+class ConversationMemoryStore:
+    """
+    An in-process LRU of conversation memories, loaded from the database on first use.
+    """
+
+    def __init__(self, window_size=MEMORY_WINDOW, cache_size=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL):
+        self.window_size = window_size
+        self.cache = LRUCache(maxsize=cache_size, ttl=ttl)
+        self._summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+
+    def get(self, subreddit, user_id):
+        key = (subreddit.lower(), user_id)
+        memory = self.cache.get(key)
+        CACHE_REQUESTS.inc(cache="memory", result="miss" if memory is None else "hit")
+        if memory is None:
+            with stage("supabase.read"):
+                saved = data_access_layer.fetch_conversation_summary(subreddit, user_id) or {}
+                # every turn the summary doesn't cover yet. Usually that is the window plus a few turns waiting
+                # for the next summary, but a summary that failed to save leaves a longer backlog
+                rows = data_access_layer.fetch_recent_conversation_data(
+                    subreddit, user_id, None, after=saved.get("summarized_until")
+                )
+            memory = ConversationMemory(subreddit, _turns_from_rows(rows), self.window_size,
+                                        saved.get("summary") or "", saved.get("summarized_until"))
+            self.cache.set(key, memory)
+            if len(memory.overflow) >= SUMMARY_BATCH:
+                self._summary_executor.submit(self._summarize, memory, user_id)
+        return memory
+
+    def record_turn(self, subreddit, user_id, question, answer, created_at=None):
+        """
+        Add a turn to the cached window and update the summary in the background if it is due.
+
+        The turn's row is queued for the database before this is called, so a conversation that isn't cached
+        is left alone: loading it now would read that row back and the turn would be added twice.
+        """
+        memory = self.cache.get((subreddit.lower(), user_id))
+        if memory is None:
+            return
+        memory.add_turn(question, answer, created_at)
+        if len(memory.overflow) >= SUMMARY_BATCH:
+            self._summary_executor.submit(self._summarize, memory, user_id)
+
+    def _summarize(self, memory, user_id):
+        try:
+            # a backlog is folded in SUMMARY_MAX_TURNS at a time, saving after each step
+            while memory.summarize(get_summary_llm()):
+                data_access_layer.upsert_conversation_summary(
+                    memory.subreddit, user_id, memory.summary, memory.summarized_until
+                )
+        except Exception as e:
+            print("An error occurred while summarizing the conversation:", e)
+
+    def clear(self, subreddit, user_id):
+        self.cache.pop((subreddit.lower(), user_id))
+
+
+conversation_memory = ConversationMemoryStore()
@@ -0,0 +1,403 @@
+import atexit
+import bisect
+import contextvars
+import fcntl
+import functools
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+"""
+Lightweight request tracing and metrics, exported in the Prometheus text format on /metrics.
+
+- stage("embed") times a block of code into the stage_duration_seconds histogram, and adds it to the
+  current request's trace.
+- counters count things: API calls, chunks embedded, cache hits and misses, LLM tokens.
+- every request gets a trace id (X-Trace-Id), kept in a context variable. Work handed to a thread pool
+  keeps the trace if it is wrapped with in_current_context.
+
+Everything is in-process and costs a lock and a few dict lookups per observation, so it stays on in
+production. With several gunicorn workers each one keeps its own numbers. Set METRICS_MULTIPROC_DIR
+(gunicorn.conf.py does) and each worker saves a snapshot of them there every METRICS_SNAPSHOT_INTERVAL
+seconds. /metrics then adds up the snapshots of all workers, including the ones that have exited, so
+counters don't go backwards when workers are recycled.
+"""
+
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+## requests slower than this print their per-stage breakdown, with their trace id
+SLOW_REQUEST_SECONDS = float(os.getenv("METRICS_SLOW_REQUEST_SECONDS", 10))
+
+## shared by all workers of a host, see snapshot_metrics
+MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(self.labelnames, labels), 0)
+
+    def snapshot(self):
+        """The values as JSON-friendly [labels, value] pairs."""
+        with self._lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, snapshots):
+        """Add up several snapshots, into a single one."""
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        return [[list(key), value] for key, value in values.items()]
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        values = {tuple(key): value for key, value in snapshot}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Counts observations (usually durations in seconds) into cumulative buckets, optionally split by labels."""
+
+    type = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # labels -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels):
+        entry = self.values.get(_label_key(self.labelnames, labels))
+        return sum(entry[0]) if entry else 0
+
+    def snapshot(self):
+        """The values as JSON-friendly [labels, bucket counts, sum] entries."""
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self.values.items()]
+
+    def merge(self, snapshots):
+        """Add up several snapshots, into a single one."""
+        values = {}
+        for snapshot in snapshots:
+            for key, counts, total in snapshot:
+                entry = values.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+        return [[list(key), counts, total] for key, (counts, total) in values.items()]
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        values = {tuple(key): (counts, total) for key, counts, total in snapshot}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, description, labelnames=()):
+        return self._register(Counter, name, description, labelnames)
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, description, labelnames, buckets)
+
+    def snapshot(self):
+        """The values of every metric, by name, as JSON-friendly lists."""
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def merge(self, snapshots):
+        """Add up several registry snapshots, e.g. of different processes, into a single one."""
+        merged = {}
+        for name in {name for snapshot in snapshots for name in snapshot}:
+            parts = [snapshot[name] for snapshot in snapshots if name in snapshot]
+            metric = self.metrics.get(name)
+            # a metric this process doesn't know can't be added up, but render skips it anyway
+            merged[name] = metric.merge(parts) if metric else [entry for part in parts for entry in part]
+        return merged
+
+    def clear(self):
+        """Forget all values, e.g. the ones a forked worker inherited from its parent."""
+        for metric in list(self.metrics.values()):
+            with metric._lock:
+                metric.values.clear()
+
+    def render(self, snapshot=None):
+        """The metrics in the Prometheus text exposition format, of this process or of a (merged) snapshot."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render(None if snapshot is None else snapshot.get(metric.name, [])))
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_DURATION = metrics.histogram(
+    "stage_duration_seconds", "Time spent in each stage of serving a request.", ["stage"]
+)
+STAGE_ERRORS = metrics.counter("stage_errors_total", "Stages that raised an exception.", ["stage"])
+REQUEST_DURATION = metrics.histogram(
+    "http_request_duration_seconds", "Time to build each HTTP response.", ["method", "route", "status"]
+)
+API_CALLS = metrics.counter("api_calls_total", "Calls made to external APIs.", ["api", "status"])
+CACHE_REQUESTS = metrics.counter("cache_requests_total", "Cache lookups, by cache and result.", ["cache", "result"])
+CHUNKS_EMBEDDED = metrics.counter("chunks_embedded_total", "Texts sent to the embedding provider.", ["provider"])
+CHUNKS_INGESTED = metrics.counter("chunks_ingested_total", "Chunks added to a subreddit's vector collection.")
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Tokens used by the chat model.", ["kind"])
+ROWS_WRITTEN = metrics.counter("supabase_rows_written_total", "Conversation rows inserted into Supabase.")
+
+
+## With METRICS_MULTIPROC_DIR set, every process writes its snapshot to metrics.<pid>.json there. When a
+## worker exits, the gunicorn master folds its file into archive.json, so the numbers of recycled workers
+## are kept. Snapshots are replaced atomically, the lock only keeps a scrape from reading a dead worker's
+## numbers twice, once in its own file and once in the archive.
+def _snapshot_path(pid):
+    return os.path.join(MULTIPROC_DIR, f"metrics.{pid}.json")
+
+
+@contextmanager
+def _multiproc_lock():
+    with open(os.path.join(MULTIPROC_DIR, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def snapshot_metrics():
+    """Save this process's numbers to METRICS_MULTIPROC_DIR, where /metrics of any worker picks them up."""
+    if MULTIPROC_DIR:
+        _write_snapshot(_snapshot_path(os.getpid()), metrics.snapshot())
+
+
+def start_snapshot_writer(interval=SNAPSHOT_INTERVAL):
+    """Save this process's numbers every ``interval`` seconds and at exit. Workers call this after the fork."""
+    if not MULTIPROC_DIR:
+        return
+
+    def write():
+        while True:
+            time.sleep(interval)
+            try:
+                snapshot_metrics()
+            except Exception as e:
+                print("An error occurred while saving the metrics:", e)
+
+    threading.Thread(target=write, name="metrics-snapshot", daemon=True).start()
+    atexit.register(snapshot_metrics)
+
+
+def mark_process_dead(pid):
+    """Fold the snapshot of a worker that exited into the archive. The gunicorn master calls this."""
+    if not MULTIPROC_DIR:
+        return
+    path = _snapshot_path(pid)
+    with _multiproc_lock():
+        snapshot = _read_snapshot(path)
+        if snapshot is not None:
+            archive = os.path.join(MULTIPROC_DIR, "archive.json")
+            _write_snapshot(archive, metrics.merge([_read_snapshot(archive) or {}, snapshot]))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def clear_multiproc_dir():
+    """Remove the snapshots of an earlier run, so a restarted server starts from zero like a single process."""
+    if not MULTIPROC_DIR:
+        return
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.json")):
+        os.remove(path)
+
+
+def render_metrics():
+    """The metrics of every worker added up, or of this process alone without METRICS_MULTIPROC_DIR."""
+    if not MULTIPROC_DIR:
+        return metrics.render()
+    snapshot_metrics()
+    with _multiproc_lock():
+        paths = glob.glob(os.path.join(MULTIPROC_DIR, "*.json"))
+        snapshots = [snapshot for snapshot in map(_read_snapshot, paths) if snapshot]
+    return metrics.render(metrics.merge(snapshots))
+
+
+class Trace:
+    """
+    What one request spent its time on.
+
+    :param trace_id: Identifies the request in logs, and is sent back in the X-Trace-Id header.
+    """
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started_at = time.perf_counter()
+        self.stages = {}  # stage -> (seconds, calls). Stages can run in parallel, so they don't add up.
+        self._lock = threading.Lock()
+
+    def add(self, stage_name, seconds):
+        with self._lock:
+            total, calls = self.stages.get(stage_name, (0.0, 0))
+            self.stages[stage_name] = (total + seconds, calls + 1)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def summary(self):
+        with self._lock:
+            stages = " ".join(
+                f"{name}={seconds:.3f}s" + (f"x{calls}" if calls > 1 else "")
+                for name, (seconds, calls) in sorted(self.stages.items(), key=lambda item: -item[1][0])
+            )
+        return f"trace={self.trace_id} total={self.elapsed():.3f}s {stages}"
+
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(trace_id=None):
+    """Start a new trace for the current request, and return it."""
+    trace = Trace(trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def end_trace():
+    """Finish the current request's trace, printing it if the request was slow."""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    _current_trace.set(None)
+    if trace.elapsed() >= SLOW_REQUEST_SECONDS:
+        print(f"Slow request: {trace.summary()}")
+    return trace
+
+
+def in_current_context(fn):
+    """
+    Wrap fn so it runs with the caller's context variables, and so keeps the caller's trace, even when
+    a thread pool runs it. Wrap each submission separately, a context can only be entered by one thread at once.
+    """
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block of code as a stage of the current request:
+
+        with stage("chroma.query"):
+            results = collection.query(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name, seconds):
+    """Record a stage that was timed elsewhere, e.g. by a callback."""
+    STAGE_DURATION.observe(seconds, stage=name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
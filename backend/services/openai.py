@@ -1,7 +1,11 @@
-from langchain_openai import ChatOpenAI
-import os
+import os,sys
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 
-llm = ChatOpenAI(
-    openai_api_key=os.getenv("OPENAI_API_KEY"),  # Correct parameter name
-    temperature=0.2,
-)
+from services.registry import get_llm
+
+
+def __getattr__(name):
+    # there is a single chat model, built by the service registry on first use
+    if name == "llm":
+        return get_llm()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
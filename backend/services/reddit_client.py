@@ -1,17 +1,165 @@
 import requests
 import praw
+import prawcore
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from services.metrics import API_CALLS, stage
+from store.cache import SingleFlight
+
 load_dotenv()
 
 """
 Adding the reddit client.
+
+Every Reddit request in the process goes through a small access layer:
+- one token bucket per OAuth client, kept in sync with Reddit's x-ratelimit-* response headers, so we
+  slow down before Reddit starts rejecting us instead of after,
+- a process-wide worker pool for fetching threads, instead of one thread pool per request,
+- request coalescing, so concurrent fetches of the same search or submission only hit Reddit once,
+- optionally several sets of credentials, with load spread across them.
 """
 
 
-reddit = praw.Reddit(
-        client_id=os.getenv("REDDIT_CLIENT_ID"),
-        client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
-        user_agent=os.getenv("REDDIT_USER_AGENT")
-    )
\ No newline at end of file
+## Reddit allows roughly 100 requests per minute per OAuth client
+REQUESTS_PER_SECOND = float(os.getenv("REDDIT_REQUESTS_PER_SECOND", 1.6))
+BURST = float(os.getenv("REDDIT_BURST", 10))
+MAX_WORKERS = int(os.getenv("REDDIT_MAX_WORKERS", 16))
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Each Reddit request takes one token, and tokens refill at ``rate`` per second.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+    def update_from_headers(self, headers):
+        """
+        Re-sync the bucket with what Reddit says is left in the current rate-limit window.
+
+        Reddit reports the requests remaining and the seconds until the window resets, so the
+        sustainable rate is whatever is left spread evenly over the rest of the window.
+        """
+        try:
+            remaining = float(headers["x-ratelimit-remaining"])
+            reset_seconds = float(headers["x-ratelimit-reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+            if reset_seconds > 0:
+                self.rate = max(remaining, 1) / reset_seconds
+
+
+class RateLimitedRequestor(prawcore.Requestor):
+    """A prawcore requestor that takes a token before every HTTP request and reads the rate-limit headers after."""
+
+    def __init__(self, *args, bucket=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket or TokenBucket()
+
+    def request(self, *args, **kwargs):
+        with stage("reddit.rate_limit_wait"):
+            self.bucket.acquire()
+        try:
+            response = super().request(*args, **kwargs)
+        except Exception:
+            API_CALLS.inc(api="reddit", status="error")
+            raise
+        API_CALLS.inc(api="reddit", status=response.status_code)
+        self.bucket.update_from_headers(response.headers)
+        return response
+
+
+def _load_credentials():
+    """
+    The primary credentials come from REDDIT_CLIENT_ID / REDDIT_CLIENT_SECRET. Extra clients can be added
+    as a comma separated list of id:secret pairs in REDDIT_EXTRA_CREDENTIALS.
+    """
+    credentials = [(os.getenv("REDDIT_CLIENT_ID"), os.getenv("REDDIT_CLIENT_SECRET"))]
+    for pair in os.getenv("REDDIT_EXTRA_CREDENTIALS", "").split(","):
+        if ":" in pair:
+            client_id, client_secret = pair.strip().split(":", 1)
+            credentials.append((client_id, client_secret))
+    return credentials
+
+
+class RedditPool:
+    """
+    A pool of praw clients, one per set of credentials, that share a worker pool and coalesce duplicate requests.
+    """
+
+    def __init__(self, credentials, user_agent, max_workers=MAX_WORKERS):
+        self.buckets = []
+        self.clients = []
+        for client_id, client_secret in credentials:
+            bucket = TokenBucket()
+            self.buckets.append(bucket)
+            self.clients.append(praw.Reddit(
+                client_id=client_id,
+                client_secret=client_secret,
+                user_agent=user_agent,
+                requestor_class=RateLimitedRequestor,
+                requestor_kwargs={"bucket": bucket},
+            ))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reddit")
+        self.single_flight = SingleFlight()
+
+    def client(self):
+        """Return the client with the most rate-limit headroom."""
+        best = max(range(len(self.clients)), key=lambda i: self.buckets[i].available())
+        return self.clients[best]
+
+    def run(self, key, fn):
+        """
+        Call fn(client) on the least loaded client. Concurrent calls with the same key share a single call.
+        """
+        return self.single_flight.do(key, lambda: fn(self.client()))
+
+
+def create_reddit_pool():
+    """Build the pool from the environment. Use services.registry.get_reddit_pool, which builds it once."""
+    return RedditPool(_load_credentials(), os.getenv("REDDIT_USER_AGENT"))
+
+
+def __getattr__(name):
+    # the old module-level pool and client, now built on first use
+    from services.registry import get_reddit_pool
+    if name == "reddit_pool":
+        return get_reddit_pool()
+    if name == "reddit":
+        return get_reddit_pool().clients[0]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,133 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+"""
+The process-wide service registry.
+
+Every external client the backend talks to (the chat and summary LLMs, OpenAI, Supabase, Chroma and the pool of Reddit
+clients) is built here, on first use, instead of when its module is imported. The heavy libraries behind
+them are imported inside the factories too, so a process only pays for the clients the requests it serves
+actually need. /search_subreddits, for example, never loads langchain or chromadb.
+"""
+
+
+class ServiceRegistry:
+    """
+    Lazily built, process-wide singletons, looked up by name.
+
+    Each service is built by its factory the first time it is asked for. Two threads asking at once wait
+    for the same build instead of building it twice.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._services = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        """:param factory: A function with no arguments that builds the service."""
+        with self._lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        service = self._services.get(name)
+        if service is not None:
+            return service
+        if name not in self._factories:
+            raise KeyError(f"No service named {name!r} is registered")
+        with self._locks[name]:
+            if name not in self._services:
+                self._services[name] = self._factories[name]()
+            return self._services[name]
+
+    def set(self, name, service):
+        """Use an already built service, e.g. a fake one in tests or benchmarks."""
+        with self._lock:
+            self._locks.setdefault(name, threading.Lock())
+            self._services[name] = service
+
+    def loaded(self, name):
+        return name in self._services
+
+    def reset(self, *names):
+        """Forget the named services (all of them by default), so they are rebuilt on next use."""
+        with self._lock:
+            for name in names or list(self._services):
+                self._services.pop(name, None)
+
+
+def _create_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        temperature=0.2,
+        streaming=True,
+        stream_usage=True,  # report token usage on streamed responses too
+    )
+
+
+def _create_summary_llm():
+    # deterministic and not streamed, its output only goes into the conversation summary
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(openai_api_key=os.getenv("OPENAI_API_KEY"), temperature=0)
+
+
+def _create_openai():
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+def _create_supabase():
+    from store.initialize_database import create_supabase_client
+    return create_supabase_client()
+
+
+def _create_chroma_client():
+    from store.chroma_db import create_chroma_client
+    return create_chroma_client()
+
+
+def _create_reddit_pool():
+    from services.reddit_client import create_reddit_pool
+    return create_reddit_pool()
+
+
+registry = ServiceRegistry()
+registry.register("llm", _create_llm)
+registry.register("summary_llm", _create_summary_llm)
+registry.register("openai", _create_openai)
+registry.register("supabase", _create_supabase)
+registry.register("chroma", _create_chroma_client)
+registry.register("reddit", _create_reddit_pool)
+
+
+def get_llm():
+    """The chat model the agents answer with."""
+    return registry.get("llm")
+
+
+def get_summary_llm():
+    """The model that folds old conversation turns into the running summary."""
+    return registry.get("summary_llm")
+
+
+def get_openai():
+    """A plain OpenAI client, used for embeddings."""
+    return registry.get("openai")
+
+
+def get_supabase():
+    return registry.get("supabase")
+
+
+def get_chroma_client():
+    return registry.get("chroma")
+
+
+def get_reddit_pool():
+    return registry.get("reddit")
@@ -0,0 +1,98 @@
+import sys,os
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from typing import Dict, List, Tuple
+
+from store.bm25_index import tokenize
+from store.chroma_db import get_keyword_index, query_subreddit
+
+"""
+Hybrid retrieval: dense vector search and BM25 keyword search over the same subreddit, fused with
+reciprocal rank fusion and then reranked locally, so only a few of the best chunks reach the LLM.
+"""
+
+
+DENSE_CANDIDATES = int(os.getenv("RAG_DENSE_CANDIDATES", 20))
+KEYWORD_CANDIDATES = int(os.getenv("RAG_KEYWORD_CANDIDATES", 20))
+TOP_K = int(os.getenv("RAG_TOP_K", 5))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", 2000))
+## reciprocal rank fusion constant, 60 is the value from the original RRF paper
+RRF_K = 60
+## how much weight the reranker gives to the share of query terms a chunk contains
+COVERAGE_WEIGHT = float(os.getenv("RAG_RERANK_COVERAGE_WEIGHT", 0.5))
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough token count, about four characters per token for English text."""
+    return max(1, len(text) // 4)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> Dict[str, float]:
+    """Fuse several best-first lists of ids into a single score per id."""
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+def rerank(query: str, candidates: Dict[str, Tuple[str, Dict]], fused_scores: Dict[str, float]) -> List[str]:
+    """
+    Order candidates by their fused score plus how many of the query's terms they contain.
+
+    This is a cheap local stand-in for a cross-encoder. It rewards chunks that match on both retrievers
+    and actually mention what was asked about.
+    """
+    query_terms = set(tokenize(query))
+    best_fused = max(fused_scores.values(), default=1.0) or 1.0
+
+    def score(id):
+        document = candidates[id][0]
+        coverage = len(query_terms & set(tokenize(document))) / len(query_terms) if query_terms else 0.0
+        return fused_scores[id] / best_fused + COVERAGE_WEIGHT * coverage
+
+    return sorted(candidates, key=score, reverse=True)
+
+
+def hybrid_search(subreddit_name: str, query: str, query_embedding: List[float], top_k: int = TOP_K,
+                  token_budget: int = CONTEXT_TOKEN_BUDGET, dense: Dict = None) -> Tuple[List[str], List[Dict]]:
+    """
+    Retrieve the best chunks of a subreddit for a query.
+
+    :param dense: The vector search results for query_embedding, with DENSE_CANDIDATES results, if the
+        caller already queried the collection.
+    :return: (documents, metadatas) of at most top_k chunks that together fit in token_budget tokens.
+        The best chunk is always returned, even if it alone is over budget.
+    """
+    if dense is None:
+        dense = query_subreddit(subreddit_name, query_embedding, n_results=DENSE_CANDIDATES)
+    keyword_index = get_keyword_index(subreddit_name)
+    keyword = keyword_index.search(query, KEYWORD_CANDIDATES)
+
+    candidates = {}
+    for id, document, metadata in zip(dense['ids'][0], dense['documents'][0], dense['metadatas'][0]):
+        # while another thread is adding to the collection, Chroma can return a vector before its document
+        if document is None:
+            continue
+        candidates[id] = (document, metadata or {})
+    for id, _, document, metadata in keyword:
+        if id not in candidates:
+            candidates[id] = (document, metadata or {})
+
+    fused_scores = reciprocal_rank_fusion([dense['ids'][0], [id for id, *_ in keyword]])
+
+    documents = []
+    metadatas = []
+    used_tokens = 0
+    for id in rerank(query, candidates, fused_scores):
+        if len(documents) >= top_k:
+            break
+        document, metadata = candidates[id]
+        # chunks record their real token count at ingest, older ones fall back to an estimate
+        tokens = metadata.get("tokens") or estimate_tokens(document)
+        if documents and used_tokens + tokens > token_budget:
+            continue
+        documents.append(document)
+        metadatas.append(metadata)
+        used_tokens += tokens
+    return documents, metadatas
@@ -1,73 +1,215 @@
 import sys,os
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
-from services.reddit_client import reddit
-import time
-from concurrent.futures import ThreadPoolExecutor
+from services.metrics import in_current_context, stage
+from services.registry import get_reddit_pool
+from store.cache import LRUCache
+from praw.models import MoreComments
+import heapq
+import itertools
 
 """
 The logic to search for a subreddit, but also to search for the topics within a subreddit.
 """
 
 
-## does not handle pagination yet.
-## simply gets the name, public description, and icon of a subreddit.
-## used for when someone searches for a subreddit.
-def search_subreddits(query, limit=20):
-    results = reddit.subreddits.search(query, limit=limit)
-    
-    subreddit_list = list(results)
+## how much comment text to pull per thread. Anything past the chunk budget would be embedded and
+## thrown away, so there's no point fetching it.
+COMMENT_CHAR_BUDGET = int(os.getenv("REDDIT_COMMENT_CHAR_BUDGET", 12000))
+MAX_MORE_EXPANSIONS = int(os.getenv("REDDIT_MAX_MORE_EXPANSIONS", 5))
+
+
+## results of /search_subreddits are cached per (normalized query, limit). Popular queries and the
+## keystroke-by-keystroke queries of the search box are then served from memory.
+SUBREDDIT_SEARCH_TTL = float(os.getenv("SUBREDDIT_SEARCH_TTL", 10 * 60))
+SUBREDDIT_SEARCH_CACHE_SIZE = int(os.getenv("SUBREDDIT_SEARCH_CACHE_SIZE", 2048))
+_subreddit_search_cache = LRUCache(maxsize=SUBREDDIT_SEARCH_CACHE_SIZE, ttl=SUBREDDIT_SEARCH_TTL)
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def _fetch_subreddits(client, query, limit):
+    subreddit_list = client.subreddits.search(query, limit=limit)
     subreddits = []
         
     for sub in subreddit_list:
-        icon_img = sub.icon_img if sub.icon_img else sub.community_icon
+        # read straight from the listing data; attribute access would lazily re-fetch missing fields
+        data = vars(sub)
+        icon_img = data.get("icon_img") or data.get("community_icon")
         subreddit_details = {
             "display_name": sub.display_name,
-            "public_description": sub.public_description,
+            "public_description": data.get("public_description", ""),
             "icon": icon_img,
-            "subscribers": sub.subscribers,
-            "id": sub.id
+            "subscribers": data.get("subscribers"),
+            "id": data.get("id")
         }
         subreddits.append(subreddit_details)
     return subreddits
 
 
+def _refresh_subreddit_search(query, limit):
+    """Fetch a query from Reddit and cache it. Concurrent refreshes of the same query share one request."""
+    def fetch(client):
+        subreddits = _fetch_subreddits(client, query, limit)
+        _subreddit_search_cache.set((query, limit), subreddits)
+        return subreddits
+    return get_reddit_pool().run(("subreddits", query, limit), fetch)
+
+
+def _results_from_prefix(query, limit):
+    """
+    Look for a cached result for a prefix of the query (e.g. "dub" while the user types "dubai") and
+    keep the subreddits from it that still match.
+    """
+    for end in range(len(query) - 1, 1, -1):
+        cached = _subreddit_search_cache.get((query[:end], limit))
+        if cached is not None:
+            matches = [sub for sub in cached if query in sub["display_name"].lower()]
+            return matches or None
+    return None
 
 
-from concurrent.futures import ThreadPoolExecutor
-import time
+## does not handle pagination yet.
+## simply gets the name, public description, and icon of a subreddit.
+## used for when someone searches for a subreddit.
+def search_subreddits(query, limit=20):
+    query = normalize_query(query)
+    cached = _subreddit_search_cache.get((query, limit))
+    if cached is not None:
+        return cached
+
+    # Serve what we already know from a shorter query straight away, and fetch the full answer for the
+    # next keystroke in the background
+    provisional = _results_from_prefix(query, limit)
+    if provisional is not None:
+        get_reddit_pool().executor.submit(_refresh_subreddit_search, query, limit)
+        return provisional
+
+    return _refresh_subreddit_search(query, limit)
+
+
+
+
+from concurrent.futures import as_completed
 
 def process_post(post):
     """Process a single post to extract title, content, and responses."""
+    with stage("reddit.comments"):
+        comments = [
+            {
+                "id": comment.id,
+                "body": comment.body,
+                "score": comment.score,
+                "created_utc": comment.created_utc,
+            }
+            for comment in iter_comments(post)
+        ]
     return {
+        "POST ID": post.id,
+        "SUBREDDIT": post.subreddit.display_name,
         "POST TITLE": post.title,
         "POST CONTENT": post.selftext,
-        "POST RESPONSES": get_comments_from_thread(post.id)
+        "POST SCORE": post.score,
+        "POST CREATED": post.created_utc,
+        "POST COMMENTS": comments,
+        "POST RESPONSES": [comment["body"] for comment in comments]
     }
 
 
+def fetch_post(post):
+    """Process a post through the shared Reddit pool, coalescing concurrent fetches of the same submission."""
+    return get_reddit_pool().run(("submission", post.id), lambda client: process_post(post))
+
+
+def iter_subreddit_posts(subreddit_name, query, limit=3):
+    """
+    Search a subreddit and yield each processed post as soon as its comments have been fetched,
+    so callers can start working on the first post while the others are still loading.
+    """
+    reddit_pool = get_reddit_pool()
+    with stage("reddit.search"):
+        results = reddit_pool.run(
+            ("search", subreddit_name.lower(), query, limit),
+            lambda client: list(client.subreddit(subreddit_name).search(query, limit=limit))
+        )
+    futures = [reddit_pool.executor.submit(in_current_context(fetch_post), post) for post in results]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def iter_listing_posts(subreddit_name, sort="top", limit=10, time_filter="week"):
+    """
+    Like iter_subreddit_posts, but for one of a subreddit's listings ("top", "new" or "hot") instead of a search.
+    """
+    def fetch(client):
+        subreddit = client.subreddit(subreddit_name)
+        if sort == "top":
+            return list(subreddit.top(time_filter=time_filter, limit=limit))
+        return list(getattr(subreddit, sort)(limit=limit))
+
+    reddit_pool = get_reddit_pool()
+    with stage("reddit.listing"):
+        results = reddit_pool.run(("listing", subreddit_name.lower(), sort, limit, time_filter), fetch)
+    futures = [reddit_pool.executor.submit(in_current_context(fetch_post), post) for post in results]
+    for future in as_completed(futures):
+        yield future.result()
+
+
 def search_within_subreddit(subreddit_name, query, limit=3):
-    start_time = time.time()  # Start the timer
-    subreddit = reddit.subreddit(subreddit_name)  # Get the subreddit object
-    results = list(subreddit.search(query, limit=limit))  # Get the results
-    
-    # Multithread the processing of posts
-    with ThreadPoolExecutor(max_workers=limit) as executor:
-        posts = list(executor.map(process_post, results))  # Map each post to a thread
-
-    end_time = time.time()  # End the timer
-    print(f"Search completed in {end_time - start_time:.2f} seconds.")  # Print the elapsed time
-    return posts
-
-
-def get_comments_from_thread(thread_id):
-    thread = reddit.submission(id=thread_id)
-    thread.comments.replace_more(limit=5)  # Load first 20 comments
-    
-    # Flatten comments and limit to the first 10
-    return [
-        comment.body
-        for comment in thread.comments.list()  # Limit to first 20 comments
-    ]
+    # timed as the "reddit.search" and "reddit.comments" stages, see /metrics
+    return list(iter_subreddit_posts(subreddit_name, query, limit))
+
+
+def iter_comments(submission, char_budget=COMMENT_CHAR_BUDGET, max_expansions=MAX_MORE_EXPANSIONS):
+    """
+    Yield the comments of a submission best first, until char_budget characters have been yielded.
+
+    Comments come out shallowest first and highest scored first within a depth, so the budget is spent on
+    the replies most likely to be useful. "More comments" stubs cost an API call each, so they are only
+    expanded (at most max_expansions of them) when the comments we already have don't fill the budget.
+    """
+    submission.comment_sort = "top"  # only takes effect if the comments haven't been fetched yet
+
+    heap = []
+    pending_more = []
+    counter = itertools.count()
+
+    def push(comments, depth):
+        for comment in comments:
+            if isinstance(comment, MoreComments):
+                pending_more.append((comment, depth))
+            else:
+                heapq.heappush(heap, (depth, -(comment.score or 0), next(counter), comment))
+
+    push(submission.comments, 0)
+    used = 0
+    expansions = 0
+    while used < char_budget:
+        if not heap:
+            if not pending_more or expansions >= max_expansions:
+                break
+            # expand the biggest stub first, it is the most likely to hold good comments
+            pending_more.sort(key=lambda entry: entry[0].count)
+            more, depth = pending_more.pop()
+            expansions += 1
+            push(more.comments(), depth)
+            continue
+
+        depth, _, _, comment = heapq.heappop(heap)
+        push(comment.replies, depth + 1)
+        body = comment.body
+        if not body or body in ("[deleted]", "[removed]"):
+            continue
+        used += len(body)
+        yield comment
+
+
+def get_comments_from_thread(submission, char_budget=COMMENT_CHAR_BUDGET):
+    """Return the bodies of a submission's best comments, within char_budget characters."""
+    if isinstance(submission, str):
+        submission = get_reddit_pool().client().submission(id=submission)
+    return [comment.body for comment in iter_comments(submission, char_budget)]
 
 
 
@@ -1,14 +1,11 @@
 
-from dotenv import load_dotenv
 import os,sys
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
 
-from langchain.agents import initialize_agent, AgentType
 from langchain.tools import Tool
-from langchain.llms import OpenAI
-from langchain.memory import ConversationBufferMemory
 from .RAG import rag_search_pipeline
-import json
+from .metrics import stage
+import asyncio
 
 
 """
@@ -19,11 +16,17 @@ A file defining the tools that the chatbot will use.
 def create_subreddit_search_tool(subreddit_name: str) -> Tool:
     """Return a Tool instance that can only search within the given subreddit_name."""
     def _run(query: str, limit=3) -> str:
-        return rag_search_pipeline(subreddit_name, query, limit)
+        with stage("tool"):
+            return rag_search_pipeline(subreddit_name, query, limit)
+
+    async def _arun(query: str, limit=3) -> str:
+        # the pipeline is thread based, so async agents run it off the event loop
+        return await asyncio.to_thread(_run, query, limit)
 
     return Tool(
         name="Reddit Information Search",
         func=_run,
+        coroutine=_arun,
         description=(
             f"Searches only within r/{subreddit_name} for threads matching a query. "
             "Takes in 'query' (the search term) and optionally 'limit' (number of threads to retrieve)."
@@ -0,0 +1,130 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+"""
+A small in-memory BM25 keyword index, kept next to each subreddit's vector collection.
+
+Dense embeddings are poor at exact keywords such as place or product names, so retrieval fuses
+these keyword scores with the vector search results.
+"""
+
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i if in is it its me my of on or so "
+    "that the their there this to was we what when where which who why will with you your".split()
+)
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    An incrementally updatable Okapi BM25 index.
+
+    :param k1: Term frequency saturation.
+    :param b: How strongly scores are normalized by document length.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.lengths = []
+        self.positions = {}  # document id -> position in the lists above
+        self.postings = defaultdict(dict)  # term -> {position: term frequency}
+        self.total_length = 0
+        self.removed = 0  # positions left empty by remove, until the lists are compacted
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids) - self.removed
+
+    def add(self, ids: List[str], documents: List[str], metadatas: List[Dict] = None) -> None:
+        """Add documents to the index. Documents whose id is already indexed are ignored."""
+        metadatas = metadatas or [{} for _ in ids]
+        with self._lock:
+            for id, document, metadata in zip(ids, documents, metadatas):
+                if id in self.positions:
+                    continue
+                tokens = tokenize(document)
+                position = len(self.ids)
+                self.positions[id] = position
+                self.ids.append(id)
+                self.documents.append(document)
+                self.metadatas.append(metadata)
+                self.lengths.append(len(tokens))
+                self.total_length += len(tokens)
+                for term, frequency in Counter(tokens).items():
+                    self.postings[term][position] = frequency
+
+    def remove(self, ids: List[str]) -> None:
+        """Remove documents from the index. Ids that aren't indexed are ignored."""
+        with self._lock:
+            for id in ids:
+                position = self.positions.pop(id, None)
+                if position is None:
+                    continue
+                for term in set(tokenize(self.documents[position])):
+                    postings = self.postings[term]
+                    postings.pop(position, None)
+                    if not postings:
+                        del self.postings[term]
+                self.total_length -= self.lengths[position]
+                self.ids[position] = self.documents[position] = self.metadatas[position] = None
+                self.lengths[position] = 0
+                self.removed += 1
+            if self.removed > len(self.ids) // 2:
+                self._compact()
+
+    def _compact(self):
+        live = [position for position in range(len(self.ids)) if self.ids[position] is not None]
+        moved = {old: new for new, old in enumerate(live)}
+        self.ids = [self.ids[position] for position in live]
+        self.documents = [self.documents[position] for position in live]
+        self.metadatas = [self.metadatas[position] for position in live]
+        self.lengths = [self.lengths[position] for position in live]
+        self.positions = {id: position for position, id in enumerate(self.ids)}
+        for term, postings in self.postings.items():
+            self.postings[term] = {moved[position]: frequency for position, frequency in postings.items()}
+        self.removed = 0
+
+    def search(self, query: str, n_results: int = 10) -> List[Tuple[str, float, str, Dict]]:
+        """
+        Return up to n_results (id, score, document, metadata) tuples, best first.
+
+        Documents are returned with their ids, read under the same lock, so a concurrent remove can't
+        take them away between the search and a later ``get``.
+        """
+        with self._lock:
+            n_documents = len(self.ids) - self.removed
+            if not n_documents:
+                return []
+            average_length = self.total_length / n_documents or 1.0
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / average_length)
+                    scores[position] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+            return [
+                (self.ids[position], score, self.documents[position], self.metadatas[position])
+                for position, score in best
+            ]
+
+    def get(self, id: str) -> Tuple[str, Dict]:
+        """Return the (document, metadata) stored under an id."""
+        with self._lock:
+            position = self.positions[id]
+            return self.documents[position], self.metadatas[position]
@@ -1,117 +1,495 @@
 import sys, os
 from typing import List, Dict
-import chromadb
-from langchain.text_splitter import CharacterTextSplitter
-import uuid
-from openai import OpenAI
+import atexit
+import hashlib
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor
-from itertools import islice
-from tqdm import tqdm
+from contextlib import contextmanager
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .bm25_index import BM25Index
+from .chunking import chunk_posts, chunk_token_budget
+from .embedding_cache import embedding_cache, cache_key, normalize_text
+from .embeddings import EmbeddingProvider, get_embedding_provider
+
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from services.metrics import API_CALLS, CACHE_REQUESTS, CHUNKS_EMBEDDED, CHUNKS_INGESTED, in_current_context, stage
+from services.registry import get_chroma_client, registry
 
 load_dotenv()
-open_ai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-chromadb_client = chromadb.Client()
-collection = chromadb_client.create_collection(
-    name="reddit_collection",
-    metadata={"hnsw:space": "cosine"}
-)
-
-splitter = CharacterTextSplitter(
-    separator=" ",
-    chunk_size=1500,
-    chunk_overlap=100
-)
-
-def get_embedding(text, model="text-embedding-ada-002"):
-    text = text.replace("\n", " ")
-    response = open_ai_client.embeddings.create(input=[text], model=model)
-    return response.data[0].embedding
-
-def get_embeddings(texts: List[str], batch_size: int = 100, model: str = "text-embedding-ada-002") -> List[List[float]]:
-    """Get embeddings for a large batch of texts by processing in smaller batches"""
-    all_embeddings = []
-    cleaned_texts = [" ".join(text.split()) for text in texts if text and isinstance(text, str)]
-    
-    # Process in parallel using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = []
-        for i in range(0, len(cleaned_texts), batch_size):
-            batch = cleaned_texts[i:i + batch_size]
-            try:
-                response = open_ai_client.embeddings.create(
-                    input=batch,
-                    model=model
+
+## how many embedding requests may be in flight at once, and how often a failed batch is retried
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 3))
+EMBEDDING_RETRY_BASE_DELAY = float(os.getenv("EMBEDDING_RETRY_BASE_DELAY", 0.5))
+
+## where the vector store lives. CHROMA_HOST points at a shared Chroma server (use this when running
+## several workers), CHROMA_PERSIST_DIRECTORY keeps a local on-disk store, and with neither set we fall
+## back to a throwaway store that is deleted when the process exits.
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", 8000))
+CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY")
+## "chroma", or "numpy" for the compact in-process store in store/numpy_store.py (configured with the
+## NUMPY_STORE_* settings). Like a local Chroma store, the numpy store belongs to a single process.
+## Only a Chroma server is shared between processes, see vector_store_is_shared.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+## with a shared Chroma server other processes add to the collections too, so each process rebuilds its
+## keyword index of a subreddit from the store once it is older than this many seconds
+KEYWORD_INDEX_REFRESH_INTERVAL = float(os.getenv("KEYWORD_INDEX_REFRESH_INTERVAL", 5 * 60))
+
+
+def vector_store_is_shared() -> bool:
+    """Whether every process uses the same vector store (a Chroma server) rather than its own."""
+    return VECTOR_BACKEND == "chroma" and bool(CHROMA_HOST)
+
+
+def create_chroma_client():
+    """Build the Chroma client. Use get_chroma_client, which builds it once, on first use."""
+    if VECTOR_BACKEND == "numpy":
+        from .numpy_store import create_numpy_store
+        return create_numpy_store()
+    if VECTOR_BACKEND != "chroma":
+        raise ValueError(f"Unknown VECTOR_BACKEND {VECTOR_BACKEND!r}, expected chroma or numpy")
+
+    import chromadb
+
+    if CHROMA_HOST:
+        return chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    if CHROMA_PERSIST_DIRECTORY:
+        return chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+    # Chroma's in-memory database is dropped as soon as the thread that opened it exits, and the client
+    # may be built on any thread, so the throwaway store lives in a temporary directory instead
+    path = tempfile.mkdtemp(prefix="chroma-")
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return chromadb.PersistentClient(path=path)
+
+
+## one collection per subreddit and embedding model, created lazily on first use and cached for the
+## life of the process
+_collections = {}
+_keyword_indexes = {}
+_keyword_indexes_loaded_at = {}
+_keyword_indexes_refreshing = set()
+_collections_lock = threading.Lock()
+
+
+def reset_client() -> None:
+    """
+    Forget the Chroma client and the collections opened with it, the next use builds a fresh one. Forked
+    worker processes call this, since a client's connections and threads don't survive a fork.
+    """
+    with _collections_lock:
+        registry.reset("chroma")
+        _collections.clear()
+
+
+def __getattr__(name):
+    # the old module-level client, now built on first use
+    if name == "chromadb_client":
+        return get_chroma_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def collection_name(subreddit_name: str) -> str:
+    """
+    Map a subreddit name onto a valid Chroma collection name.
+
+    Subreddit names are case-insensitive, so r/Dubai and r/dubai share a collection. The name ends with
+    the embedding provider's tag, so vectors from different models never end up in the same collection.
+    """
+    name = re.sub(r"[^a-z0-9_-]", "_", subreddit_name.strip().lower())[:30].rstrip("_-")
+    return f"reddit_{name}__{get_embedding_provider().tag}"
+
+
+def get_collection(subreddit_name: str):
+    """Return the collection holding a subreddit's chunks, creating it on first use."""
+    name = collection_name(subreddit_name)
+    collection = _collections.get(name)
+    if collection is None:
+        with _collections_lock:
+            collection = _collections.get(name)
+            if collection is None:
+                provider = get_embedding_provider()
+                collection = get_chroma_client().get_or_create_collection(
+                    name=name,
+                    metadata={
+                        "hnsw:space": "cosine",
+                        "subreddit": subreddit_name.strip().lower(),
+                        "embedding_provider": provider.key,
+                        "embedding_dimension": provider.dimension,
+                    }
                 )
-                batch_embeddings = [res.embedding for res in response.data]
-                all_embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"Error in batch {i//batch_size}: {str(e)}")
-                continue
-    
-    return all_embeddings
+                _collections[name] = collection
+    return collection
+
+
+def _load_keyword_index(subreddit_name: str) -> BM25Index:
+    index = BM25Index()
+    stored = get_collection(subreddit_name).get(include=["documents", "metadatas"])
+    index.add(stored["ids"], stored["documents"], stored["metadatas"])
+    return index
+
+
+def _refresh_keyword_index(subreddit_name: str, name: str) -> None:
+    try:
+        index = _load_keyword_index(subreddit_name)
+        with _collections_lock:
+            _keyword_indexes[name] = index
+    except Exception as e:
+        print(f"Error while refreshing the keyword index for r/{subreddit_name}: {str(e)}")
+    finally:
+        with _collections_lock:
+            _keyword_indexes_loaded_at[name] = time.time()
+            _keyword_indexes_refreshing.discard(name)
+
+
+def get_keyword_index(subreddit_name: str) -> BM25Index:
+    """
+    Return the BM25 keyword index that sits next to a subreddit's collection.
+
+    The index lives in memory, so the first call in a process builds it from the documents already stored
+    in the collection. After that, upload_reddit_content keeps it up to date with what this process adds.
+    When the store is shared, chunks added by other processes are picked up by rebuilding the index in the
+    background every KEYWORD_INDEX_REFRESH_INTERVAL seconds, the stale index is served until then.
+    """
+    name = collection_name(subreddit_name)
+    index = _keyword_indexes.get(name)
+    if index is None:
+        with _collections_lock:
+            index = _keyword_indexes.get(name)
+            if index is not None:
+                return index
+        try:
+            index = _load_keyword_index(subreddit_name)
+        except Exception as e:
+            print(f"Error while loading the keyword index for r/{subreddit_name}: {str(e)}")
+            index = BM25Index()
+        with _collections_lock:
+            if name not in _keyword_indexes:
+                _keyword_indexes_loaded_at[name] = time.time()
+            index = _keyword_indexes.setdefault(name, index)
+    elif vector_store_is_shared() and time.time() - _keyword_indexes_loaded_at.get(name, 0) > KEYWORD_INDEX_REFRESH_INTERVAL:
+        with _collections_lock:
+            refresh = name not in _keyword_indexes_refreshing
+            _keyword_indexes_refreshing.add(name)
+        if refresh:
+            threading.Thread(target=_refresh_keyword_index, args=(subreddit_name, name), daemon=True).start()
+    return index
+
+
+def warm_up_collections(max_collections: int = None) -> int:
+    """
+    Open every stored subreddit collection and run one query against it, so its HNSW index is loaded
+    into memory before the first user request instead of during it.
+
+    :param max_collections: Stop after this many collections, or None to warm them all.
+    :return: The number of collections warmed.
+    """
+    warmed = 0
+    start_time = time.time()
+    for entry in get_chroma_client().list_collections():
+        if max_collections is not None and warmed >= max_collections:
+            break
+        # newer chroma versions return names, older ones return collection objects
+        name = entry if isinstance(entry, str) else entry.name
+        if not (name.startswith("reddit_") and name.endswith(f"__{get_embedding_provider().tag}")):
+            continue
+        try:
+            collection = get_chroma_client().get_collection(name=name)
+            with _collections_lock:
+                collection = _collections.setdefault(name, collection)
+            sample = collection.peek(limit=1)
+            if len(sample["ids"]) > 0:
+                collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1, include=[])
+            warmed += 1
+        except Exception as e:
+            print(f"Error while warming up collection {name}: {str(e)}")
+    print(f"Warmed up {warmed} collections in {time.time() - start_time:.2f} seconds")
+    return warmed
+
 
-def upload_reddit_content(reddit_content: List[Dict]) -> None:
-    """Process and upload Reddit content with optimized batching"""
+def query_subreddit(subreddit_name: str, query_embedding: List[float], n_results: int = 10, where: Dict = None) -> Dict:
+    """Find the chunks of a single subreddit that are closest to ``query_embedding``."""
+    collection = get_collection(subreddit_name)
+    count = collection.count()
+    if count == 0:
+        return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+    with stage("chroma.query"):
+        return collection.query(
+            query_embeddings=[query_embedding],
+            n_results=min(n_results, count),
+            where=where
+        )
+
+
+def get_embedding(text, provider: EmbeddingProvider = None):
+    return get_embeddings([text], provider=provider)[0]
+
+
+def _embed_batch(batch: List[str], provider: EmbeddingProvider, max_retries: int) -> List[List[float]]:
+    """Embed a single batch, retrying with exponential backoff on failure."""
+    delay = EMBEDDING_RETRY_BASE_DELAY
+    for attempt in range(max_retries + 1):
+        try:
+            with stage("embed"):
+                embeddings = provider.embed(batch)
+            API_CALLS.inc(api=f"embeddings.{provider.name}", status="ok")
+            CHUNKS_EMBEDDED.inc(len(batch), provider=provider.name)
+            return embeddings
+        except Exception as e:
+            API_CALLS.inc(api=f"embeddings.{provider.name}", status="error")
+            if attempt == max_retries:
+                raise
+            print(f"Embedding batch failed ({str(e)}), retrying in {delay:.1f}s...")
+            time.sleep(delay + random.uniform(0, delay))
+            delay *= 2
+
+
+def get_embeddings(
+    texts: List[str],
+    batch_size: int = 100,
+    provider: EmbeddingProvider = None,
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+    max_retries: int = EMBEDDING_MAX_RETRIES,
+) -> List[List[float]]:
+    """
+    Get embeddings for a large batch of texts by processing smaller batches concurrently.
+
+    The returned list is aligned with ``texts``: embeddings[i] belongs to texts[i].
+    Texts already in the embedding cache are served from it and only cache misses are sent
+    to the provider (the configured one unless ``provider`` is given). At most ``max_concurrency``
+    requests are in flight at once, and a batch that still fails after ``max_retries`` retries
+    raises instead of being dropped.
+    """
+    provider = provider or get_embedding_provider()
+    max_concurrency = min(max_concurrency, provider.max_concurrency)
+    cleaned_texts = [normalize_text(text) or " " for text in texts]
+    keys = [cache_key(provider.key, text) for text in cleaned_texts]
+    cached = embedding_cache.get_many(keys)
+    CACHE_REQUESTS.inc(len(cached), cache="embedding", result="hit")
+    CACHE_REQUESTS.inc(len(keys) - len(cached), cache="embedding", result="miss")
+
+    # embed each missing text once, even if it appears several times in the input
+    missing = {}
+    for key, text in zip(keys, cleaned_texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+    missing_keys = list(missing)
+    missing_texts = list(missing.values())
+
+    batches = [missing_texts[i:i + batch_size] for i in range(0, len(missing_texts), batch_size)]
+    if batches:
+        # results are collected in submission order, so batches are reassembled in input order
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as executor:
+            futures = [
+                executor.submit(in_current_context(_embed_batch), batch, provider, max_retries) for batch in batches
+            ]
+            new_embeddings = [embedding for future in futures for embedding in future.result()]
+        fresh = dict(zip(missing_keys, new_embeddings))
+        embedding_cache.set_many(fresh)
+        cached.update(fresh)
+
+    return [cached[key] for key in keys]
+
+
+def chunk_id(submission_id: str, index: int, chunk: str) -> str:
+    """A deterministic ID for a chunk, so re-ingesting the same thread maps onto the same records."""
+    content_hash = hashlib.sha1(chunk.encode("utf-8")).hexdigest()[:16]
+    return f"{submission_id}_{index}_{content_hash}"
+
+
+def get_existing_ids(collection, ids: List[str]) -> set:
+    """Return the subset of ``ids`` that is already stored in the collection."""
+    existing = set()
+    for i in range(0, len(ids), 1000):
+        try:
+            existing.update(collection.get(ids=ids[i:i + 1000], include=[])["ids"])
+        except Exception as e:
+            print(f"Error while checking for existing chunks: {str(e)}")
+    return existing
+
+
+## uploads touching the same thread are serialized, so one upload's cleanup of outdated chunks can't
+## delete the chunks another upload of that thread has just added. This only covers the threads of this
+## process, workers sharing a Chroma server can still interleave
+_submission_locks = {}  # (collection name, submission id) -> [lock, uploads holding or waiting for it]
+_submission_locks_lock = threading.Lock()
+
+
+@contextmanager
+def submission_locks(subreddit_name: str, submission_ids):
+    """Hold the upload locks of the given submissions, taken in a fixed order so uploads can't deadlock."""
+    name = collection_name(subreddit_name)
+    keys = [(name, id) for id in sorted(set(submission_ids), key=str)]
+    with _submission_locks_lock:
+        entries = []
+        for key in keys:
+            entry = _submission_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            entries.append(entry)
+    acquired = []
+    try:
+        for lock, _ in entries:
+            lock.acquire()
+            acquired.append(lock)
+        yield
+    finally:
+        for lock in acquired:
+            lock.release()
+        # drop the locks nobody is waiting for, so the table doesn't grow with every thread ever ingested
+        with _submission_locks_lock:
+            for key, entry in zip(keys, entries):
+                entry[1] -= 1
+                if not entry[1]:
+                    del _submission_locks[key]
+
+
+def delete_stale_chunks(subreddit_name: str, current_ids: Dict[str, set]) -> int:
+    """
+    Delete the stored chunks of the given submissions that aren't among their current chunk ids.
+
+    A chunk's id depends on how the thread's comments were packed, so when a thread changes (new comments,
+    new scores) it is chunked differently and its old chunks would otherwise pile up next to the new ones.
+
+    :param current_ids: The ids of each submission's chunks as just ingested, by submission id.
+    :return: How many chunks were deleted.
+    """
+    if not current_ids:
+        return 0
+    collection = get_collection(subreddit_name)
+    keep = set().union(*current_ids.values())
+    stored = collection.get(where={"submission_id": {"$in": list(current_ids)}}, include=[])["ids"]
+    stale = [id for id in stored if id not in keep]
+    if stale:
+        with stage("chroma.delete"):
+            collection.delete(ids=stale)
+        get_keyword_index(subreddit_name).remove(stale)
+    return len(stale)
+
+
+def upload_reddit_content(reddit_content: List[Dict], subreddit_name: str) -> None:
+    """Process and upload Reddit content into the subreddit's collection with optimized batching"""
     if not reddit_content:
         return
+    collection = get_collection(subreddit_name)
+    ingested_at = time.time()
     
     # Prepare all chunks and their metadata
     all_chunks = []
     all_metadata = []
     all_ids = []
     
-    # Process posts in parallel
-    def process_post(post):
-        combined_text = f"{post.get('POST TITLE', '')} {post.get('POST CONTENT', '')} {' '.join(post.get('POST RESPONSES', []))}"
-        if not combined_text.strip():
-            return [], [], []
-        
-        chunks = splitter.split_text(combined_text)
+    # Pack whole comments into token-budgeted chunks, all posts in one batch
+    def process_post(post, chunks):
+        submission_id = chunks[0].metadata["submission_id"] if chunks else None
         post_chunks = []
         post_metadata = []
         post_ids = []
         
-        for chunk in chunks:
-            post_chunks.append(chunk)
+        for index, chunk in enumerate(chunks):
+            post_chunks.append(chunk.text)
             post_metadata.append({
                 "type": "combined_content",
-                "title": post.get('POST TITLE', '')[:100]
+                "title": post.get('POST TITLE', '')[:100],
+                "subreddit": post.get('SUBREDDIT') or subreddit_name,
+                "ingested_at": ingested_at,
+                **chunk.metadata,
             })
-            post_ids.append(f"combined_{uuid.uuid4()}")
+            post_ids.append(chunk_id(submission_id, index, chunk.text))
         
         return post_chunks, post_metadata, post_ids
     
-    # Process posts in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(process_post, reddit_content))
+    with stage("chunk"):
+        # a chunk is never longer than the embedding model reads
+        chunked_posts = chunk_posts(reddit_content, chunk_token_budget(get_embedding_provider()))
+    results = [process_post(post, chunks) for post, chunks in zip(reddit_content, chunked_posts)]
         
+    # Chunk IDs are deterministic, so a chunk we've seen before (in this upload or an earlier one)
+    # is skipped before we pay to embed it again
+    seen_ids = set()
+    current_ids = {}  # submission id -> the ids of its chunks in this upload
     for chunks, metadata, ids in results:
-        all_chunks.extend(chunks)
-        all_metadata.extend(metadata)
-        all_ids.extend(ids)
-    
-    print(f"Processing {len(all_chunks)} chunks...")
+        for chunk, chunk_metadata, id in zip(chunks, metadata, ids):
+            current_ids.setdefault(chunk_metadata["submission_id"], set()).add(id)
+            if id in seen_ids:
+                continue
+            seen_ids.add(id)
+            all_chunks.append(chunk)
+            all_metadata.append(chunk_metadata)
+            all_ids.append(id)
+
+    with submission_locks(subreddit_name, current_ids):
+        existing_ids = get_existing_ids(collection, all_ids)
+        if existing_ids:
+            # We just saw these chunks on Reddit, so mark them as fresh without re-embedding them
+            refreshed = [i for i, id in enumerate(all_ids) if id in existing_ids]
+            try:
+                with stage("chroma.update"):
+                    collection.update(
+                        ids=[all_ids[i] for i in refreshed],
+                        metadatas=[all_metadata[i] for i in refreshed]
+                    )
+            except Exception as e:
+                print(f"Error while refreshing existing chunks: {str(e)}")
+            keep = [i for i, id in enumerate(all_ids) if id not in existing_ids]
+            all_chunks = [all_chunks[i] for i in keep]
+            all_metadata = [all_metadata[i] for i in keep]
+            all_ids = [all_ids[i] for i in keep]
+            print(f"Skipping {len(existing_ids)} chunks that are already indexed")
+
+        if all_chunks:
+            print(f"Processing {len(all_chunks)} chunks...")
+            if not _add_chunks(collection, subreddit_name, all_chunks, all_metadata, all_ids):
+                # keep the old chunks of these threads rather than leave them with none
+                return
+
+        try:
+            stale = delete_stale_chunks(subreddit_name, current_ids)
+            if stale:
+                print(f"Deleted {stale} outdated chunks")
+        except Exception as e:
+            print(f"Error while deleting outdated chunks: {str(e)}")
+
+
+def _add_chunks(collection, subreddit_name: str, all_chunks: List[str], all_metadata: List[Dict],
+                all_ids: List[str]) -> bool:
+    """Embed and add new chunks to the collection and the keyword index. Returns whether all of them were added."""
     
-    # Get embeddings in optimized batches
-    embeddings = get_embeddings(all_chunks)
+    # Get embeddings in optimized batches. A batch that keeps failing aborts the upload,
+    # so we never add vectors that are misaligned with their documents.
+    try:
+        embeddings = get_embeddings(all_chunks)
+    except Exception as e:
+        print(f"Error while embedding chunks, skipping upload: {str(e)}")
+        return False
     
     # Upload to ChromaDB in batches
     batch_size = 1000
+    added = True
     for i in range(0, len(all_chunks), batch_size):
         end_idx = min(i + batch_size, len(all_chunks))
         try:
-            collection.add(
-                embeddings=embeddings[i:end_idx],
-                documents=all_chunks[i:end_idx],
-                metadatas=all_metadata[i:end_idx],
-                ids=all_ids[i:end_idx]
-            )
+            with stage("chroma.add"):
+                collection.add(
+                    embeddings=embeddings[i:end_idx],
+                    documents=all_chunks[i:end_idx],
+                    metadatas=all_metadata[i:end_idx],
+                    ids=all_ids[i:end_idx]
+                )
+            get_keyword_index(subreddit_name).add(all_ids[i:end_idx], all_chunks[i:end_idx], all_metadata[i:end_idx])
+            CHUNKS_INGESTED.inc(end_idx - i)
         except Exception as e:
             print(f"Error during batch upload: {str(e)}")
+            added = False
             continue
     
     print(f"Successfully uploaded {len(embeddings)} chunks to ChromaDB")
+    return added
 
 # Example usage:
 # upload_reddit_content(reddit_data)
\ No newline at end of file
@@ -0,0 +1,169 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+"""
+Token-aware, structure-preserving chunking of Reddit posts.
+
+Instead of concatenating a thread and cutting it every N characters, whole comments are packed into
+chunks up to a token budget, measured with the tokenizer of the embedding model. A comment is only
+ever split when it is on its own bigger than the budget. Each chunk records which comments it holds.
+"""
+
+
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", 512))
+CHUNKER_THREADS = int(os.getenv("CHUNKER_THREADS", 4))
+## text-embedding-ada-002 (and the text-embedding-3 models) use the cl100k_base encoding
+CHUNK_ENCODING = os.getenv("CHUNK_ENCODING", "cl100k_base")
+
+_encoding = None
+
+
+def get_encoding():
+    """Load the tokenizer on first use, it has to be read (or downloaded) and is slow to build."""
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(CHUNK_ENCODING)
+    return _encoding
+
+
+def set_encoding(encoding) -> None:
+    """
+    Replace the tokenizer, e.g. with an offline one in tests or benchmarks. It needs tiktoken's
+    encode, encode_batch and decode methods.
+    """
+    global _encoding
+    _encoding = encoding
+
+
+@dataclass
+class Chunk:
+    """
+    :param text: The chunk's text, starting with the title of the post it belongs to.
+    :param metadata: Chroma-compatible (flat, scalar valued) metadata for the chunk.
+    """
+    text: str
+    metadata: Dict = field(default_factory=dict)
+
+
+@dataclass
+class _Unit:
+    """A piece of a post that we try not to split: the post body or a single comment."""
+    id: str
+    text: str
+    score: int
+    created_utc: float
+    tokens: List[int] = field(default_factory=list)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def _submission_id(post: Dict) -> str:
+    return post.get('POST ID') or hashlib.sha1(post.get('POST TITLE', '').encode("utf-8")).hexdigest()[:12]
+
+
+def _post_units(post: Dict) -> List[_Unit]:
+    submission_id = _submission_id(post)
+    units = []
+    content = post.get('POST CONTENT', '')
+    if content.strip():
+        units.append(_Unit(submission_id, content, post.get('POST SCORE', 0), post.get('POST CREATED', 0.0)))
+
+    comments = post.get('POST COMMENTS')
+    if comments is None:
+        # posts without structured comments only have the comment bodies
+        comments = [{"id": "", "body": body, "score": 0, "created_utc": 0.0} for body in post.get('POST RESPONSES', [])]
+    for comment in comments:
+        if comment["body"].strip():
+            units.append(_Unit(comment["id"], comment["body"], comment["score"] or 0, comment["created_utc"] or 0.0))
+    return units
+
+
+def _pack(post: Dict, units: List[_Unit], title_tokens: int, token_budget: int) -> List[Chunk]:
+    """Greedily pack a post's units into chunks, in order, splitting only units that can't fit on their own."""
+    title = post.get('POST TITLE', '')
+    budget = max(token_budget - title_tokens, 32)
+
+    pieces = []
+    for unit in units:
+        if len(unit.tokens) <= budget:
+            pieces.append((unit, unit.text, len(unit.tokens)))
+            continue
+        for start in range(0, len(unit.tokens), budget):
+            window = unit.tokens[start:start + budget]
+            pieces.append((unit, get_encoding().decode(window), len(window)))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush():
+        if not current:
+            return
+        parts = [title] if title else []
+        parts.extend(piece_text for _, piece_text, _ in current)
+        text = "\n".join(parts)
+        members = [unit for unit, _, _ in current]
+        chunks.append(Chunk(text=text, metadata={
+            "submission_id": _submission_id(post),
+            "comment_ids": ",".join(dict.fromkeys(unit.id for unit in members if unit.id)),
+            "score": max(unit.score for unit in members),
+            "created_utc": max(unit.created_utc for unit in members),
+            "tokens": title_tokens + sum(tokens for _, _, tokens in current),
+        }))
+
+    for piece in pieces:
+        if current and current_tokens + piece[2] > budget:
+            flush()
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += piece[2]
+    flush()
+
+    if not chunks and title.strip():
+        # a post with nothing but a title still gets a chunk
+        chunks.append(Chunk(text=title, metadata={
+            "submission_id": _submission_id(post),
+            "comment_ids": "",
+            "score": post.get('POST SCORE', 0),
+            "created_utc": post.get('POST CREATED', 0.0),
+            "tokens": title_tokens,
+        }))
+    return chunks
+
+
+def chunk_token_budget(provider) -> int:
+    """CHUNK_TOKEN_BUDGET, or less if the embedding provider's model reads less of a chunk than that."""
+    return min(CHUNK_TOKEN_BUDGET, provider.max_chunk_tokens or CHUNK_TOKEN_BUDGET)
+
+
+def chunk_posts(posts: List[Dict], token_budget: int = CHUNK_TOKEN_BUDGET) -> List[List[Chunk]]:
+    """
+    Chunk many posts at once.
+
+    Every title, body and comment across all posts is tokenized in a single multi-threaded batch, then each
+    post is packed on its own.
+
+    :return: One list of chunks per post, in the same order as ``posts``.
+    """
+    post_units = [_post_units(post) for post in posts]
+    titles = [post.get('POST TITLE', '') for post in posts]
+    texts = titles + [unit.text for units in post_units for unit in units]
+    encoded = get_encoding().encode_batch(texts, num_threads=CHUNKER_THREADS, disallowed_special=())
+
+    title_tokens = [len(tokens) for tokens in encoded[:len(posts)]]
+    position = len(posts)
+    for units in post_units:
+        for unit in units:
+            unit.tokens = encoded[position]
+            position += 1
+
+    return [
+        _pack(post, units, title_count, token_budget)
+        for post, units, title_count in zip(posts, post_units, title_tokens)
+    ]
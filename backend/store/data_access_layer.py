@@ -1,11 +1,236 @@
-from .initialize_database import supabase
+from .initialize_database import get_supabase
+from services.metrics import API_CALLS, ROWS_WRITTEN, stage
 from flask import jsonify
+from postgrest.exceptions import APIError
+from datetime import datetime, timedelta, timezone
+import atexit
+import os
+import threading
+import time
 
 """
 Upload, retrieve, insert user and conversation related data into supabase. 
 """
 
 
+## conversation turns are written behind the chat response: they are queued and flushed to supabase in bulk
+## once WRITE_BEHIND_BATCH_SIZE turns are waiting or WRITE_BEHIND_FLUSH_INTERVAL seconds have passed.
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 50))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 1.0))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 10000))
+## a row the database keeps rejecting (a missing user, a bad value) is dropped after this many attempts
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 3))
+
+
+class ConversationWriteBehind:
+    """
+    A write-behind queue for conversation_history rows.
+
+    Rows are accepted without blocking and inserted in bulk by a background thread. Rows that haven't
+    reached the database yet can be read back with pending_rows, so readers still see their own writes.
+
+    :param client: A supabase client, or anything with the same table(...).insert(...).execute() interface.
+        Defaults to the shared supabase client, looked up when the first rows are flushed.
+    :param batch_size: Flush as soon as this many rows are waiting.
+    :param flush_interval: Flush rows that have been waiting this many seconds.
+    :param max_pending: When the database is unreachable, keep at most this many rows and drop the oldest.
+    :param max_attempts: Drop a row once the database has rejected it this many times.
+    """
+
+    def __init__(self, client=None, batch_size=WRITE_BEHIND_BATCH_SIZE, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.in_flight = []
+        self.attempts = {}  # id(row) -> how many times the database rejected it
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Start the background flusher. Called lazily on the first write."""
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="conversation-write-behind", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, row):
+        self.start()
+        with self._condition:
+            self.pending.append(row)
+            if len(self.pending) > self.max_pending:
+                dropped = len(self.pending) - self.max_pending
+                for old in self.pending[:dropped]:
+                    self.attempts.pop(id(old), None)
+                del self.pending[:dropped]
+                print(f"Write-behind queue is full, dropped {dropped} conversation rows")
+            if len(self.pending) >= self.batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or len(self.pending) >= self.batch_size,
+                                         timeout=self.flush_interval)
+                stopped = self._stopped
+            flushed = self.flush()
+            if stopped:
+                return
+            if not flushed:
+                # the database is unhappy, don't hammer it with retries
+                time.sleep(self.flush_interval)
+
+    def flush(self):
+        """
+        Insert every pending row in bulk. When a batch fails, its rows are inserted one at a time, so a single
+        row the database rejects can't hold back everyone else's. Rows that still fail go back on the queue
+        for the next flush, and are dropped once the database has rejected them max_attempts times.
+
+        :return: False if any row failed to insert, True otherwise.
+        """
+        with self._flush_lock:
+            with self._condition:
+                if not self.pending:
+                    return True
+                self.in_flight, self.pending = self.pending, []
+            try:
+                client = self.client if self.client is not None else get_supabase()
+            except Exception as e:
+                print("An error occurred while flushing conversation data:", e)
+                with self._condition:
+                    self.pending = self.in_flight + self.pending
+                    self.in_flight = []
+                return False
+            rows = list(self.in_flight)
+            failed = []
+            errors = []
+            written = 0
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                if errors and not written and not isinstance(errors[-1], APIError):
+                    # the database is down, leave the rest for the next flush
+                    failed.extend(batch)
+                    errors.extend([errors[-1]] * len(batch))
+                    continue
+                try:
+                    self._insert(client, batch)
+                    written += len(batch)
+                    continue
+                except Exception as e:
+                    print("An error occurred while flushing conversation data, retrying row by row:", e)
+                for row in batch:
+                    if errors and not written and not isinstance(errors[-1], APIError):
+                        failed.append(row)
+                        errors.append(errors[-1])
+                        continue
+                    try:
+                        self._insert(client, [row])
+                        written += 1
+                    except Exception as e:
+                        failed.append(row)
+                        errors.append(e)
+            with self._condition:
+                self.in_flight = []
+                self.pending = self._retry(failed, errors, written) + self.pending
+            return not failed
+
+    def _insert(self, client, rows):
+        try:
+            with stage("supabase.write"):
+                client.table('conversation_history').insert(rows).execute()
+        except Exception:
+            API_CALLS.inc(api="supabase", status="error")
+            raise
+        API_CALLS.inc(api="supabase", status="ok")
+        ROWS_WRITTEN.inc(len(rows))
+        written = {id(row) for row in rows}
+        with self._condition:
+            # these rows are in the database now, readers will get them from there
+            self.in_flight = [row for row in self.in_flight if id(row) not in written]
+            for row in rows:
+                self.attempts.pop(id(row), None)
+
+    def _retry(self, rows, errors, written):
+        """The failed rows to queue again. Called with the condition held."""
+        retry = []
+        for row, error in zip(rows, errors):
+            # when nothing went through and the database didn't answer, it is down rather than rejecting the row
+            if not written and not isinstance(error, APIError):
+                retry.append(row)
+                continue
+            attempts = self.attempts.get(id(row), 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop(id(row), None)
+                print(f"Dropped a conversation row for r/{row.get('subreddit')} (user {row.get('google_id')!r}) "
+                      f"after {attempts} failed inserts:", error)
+                continue
+            self.attempts[id(row)] = attempts
+            retry.append(row)
+        return retry
+
+    def stop(self):
+        """Flush whatever is left and stop the background flusher."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def pending_rows(self, subreddit, user_id):
+        """The rows for a conversation that are queued but not yet in the database, oldest first."""
+        with self._condition:
+            rows = self.in_flight + self.pending
+        return [row for row in rows if row["subreddit"] == subreddit and row["google_id"] == user_id]
+
+    def discard(self, subreddit, user_id):
+        """Drop the queued rows of a conversation, e.g. because it is being deleted."""
+        # wait for an insert that is already running, so its rows can't land (or be queued again) after the
+        # caller's delete
+        with self._flush_lock, self._condition:
+            kept = []
+            for row in self.pending:
+                if row["subreddit"] == subreddit and row["google_id"] == user_id:
+                    self.attempts.pop(id(row), None)
+                else:
+                    kept.append(row)
+            self.pending = kept
+
+
+conversation_writer = ConversationWriteBehind()
+atexit.register(conversation_writer.stop)
+
+
+_last_timestamp = None
+_timestamp_lock = threading.Lock()
+
+
+def next_row_timestamp():
+    """
+    A created_at for a new row, set here rather than by the database: rows of one bulk insert would all
+    get the same now(), and their order would be lost. Strictly increasing within the process.
+    """
+    global _last_timestamp
+    with _timestamp_lock:
+        now = datetime.now(timezone.utc)
+        if _last_timestamp is not None and now <= _last_timestamp:
+            now = _last_timestamp + timedelta(microseconds=1)
+        _last_timestamp = now
+    return now.isoformat()
+
+
+def _timestamp(row):
+    """A row's created_at as a datetime. The database and this process may format it differently."""
+    value = row.get("created_at")
+    return datetime.fromisoformat(value) if value else datetime.min.replace(tzinfo=timezone.utc)
+
+
 def upsert_user_data(user_data):
     """
     Upserts user data into the Supabase table.
@@ -14,7 +239,7 @@ def upsert_user_data(user_data):
                       'google_id', 'email', 'name', 'picture'
     """
     try:
-        response = supabase.table('users').upsert(user_data).execute()
+        response = get_supabase().table('users').upsert(user_data).execute()
         return {
             "status_code": 200,
             "message": "Successfully Uploaded Data"
@@ -29,7 +254,7 @@ def upsert_user_data(user_data):
 ## conversation data is as such {User_prompt: chat_answer}
 def upload_conversation_data(subreddit, user_id, conversation_data):
     """
-    Uploads conversation history to the Supabase table.
+    Queues conversation history to be written to the Supabase table in the background.
 
     :param subreddit: The subreddit to associate with the conversation data.
     :param user_id: The user ID to associate with the conversation data.
@@ -37,15 +262,17 @@ def upload_conversation_data(subreddit, user_id, conversation_data):
     :return: A JSON response indicating the success or failure of the upload.
     """
     try:
-        response = supabase.table('conversation_history').insert({
+        row = {
             "subreddit": subreddit,
             "google_id": user_id,
-            "chat_history": conversation_data
-        }).execute()
+            "chat_history": conversation_data,
+            "created_at": next_row_timestamp(),
+        }
+        conversation_writer.enqueue(row)
         return {
             "status_code": 200,
-            "message": "Data uploaded successfully",
-            "data": response.data
+            "message": "Data queued for upload",
+            "data": [row]
         }
     except Exception as e:
         print("An error occurred:", e)
@@ -68,16 +295,105 @@ def fetch_conversation_data(subreddit, user_id):
     :return: A list containing the conversation history.
     """
     try:
-        response = supabase.table('conversation_history').select("chat_history").eq("subreddit", subreddit).eq("google_id", user_id).execute()
+        response = get_supabase().table('conversation_history').select("chat_history, created_at").eq("subreddit", subreddit).eq("google_id", user_id).order("created_at").execute()
+        rows = response.data or []
+        # Add the turns that are still waiting to be written, so users always see their latest messages.
+        # An insert that just finished can still be listed as pending, the timestamps tell the copies apart
+        written = {_timestamp(row) for row in rows}
+        rows += [row for row in conversation_writer.pending_rows(subreddit, user_id) if _timestamp(row) not in written]
         # Check if response data is empty
-        if not response.data:            
+        if not rows:
             return []  # Return empty list if no data
-        return response.data  # Return data directly as a list
+        return [{"chat_history": row["chat_history"]} for row in sorted(rows, key=_timestamp)]  # Return data directly as a list
     except Exception as e:
         print("An error occurred:", e)
         return []  # Ensure a list is returned in case of an error
 
 
+## fetches only the most recent turns of a conversation, newest rows are selected by the database
+## and then returned oldest first, like fetch_conversation_data.
+def fetch_recent_conversation_data(subreddit, user_id, limit, after=None):
+    """
+    Fetches the last ``limit`` turns of a conversation from the Supabase table.
+
+    :param subreddit: The subreddit to filter the conversation data.
+    :param user_id: The user ID to filter the conversation data.
+    :param limit: The maximum number of turns to return, or None for all of them.
+    :param after: Only return turns created after this timestamp, e.g. the ones a summary doesn't cover yet.
+    :return: A list of {"chat_history", "created_at"} rows, oldest first.
+    """
+    try:
+        query = (
+            get_supabase().table('conversation_history')
+            .select("chat_history, created_at")
+            .eq("subreddit", subreddit)
+            .eq("google_id", user_id)
+        )
+        if after:
+            query = query.gt("created_at", after)
+        query = query.order("created_at", desc=True)
+        if limit is not None:
+            query = query.limit(limit)
+        response = query.execute()
+        rows = {_timestamp(row): row for row in response.data or []}
+        # an insert that just finished can still be listed as pending, the timestamps tell the copies apart
+        for row in conversation_writer.pending_rows(subreddit, user_id):
+            if not after or _timestamp(row) > datetime.fromisoformat(after):
+                rows.setdefault(_timestamp(row), {"chat_history": row["chat_history"], "created_at": row["created_at"]})
+        ordered = [rows[key] for key in sorted(rows)]
+        if limit is None:
+            return ordered
+        return ordered[-limit:] if limit else []
+    except Exception as e:
+        print("An error occurred:", e)
+        return []
+
+
+## the rolling summary of a conversation's older turns, one row per (subreddit, google_id). The table
+## and the index behind the reads above are created by store/migrations/
+def fetch_conversation_summary(subreddit, user_id):
+    """
+    Fetches the summary of a conversation.
+
+    :return: {"summary", "summarized_until"}, where summarized_until is the created_at of the newest turn
+        the summary covers, or None if the conversation has no summary.
+    """
+    try:
+        response = (
+            get_supabase().table('conversation_summaries')
+            .select("summary, summarized_until")
+            .eq("subreddit", subreddit)
+            .eq("google_id", user_id)
+            .limit(1)
+            .execute()
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        print("An error occurred:", e)
+        return None
+
+
+def upsert_conversation_summary(subreddit, user_id, summary, summarized_until):
+    """
+    Saves the summary of a conversation, replacing the previous one.
+
+    :param summarized_until: The created_at of the newest turn the summary covers.
+    """
+    try:
+        get_supabase().table('conversation_summaries').upsert(
+            {
+                "subreddit": subreddit,
+                "google_id": user_id,
+                "summary": summary,
+                "summarized_until": summarized_until,
+                "updated_at": next_row_timestamp(),
+            },
+            on_conflict="subreddit,google_id",
+        ).execute()
+    except Exception as e:
+        print("An error occurred:", e)
+
+
 def delete_conversation_data(subreddit, user_id):
     """
     Deletes all conversation history associated with a subreddit and user ID from the Supabase table.
@@ -87,7 +403,9 @@ def delete_conversation_data(subreddit, user_id):
     :return: A JSON response indicating the success or failure of the deletion.
     """
     try:
-        response = supabase.table('conversation_history').delete().eq("subreddit", subreddit).eq("google_id", user_id).execute()
+        conversation_writer.discard(subreddit, user_id)
+        response = get_supabase().table('conversation_history').delete().eq("subreddit", subreddit).eq("google_id", user_id).execute()
+        get_supabase().table('conversation_summaries').delete().eq("subreddit", subreddit).eq("google_id", user_id).execute()
         return {
             "status_code": 200,
             "message": "Data deleted successfully",
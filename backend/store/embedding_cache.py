@@ -0,0 +1,112 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Optional
+
+from .cache import LRUCache
+
+"""
+A content-addressed cache for embeddings, so the same text is never sent to the embeddings API twice.
+
+Entries are keyed by hash(model, normalized text). Hot entries live in an in-process LRU, and everything
+is persisted to a local SQLite file so the cache survives restarts and is shared by every worker on the host.
+"""
+
+
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.abspath(os.path.dirname(os.path.dirname(__file__))), ".cache", "embeddings.sqlite3"),
+)
+EMBEDDING_CACHE_LRU_SIZE = int(os.getenv("EMBEDDING_CACHE_LRU_SIZE", 10000))
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different copies of a text share a cache entry."""
+    return " ".join(str(text).split())
+
+
+def cache_key(model: str, text: str) -> str:
+    """:param model: The embedding provider's key, e.g. "openai:text-embedding-ada-002"."""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-level embedding cache: an in-process LRU in front of a SQLite table.
+
+    :param path: The SQLite file to persist to, or None to keep the cache in memory only.
+    :param lru_size: How many embeddings to keep in the in-process LRU.
+    """
+
+    def __init__(self, path: Optional[str] = EMBEDDING_CACHE_PATH, lru_size: int = EMBEDDING_CACHE_LRU_SIZE):
+        self.lru = LRUCache(maxsize=lru_size)
+        self.path = path
+        self._local = threading.local()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with self._connection() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads, so each thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def reset(self) -> None:
+        """Drop the per-thread connections, e.g. in a forked worker that inherited its parent's."""
+        self._local = threading.local()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached embeddings for whichever of ``keys`` are present."""
+        found = {}
+        missing = []
+        for key in keys:
+            vector = self.lru.get(key)
+            if vector is None:
+                missing.append(key)
+            else:
+                found[key] = vector
+
+        if missing and self.path:
+            try:
+                conn = self._connection()
+                # stay well below sqlite's bound parameter limit
+                for i in range(0, len(missing), 500):
+                    batch = missing[i:i + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = array("f", blob).tolist()
+                        self.lru.set(key, vector)
+                        found[key] = vector
+            except sqlite3.Error as e:
+                print(f"Embedding cache read failed: {str(e)}")
+        return found
+
+    def set_many(self, entries: Dict[str, List[float]]) -> None:
+        """Store embeddings in both cache levels."""
+        for key, vector in entries.items():
+            self.lru.set(key, vector)
+
+        if entries and self.path:
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                        [(key, array("f", vector).tobytes()) for key, vector in entries.items()],
+                    )
+            except sqlite3.Error as e:
+                print(f"Embedding cache write failed: {str(e)}")
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,233 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from typing import List
+
+"""
+Pluggable embedding providers.
+
+Set EMBEDDING_PROVIDER to pick one:
+- "openai" (default): text-embedding-ada-002 over the OpenAI API.
+- "local": all-MiniLM-L6-v2 on the CPU through onnxruntime, no network round-trip on the hot path.
+- "hashing": a deterministic feature-hashing embedder with no dependencies, for offline tests and benchmarks.
+
+Every provider has a ``key`` naming its model, and a dimension. Collections and cache entries are tagged
+with them, so vectors from different models are never mixed.
+"""
+
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+
+
+class EmbeddingProvider:
+    """
+    Turns batches of texts into vectors.
+
+    :param name: Short name of the provider, e.g. "openai".
+    :param model: The model the provider runs.
+    :param dimension: Length of the vectors it returns.
+    :param max_concurrency: How many batches may be embedded at the same time.
+    """
+
+    name = "base"
+    ## the most tokens (counted like chunking counts them) of a chunk the model reads, None if it reads more
+    ## than CHUNK_TOKEN_BUDGET anyway
+    max_chunk_tokens = None
+
+    def __init__(self, model: str, dimension: int, max_concurrency: int = 1):
+        self.model = model
+        self.dimension = dimension
+        self.max_concurrency = max_concurrency
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}:{self.model}"
+
+    @property
+    def tag(self) -> str:
+        """A short identifier that is safe to use in collection names."""
+        digest = hashlib.sha1(self.key.encode("utf-8")).hexdigest()[:6]
+        return f"{self.name}{self.dimension}_{digest}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, model: str = "text-embedding-ada-002", dimension: int = 1536,
+                 max_concurrency: int = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8))):
+        super().__init__(model, dimension, max_concurrency)
+
+    @property
+    def client(self):
+        # the shared OpenAI client from the service registry, built on first use
+        from services.registry import get_openai
+        return get_openai()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        return [res.embedding for res in sorted(response.data, key=lambda res: res.index)]
+
+
+## where chromadb's embedding function keeps its download of the model, so an existing one is reused
+LOCAL_EMBEDDING_MODEL_DIR = os.getenv(
+    "LOCAL_EMBEDDING_MODEL_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "chroma", "onnx_models", "all-MiniLM-L6-v2", "onnx"),
+)
+
+
+class MiniLM:
+    """
+    all-MiniLM-L6-v2 run with onnxruntime directly, from the ONNX export that chromadb's
+    ONNXMiniLM_L6_V2 embedding function downloads. It returns the same vectors as that function, but pads
+    each batch only to its longest text (padding is masked out anyway) and runs on ``threads`` threads.
+
+    :param model_dir: The directory holding model.onnx and tokenizer.json.
+    """
+
+    MODEL_NAME = "all-MiniLM-L6-v2"
+    ## sentence-transformers, and chromadb after it, truncate the model's input at 256 word pieces
+    MAX_TOKENS = 256
+
+    def __init__(self, threads: int, model_dir: str = LOCAL_EMBEDDING_MODEL_DIR):
+        self.threads = threads
+        self.model_dir = model_dir
+        self.tokenizer = None
+        self.session = None
+        self._lock = threading.Lock()
+
+    def _download(self):
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+        stock = ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+        if os.path.abspath(self.model_dir) != os.path.abspath(os.path.join(stock.DOWNLOAD_PATH, stock.EXTRACTED_FOLDER_NAME)):
+            raise FileNotFoundError(f"{self.MODEL_NAME} isn't in {self.model_dir}, it needs model.onnx and tokenizer.json")
+        # the embedding function downloads and verifies the export on its first call
+        stock(["download"])
+
+    def load(self):
+        """Load the tokenizer and the model, downloading them on first use (about 80 MB)."""
+        with self._lock:
+            if self.session is not None:
+                return
+            if not all(os.path.exists(os.path.join(self.model_dir, name)) for name in ("model.onnx", "tokenizer.json")):
+                self._download()
+            import onnxruntime
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=self.MAX_TOKENS)
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+            options = onnxruntime.SessionOptions()
+            options.log_severity_level = 3
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+            self.session = onnxruntime.InferenceSession(
+                os.path.join(self.model_dir, "model.onnx"), providers=["CPUExecutionProvider"], sess_options=options,
+            )
+            self.tokenizer = tokenizer
+
+    def encode(self, texts: List[str], batch_size: int = 32):
+        """Embed texts into normalized float32 vectors, as a (len(texts), 384) numpy array."""
+        import numpy as np
+
+        self.load()
+        batches = []
+        for i in range(0, len(texts), batch_size):
+            encoded = self.tokenizer.encode_batch(texts[i:i + batch_size])
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            hidden = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask,
+                                             "token_type_ids": np.zeros_like(input_ids)})[0]
+            # mean of the token vectors, leaving out the padding, then normalized like the original
+            mask = attention_mask[:, :, None]
+            embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            batches.append((embeddings / np.where(norms == 0, 1e-12, norms)).astype(np.float32))
+        return np.concatenate(batches) if batches else np.zeros((0, 384), dtype=np.float32)
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Runs all-MiniLM-L6-v2 on the CPU with onnxruntime (see MiniLM). The model is downloaded to
+    ~/.cache/chroma on first use.
+
+    :param threads: How many CPU threads the model may use.
+    """
+
+    name = "local"
+    ## the model reads 256 word pieces of a chunk. Its WordPiece vocabulary splits English text into more
+    ## tokens than cl100k does, 200 cl100k tokens leaves room for that
+    max_chunk_tokens = 200
+
+    def __init__(self, threads: int = int(os.getenv("LOCAL_EMBEDDING_THREADS", 4)),
+                 batch_size: int = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 64))):
+        self._model = MiniLM(threads)
+        self.batch_size = batch_size
+        # the model already uses all of its threads for one batch, running batches side by side doesn't help
+        super().__init__(self._model.MODEL_NAME, 384, max_concurrency=1)
+        self._lock = threading.Lock()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            vectors = self._model.encode(texts, batch_size=self.batch_size)
+        return vectors.tolist()
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Deterministic embeddings from hashed word unigrams and bigrams. Texts that share words get similar
+    vectors, which is enough to exercise retrieval end to end without any model or network access.
+    """
+
+    name = "hashing"
+    _token_pattern = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, dimension: int = int(os.getenv("HASHING_EMBEDDING_DIMENSION", 256))):
+        super().__init__(f"hashing-{dimension}", dimension, max_concurrency=1)
+
+    def _embed_one(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        tokens = self._token_pattern.findall(text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dimension] += 1.0 if (value >> 63) & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed_one(text) for text in texts]
+
+
+_PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+}
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_embedding_provider() -> EmbeddingProvider:
+    """Return the configured embedding provider, building it on first use."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                if EMBEDDING_PROVIDER not in _PROVIDERS:
+                    raise ValueError(f"Unknown EMBEDDING_PROVIDER {EMBEDDING_PROVIDER!r}, expected one of {sorted(_PROVIDERS)}")
+                _provider = _PROVIDERS[EMBEDDING_PROVIDER]()
+    return _provider
+
+
+def set_embedding_provider(provider: EmbeddingProvider) -> None:
+    """Replace the process-wide embedding provider, e.g. with a fake one in tests or benchmarks."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
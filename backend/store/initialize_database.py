@@ -1,27 +1,33 @@
-from supabase import create_client, Client
 from dotenv import load_dotenv
 import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from services.registry import get_supabase
 
 
 """
 This initializes supabase (our giant storage unit)
+
+The client is built by the service registry on first use, see create_supabase_client.
 """
 
 
 load_dotenv()  # Load environment variables from .env file
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-print(SUPABASE_URL,"here")
-
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase URL and Key must be set")
 
+def create_supabase_client():
+    from supabase import create_client
 
+    SUPABASE_URL = os.getenv("SUPABASE_URL")
+    SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Supabase URL and Key must be set")
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-print("DEBUG: SUPABASE_URL is:", SUPABASE_URL)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+def __getattr__(name):
+    # `from store.initialize_database import supabase` still works, it just builds the client on first use
+    if name == "supabase":
+        return get_supabase()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,19 @@
+-- Tables and indexes behind the windowed conversation memory (services/memory.py).
+-- Run once against the Supabase database, e.g. in the SQL editor or with `supabase db push`.
+-- Every statement is idempotent, so running it again is harmless.
+
+-- Memory loads the newest turns of one conversation, and the ones after a summary, ordered by
+-- created_at. Without this index each load scans all of the user's rows.
+create index if not exists conversation_history_conversation_created_at_idx
+    on conversation_history (subreddit, google_id, created_at);
+
+-- The rolling summary of a conversation's older turns, one row per conversation.
+-- summarized_until is the created_at of the newest turn the summary covers.
+create table if not exists conversation_summaries (
+    subreddit text not null,
+    google_id text not null,
+    summary text not null,
+    summarized_until timestamptz,
+    updated_at timestamptz not null default now(),
+    primary key (subreddit, google_id)
+);
@@ -0,0 +1,716 @@
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+"""
+A compact, in-process vector store with the parts of Chroma's client and collection API that the backend
+uses, selected with VECTOR_BACKEND=numpy (see store/chroma_db.py).
+
+Each collection keeps its vectors in one contiguous NumPy array, as float16, or as int8 with a scale per
+row, instead of float32 vectors with per-record overhead and an HNSW graph. A 1536 dimension ada embedding
+takes 3 KB as float16 and 1.5 KB as int8, against 6 KB before the graph. Search is exact by default: one
+matrix product over the (filtered) rows, which at the size of a subreddit's partition is faster than
+walking a graph. Collections past NUMPY_STORE_IVF_THRESHOLD vectors switch to an inverted file index
+and only search the clusters closest to the query.
+
+With NUMPY_STORE_DIRECTORY set, collections are saved there and their vectors are memory-mapped, so the
+operating system pages them in and out instead of the process holding all of them. Records are appended
+to a log as they are written, and only folded into a snapshot once the log has outgrown it. The directory
+is locked by the process that opens it, since nothing else coordinates writes to it.
+"""
+
+
+NUMPY_STORE_DIRECTORY = os.getenv("NUMPY_STORE_DIRECTORY")
+## "int8" (a quarter of the memory of float32, and the fastest to search), "float16" (half, and more
+## precise, but NumPy is slow to convert it back while searching) or "float32"
+NUMPY_STORE_DTYPE = os.getenv("NUMPY_STORE_DTYPE", "int8")
+## collections with at least this many vectors are searched through an IVF index instead of exhaustively
+NUMPY_STORE_IVF_THRESHOLD = int(os.getenv("NUMPY_STORE_IVF_THRESHOLD", 10000))
+## how many of the IVF clusters closest to the query are searched
+NUMPY_STORE_IVF_PROBES = int(os.getenv("NUMPY_STORE_IVF_PROBES", 16))
+## how long to wait for another process to let go of the directory, e.g. an old worker during a reload
+NUMPY_STORE_LOCK_TIMEOUT = float(os.getenv("NUMPY_STORE_LOCK_TIMEOUT", 30))
+
+DTYPES = ("float32", "float16", "int8")
+SPACES = ("cosine", "ip", "l2")
+## rows are converted to float32 this many at a time while scoring, small enough to stay in the CPU cache
+SCORE_BLOCK_ROWS = 256
+KMEANS_ITERATIONS = 10
+## the record log is compacted into the snapshot once it is bigger than the snapshot and at least this big
+LOG_COMPACT_MIN_BYTES = 1 << 20
+
+_COLLECTION_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]{1,61}[a-zA-Z0-9]$")
+
+_OPERATORS = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value is not None and value > target,
+    "$gte": lambda value, target: value is not None and value >= target,
+    "$lt": lambda value, target: value is not None and value < target,
+    "$lte": lambda value, target: value is not None and value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target,
+}
+
+
+def matches(metadata: Dict, where: Optional[Dict]) -> bool:
+    """Whether a record's metadata satisfies a Chroma-style where filter ($and, $or, $eq, $in, $gt, ...)."""
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, target in condition.items():
+                if operator not in _OPERATORS:
+                    raise ValueError(f"Unsupported where operator {operator!r}")
+                if not _OPERATORS[operator](value, target):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class NumpyCollection:
+    """
+    One collection: ids, documents and metadatas in Python lists, vectors in a single NumPy array.
+
+    The "hnsw:space" metadata key picks the distance, like it does in Chroma: "cosine" (1 - cosine
+    similarity), "ip" (1 - dot product) or "l2" (squared euclidean). Cosine collections store their
+    vectors normalized, so the embeddings they return are unit length.
+
+    :param path: The directory the collection is saved in, or None to keep it in memory only.
+    """
+
+    def __init__(self, name: str, metadata: Dict = None, dtype: str = NUMPY_STORE_DTYPE, path: str = None,
+                 ivf_threshold: int = NUMPY_STORE_IVF_THRESHOLD, ivf_probes: int = NUMPY_STORE_IVF_PROBES):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+        self.name = name
+        self.metadata = dict(metadata or {})
+        self.space = self.metadata.get("hnsw:space", "l2")
+        if self.space not in SPACES:
+            raise ValueError(f"Unknown space {self.space!r}, expected one of {', '.join(SPACES)}")
+        self.dtype = dtype
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.ivf_probes = ivf_probes
+
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.positions = {}  # id -> row
+        self.dimension = None
+        self._size = 0
+        self._vectors = None  # (capacity, dimension), in self.dtype
+        self._scales = None  # (capacity,) float32, int8 only: row = vectors[row] * scales[row]
+        self._sq_norms = None  # (capacity,) float32, l2 only
+        self._centroids = None  # IVF cluster centres, (clusters, dimension) float32
+        self._clusters = None  # IVF cluster of each row, (capacity,) int32
+        self._indexed_size = 0  # how many rows the IVF index was trained on
+        self._generation = 0  # of the snapshot, each has a log of the writes made since
+        self._snapshot_bytes = 0
+        self._log_bytes = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"NumpyCollection(name={self.name!r}, count={self._size}, dtype={self.dtype!r})"
+
+    # storage
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the vectors (and their scales and norms), not counting unused capacity."""
+        if self._vectors is None:
+            return 0
+        per_row = self._vectors.itemsize * self.dimension
+        per_row += 4 if self._scales is not None else 0
+        per_row += 4 if self._sq_norms is not None else 0
+        return per_row * self._size
+
+    def _array_path(self, name):
+        return os.path.join(self.path, f"{name}.npy")
+
+    def _new_array(self, name, shape, dtype):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        os.makedirs(self.path, exist_ok=True)
+        return np.lib.format.open_memmap(self._array_path(name) + ".tmp", mode="w+", dtype=dtype, shape=shape)
+
+    def _grow(self, capacity):
+        """Reallocate the arrays to hold ``capacity`` rows, keeping the rows stored so far."""
+        arrays = {"vectors": (self._vectors, (capacity, self.dimension), self._storage_dtype())}
+        if self.dtype == "int8":
+            arrays["scales"] = (self._scales, (capacity,), np.float32)
+        if self.space == "l2":
+            arrays["sq_norms"] = (self._sq_norms, (capacity,), np.float32)
+
+        grown = {}
+        for name, (old, shape, dtype) in arrays.items():
+            new = self._new_array(name, shape, dtype)
+            if old is not None:
+                new[:self._size] = old[:self._size]
+            if self.path is not None:
+                new.flush()
+                os.replace(self._array_path(name) + ".tmp", self._array_path(name))
+            grown[name] = new
+        self._vectors = grown["vectors"]
+        self._scales = grown.get("scales")
+        self._sq_norms = grown.get("sq_norms")
+        if self._clusters is not None:
+            # the IVF assignment is rebuilt on load, so it always stays in memory
+            clusters = np.zeros(capacity, dtype=np.int32)
+            clusters[:self._size] = self._clusters[:self._size]
+            self._clusters = clusters
+
+    def _storage_dtype(self):
+        return {"float32": np.float32, "float16": np.float16, "int8": np.int8}[self.dtype]
+
+    def _prepare(self, embeddings) -> np.ndarray:
+        """Validate a batch of embeddings and turn it into float32 rows, normalized for cosine."""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError("Expected a list of embeddings")
+        if self.dimension is None:
+            self.dimension = matrix.shape[1]
+        if matrix.shape[1] != self.dimension:
+            raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match collection dimensionality {self.dimension}")
+        if self.space == "cosine":
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1, norms)
+        return matrix
+
+    def _write_rows(self, rows: np.ndarray, matrix: np.ndarray) -> None:
+        """Quantize ``matrix`` into the given rows."""
+        if self.dtype == "int8":
+            scales = np.abs(matrix).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._vectors[rows] = np.round(matrix / scales[:, None]).astype(np.int8)
+            self._scales[rows] = scales
+        else:
+            self._vectors[rows] = matrix
+        if self._sq_norms is not None:
+            self._sq_norms[rows] = np.einsum("ij,ij->i", matrix, matrix)
+        if self._clusters is not None:
+            self._clusters[rows] = self._nearest_clusters(matrix)
+
+    def _read_rows(self, rows) -> np.ndarray:
+        """Dequantize rows back into float32."""
+        matrix = self._vectors[rows].astype(np.float32)
+        if self._scales is not None:
+            matrix *= self._scales[rows][:, None]
+        return matrix
+
+    # writes
+
+    def _check_lengths(self, ids, **columns):
+        for column, values in columns.items():
+            if values is not None and len(values) != len(ids):
+                raise ValueError(f"Got {len(ids)} ids but {len(values)} {column}")
+
+    def _append(self, ids, matrix, metadatas, documents):
+        if self._vectors is None or self._size + len(ids) > len(self._vectors):
+            self._grow(max(16, 2 * (self._size + len(ids))))
+        rows = np.arange(self._size, self._size + len(ids))
+        self._write_rows(rows, matrix)
+        for offset, id in enumerate(ids):
+            self.positions[id] = self._size + offset
+            self.ids.append(id)
+            self.documents.append(documents[offset] if documents is not None else None)
+            self.metadatas.append(dict(metadatas[offset]) if metadatas is not None and metadatas[offset] else None)
+        self._size += len(ids)
+
+    def add(self, ids: List[str], embeddings=None, metadatas: List[Dict] = None, documents: List[str] = None) -> None:
+        """Add records. Like Chroma, ids that are already stored are skipped."""
+        if embeddings is None:
+            raise ValueError("The numpy store does not embed documents itself, pass embeddings")
+        self._check_lengths(ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        with self._lock:
+            new = []
+            seen = set()
+            for i, id in enumerate(ids):
+                if id not in self.positions and id not in seen:
+                    new.append(i)
+                    seen.add(id)
+            if not new:
+                return
+            matrix = self._prepare(embeddings)[new]
+            self._append(
+                [ids[i] for i in new],
+                matrix,
+                [metadatas[i] for i in new] if metadatas is not None else None,
+                [documents[i] for i in new] if documents is not None else None,
+            )
+            self._log(self._add_entry([ids[i] for i in new]))
+
+    def update(self, ids: List[str], embeddings=None, metadatas: List[Dict] = None, documents: List[str] = None) -> None:
+        """Update stored records. New metadata is merged into the old, ids that aren't stored are skipped."""
+        self._check_lengths(ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        with self._lock:
+            self._log(self._update_entry(self._update(ids, embeddings, metadatas, documents), documents is not None))
+
+    def _update(self, ids, embeddings, metadatas, documents):
+        """:return: The ids that were updated."""
+        found = [i for i, id in enumerate(ids) if id in self.positions]
+        if not found:
+            return []
+        rows = np.array([self.positions[ids[i]] for i in found])
+        if embeddings is not None:
+            self._write_rows(rows, self._prepare(embeddings)[found])
+        for i, row in zip(found, rows):
+            if metadatas is not None and metadatas[i] is not None:
+                merged = {**(self.metadatas[row] or {}), **metadatas[i]}
+                self.metadatas[row] = {key: value for key, value in merged.items() if value is not None}
+            if documents is not None:
+                self.documents[row] = documents[i]
+        return [ids[i] for i in found]
+
+    def upsert(self, ids: List[str], embeddings=None, metadatas: List[Dict] = None, documents: List[str] = None) -> None:
+        """Update the records that are stored and add the rest."""
+        if embeddings is None:
+            raise ValueError("The numpy store does not embed documents itself, pass embeddings")
+        self._check_lengths(ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        with self._lock:
+            matrix = self._prepare(embeddings)
+            existing = [i for i, id in enumerate(ids) if id in self.positions]
+            updated = []
+            if existing:
+                updated = self._update(
+                    [ids[i] for i in existing],
+                    matrix[existing],
+                    [metadatas[i] for i in existing] if metadatas is not None else None,
+                    [documents[i] for i in existing] if documents is not None else None,
+                )
+            # later copies of the same id win, like separate upserts would
+            last = {id: i for i, id in enumerate(ids) if id not in self.positions}
+            new = sorted(last.values())
+            if new:
+                self._append(
+                    [ids[i] for i in new],
+                    matrix[new],
+                    [metadatas[i] for i in new] if metadatas is not None else None,
+                    [documents[i] for i in new] if documents is not None else None,
+                )
+            self._log(self._update_entry(updated, documents is not None), self._add_entry([ids[i] for i in new]))
+
+    def delete(self, ids: List[str] = None, where: Dict = None) -> None:
+        """Delete records by id and/or where filter. The remaining rows are compacted."""
+        with self._lock:
+            doomed = set(self._rows(ids, where))
+            if not doomed:
+                return
+            doomed_ids = [self.ids[row] for row in sorted(doomed)]
+            keep = np.array([row for row in range(self._size) if row not in doomed], dtype=np.int64)
+            arrays = [self._vectors, self._scales, self._sq_norms, self._clusters]
+            for array in arrays:
+                if array is not None:
+                    array[:len(keep)] = array[keep]
+            self._delete_records(doomed)
+            self._log({"op": "delete", "ids": doomed_ids})
+
+    def _delete_records(self, doomed):
+        """Drop the given rows from the records, the rows after them move up."""
+        keep = [row for row in range(self._size) if row not in doomed]
+        self.ids = [self.ids[row] for row in keep]
+        self.documents = [self.documents[row] for row in keep]
+        self.metadatas = [self.metadatas[row] for row in keep]
+        self.positions = {id: row for row, id in enumerate(self.ids)}
+        self._size = len(keep)
+
+    # reads
+
+    def count(self) -> int:
+        return self._size
+
+    def _rows(self, ids=None, where=None) -> List[int]:
+        """The rows matching the given ids (in that order) and where filter, all rows when both are None."""
+        if ids is not None:
+            rows = [self.positions[id] for id in ids if id in self.positions]
+        else:
+            rows = range(self._size)
+        if where:
+            rows = [row for row in rows if matches(self.metadatas[row], where)]
+        return list(rows)
+
+    def _result(self, rows, include, embeddings=None):
+        result = {"ids": [self.ids[row] for row in rows], "embeddings": None, "documents": None, "metadatas": None,
+                  "included": list(include)}
+        if "embeddings" in include:
+            result["embeddings"] = embeddings if embeddings is not None else self._read_rows(np.array(rows, dtype=np.int64))
+        if "documents" in include:
+            result["documents"] = [self.documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[row] for row in rows]
+        return result
+
+    def get(self, ids: List[str] = None, where: Dict = None, limit: int = None, offset: int = None,
+            include=("metadatas", "documents"), **kwargs) -> Dict:
+        with self._lock:
+            rows = self._rows(ids, where)
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+            return self._result(rows, include)
+
+    def peek(self, limit: int = 10) -> Dict:
+        return self.get(limit=limit, include=["embeddings", "documents", "metadatas"])
+
+    def _distances(self, queries: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """Distances from each query to each of the given rows (all rows when None), (queries, rows)."""
+        n_rows = self._size if rows is None else len(rows)
+        distances = np.empty((len(queries), n_rows), dtype=np.float32)
+        query_sq_norms = np.einsum("ij,ij->i", queries, queries) if self.space == "l2" else None
+        for start in range(0, n_rows, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, n_rows)
+            # slicing is a view, indexing with an array of rows would copy them first
+            block = slice(start, end) if rows is None else rows[start:end]
+            dots = queries @ self._read_rows(block).T
+            if self.space == "l2":
+                distances[:, start:end] = query_sq_norms[:, None] + self._sq_norms[block][None, :] - 2 * dots
+            else:
+                distances[:, start:end] = 1 - dots
+        return distances
+
+    def query(self, query_embeddings=None, n_results: int = 10, where: Dict = None,
+              include=("metadatas", "documents", "distances"), **kwargs) -> Dict:
+        """Find the n_results closest records to each query embedding, among those matching ``where``."""
+        if query_embeddings is None:
+            raise ValueError("The numpy store does not embed queries itself, pass query_embeddings")
+        with self._lock:
+            result = {"ids": [], "embeddings": [] if "embeddings" in include else None,
+                      "documents": [] if "documents" in include else None,
+                      "metadatas": [] if "metadatas" in include else None,
+                      "distances": [] if "distances" in include else None, "included": list(include)}
+            if self._size == 0:
+                for _ in query_embeddings:
+                    for key in ("ids", "embeddings", "documents", "metadatas", "distances"):
+                        if result[key] is not None:
+                            result[key].append([])
+                return result
+
+            queries = self._prepare(query_embeddings)
+            candidates = np.array(self._rows(where=where), dtype=np.int64) if where else None
+            if self._use_ivf():
+                if candidates is None:
+                    candidates = np.arange(self._size)
+                per_query = [self._probe(query, candidates, n_results) for query in queries]
+                all_distances = [self._distances(query[None, :], rows)[0] for query, rows in zip(queries, per_query)]
+            else:
+                # every query is scored against the same rows in one matrix product per block
+                all_distances = list(self._distances(queries, candidates))
+                per_query = [np.arange(self._size) if candidates is None else candidates] * len(queries)
+
+            for rows, distances in zip(per_query, all_distances):
+                k = min(n_results, len(rows))
+                best = np.argpartition(distances, k - 1)[:k] if 0 < k < len(rows) else np.arange(len(rows))
+                best = best[np.argsort(distances[best], kind="stable")]
+                best_rows = rows[best].tolist()
+                part = self._result(best_rows, include)
+                for key in ("ids", "embeddings", "documents", "metadatas"):
+                    if result[key] is not None:
+                        result[key].append(part[key])
+                if result["distances"] is not None:
+                    result["distances"].append(distances[best].astype(float).tolist())
+            return result
+
+    # IVF
+
+    def _use_ivf(self) -> bool:
+        if self._size < self.ivf_threshold:
+            return False
+        # (re)train when the collection has doubled since the index was built
+        if self._centroids is None or self._size > 2 * self._indexed_size:
+            self._train_ivf()
+        return True
+
+    def _nearest_clusters(self, matrix: np.ndarray) -> np.ndarray:
+        if self.space == "l2":
+            centroid_sq_norms = np.einsum("ij,ij->i", self._centroids, self._centroids)
+            return np.argmin(centroid_sq_norms[None, :] - 2 * matrix @ self._centroids.T, axis=1).astype(np.int32)
+        return np.argmax(matrix @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _train_ivf(self, seed: int = 0) -> None:
+        """k-means on a sample of the rows, about sqrt(n) clusters, then assign every row to one."""
+        n_clusters = max(1, int(math.sqrt(self._size)))
+        rng = np.random.default_rng(seed)
+        sample_size = min(self._size, 64 * n_clusters)
+        sample = self._read_rows(np.sort(rng.choice(self._size, sample_size, replace=False)))
+        self._centroids = sample[rng.choice(sample_size, n_clusters, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = self._nearest_clusters(sample)
+            for cluster in range(n_clusters):
+                members = sample[assignment == cluster]
+                if len(members):
+                    self._centroids[cluster] = members.mean(axis=0)
+            if self.space == "cosine":
+                norms = np.linalg.norm(self._centroids, axis=1, keepdims=True)
+                self._centroids /= np.where(norms == 0, 1, norms)
+
+        if self._clusters is None or len(self._clusters) < len(self._vectors):
+            self._clusters = np.zeros(len(self._vectors), dtype=np.int32)
+        for start in range(0, self._size, SCORE_BLOCK_ROWS):
+            block = slice(start, min(start + SCORE_BLOCK_ROWS, self._size))
+            self._clusters[block] = self._nearest_clusters(self._read_rows(block))
+        self._indexed_size = self._size
+
+    def _probe(self, query: np.ndarray, candidates: np.ndarray, n_results: int) -> np.ndarray:
+        """The candidate rows in the clusters nearest to the query, or all of them if that's too few."""
+        probes = self._nearest_probes(query)
+        rows = candidates[np.isin(self._clusters[candidates], probes)]
+        return rows if len(rows) >= n_results else candidates
+
+    def _nearest_probes(self, query: np.ndarray) -> np.ndarray:
+        n_probes = min(self.ivf_probes, len(self._centroids))
+        if self.space == "l2":
+            scores = -(np.einsum("ij,ij->i", self._centroids, self._centroids) - 2 * self._centroids @ query)
+        else:
+            scores = self._centroids @ query
+        return np.argpartition(-scores, n_probes - 1)[:n_probes]
+
+    # persistence
+
+    def _records_path(self):
+        return os.path.join(self.path, "records.json")
+
+    def _log_path(self, generation=None):
+        return os.path.join(self.path, f"records.{self._generation if generation is None else generation}.log")
+
+    def _flush(self):
+        for array in (self._vectors, self._scales, self._sq_norms):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def _log(self, *entries: Optional[Dict]) -> None:
+        """
+        Append a write's entries to the record log, then fold the log into a new snapshot if it has outgrown
+        the last one. A snapshot taken halfway through a write would hold rows the rest of it logs again.
+        """
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries if entry)
+        if self.path is None or not lines:
+            return
+        self._flush()
+        with open(self._log_path(), "a") as f:
+            f.write(lines)
+        self._log_bytes += len(lines)
+        if self._log_bytes > max(LOG_COMPACT_MIN_BYTES, self._snapshot_bytes):
+            self._save()
+
+    def _add_entry(self, ids: List[str]) -> Optional[Dict]:
+        if not ids:
+            return None
+        rows = [self.positions[id] for id in ids]
+        return {"op": "add", "dimension": self.dimension, "ids": ids,
+                "documents": [self.documents[row] for row in rows],
+                "metadatas": [self.metadatas[row] for row in rows]}
+
+    def _update_entry(self, ids: List[str], documents: bool) -> Optional[Dict]:
+        if not ids:
+            return None
+        rows = [self.positions[id] for id in ids]
+        entry = {"op": "update", "ids": ids, "metadatas": [self.metadatas[row] for row in rows]}
+        if documents:
+            entry["documents"] = [self.documents[row] for row in rows]
+        return entry
+
+    def _replay(self, entry: Dict) -> None:
+        """Apply a write from the record log to the records, the vectors on disk already have it."""
+        if entry["op"] == "add":
+            self.dimension = entry["dimension"]
+            for id, document, metadata in zip(entry["ids"], entry["documents"], entry["metadatas"]):
+                self.positions[id] = len(self.ids)
+                self.ids.append(id)
+                self.documents.append(document)
+                self.metadatas.append(metadata)
+            self._size = len(self.ids)
+        elif entry["op"] == "update":
+            rows = [self.positions[id] for id in entry["ids"]]
+            for row, metadata in zip(rows, entry["metadatas"]):
+                self.metadatas[row] = metadata
+            for row, document in zip(rows, entry.get("documents") or []):
+                self.documents[row] = document
+        elif entry["op"] == "delete":
+            self._delete_records({self.positions[id] for id in entry["ids"]})
+
+    def _save(self) -> None:
+        """
+        Write a snapshot of the records next to the memory-mapped vectors, and start a new record log.
+        Only done when the collection is created and when the log is compacted, other writes go to the log.
+        """
+        if self.path is None:
+            return
+        self._flush()
+        state = {
+            "name": self.name,
+            "metadata": self.metadata,
+            "dtype": self.dtype,
+            "dimension": self.dimension,
+            "generation": self._generation + 1,
+            "ids": self.ids,
+            "documents": self.documents,
+            "metadatas": self.metadatas,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._records_path() + ".tmp", "w") as f:
+            json.dump(state, f)
+            self._snapshot_bytes = f.tell()
+        # the new snapshot points at a log of its own, so the old one only goes once it's been replaced
+        os.replace(self._records_path() + ".tmp", self._records_path())
+        old_log = self._log_path()
+        self._generation += 1
+        self._log_bytes = 0
+        if os.path.exists(old_log):
+            os.remove(old_log)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "NumpyCollection":
+        """Open a collection saved in ``path``, its vectors are memory-mapped rather than read."""
+        with open(os.path.join(path, "records.json")) as f:
+            state = json.load(f)
+            snapshot_bytes = f.tell()
+        collection = cls(state["name"], state["metadata"], dtype=state["dtype"], path=path, **kwargs)
+        collection.dimension = state["dimension"]
+        collection.ids = state["ids"]
+        collection.documents = state["documents"]
+        collection.metadatas = state["metadatas"]
+        collection.positions = {id: row for row, id in enumerate(collection.ids)}
+        collection._size = len(collection.ids)
+        collection._generation = state.get("generation", 0)
+        collection._snapshot_bytes = snapshot_bytes
+        if os.path.exists(collection._log_path()):
+            with open(collection._log_path(), "rb+") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # a write cut short by a crash, drop it so the next one starts on a line of its own
+                        f.truncate(collection._log_bytes)
+                        break
+                    collection._replay(json.loads(line))
+                    collection._log_bytes += len(line)
+        if collection.dimension is not None:
+            collection._vectors = np.load(collection._array_path("vectors"), mmap_mode="r+")
+            if collection.dtype == "int8":
+                collection._scales = np.load(collection._array_path("scales"), mmap_mode="r+")
+            if collection.space == "l2":
+                collection._sq_norms = np.load(collection._array_path("sq_norms"), mmap_mode="r+")
+        return collection
+
+
+class NumpyVectorStore:
+    """
+    Stands in for a Chroma client: get_or_create_collection, get_collection, list_collections and
+    delete_collection, over NumpyCollections.
+
+    :param path: The directory collections are saved in (one subdirectory each), or None for memory only.
+    :param dtype: How vectors are stored, one of DTYPES.
+    """
+
+    def __init__(self, path: str = None, dtype: str = NUMPY_STORE_DTYPE, ivf_threshold: int = NUMPY_STORE_IVF_THRESHOLD,
+                 ivf_probes: int = NUMPY_STORE_IVF_PROBES):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+        self.path = path
+        self.dtype = dtype
+        self.ivf_threshold = ivf_threshold
+        self.ivf_probes = ivf_probes
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._directory_lock = None
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._lock_directory()
+
+    def _lock_directory(self, timeout: float = NUMPY_STORE_LOCK_TIMEOUT) -> None:
+        """
+        Take the directory for this process. Two processes writing to it would overwrite each other's
+        records and replace vector files the other has memory-mapped.
+        """
+        lock_file = open(os.path.join(self.path, ".lock"), "w")
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    lock_file.close()
+                    raise RuntimeError(f"{self.path} is in use by another process, a numpy store belongs to one process")
+                time.sleep(0.1)
+        self._directory_lock = lock_file  # held until close, or the end of the process
+
+    def close(self) -> None:
+        """Let go of the directory, so another process can open it."""
+        with self._lock:
+            self._collections.clear()
+            if self._directory_lock is not None:
+                self._directory_lock.close()
+                self._directory_lock = None
+
+    def _collection_path(self, name):
+        return os.path.join(self.path, name) if self.path else None
+
+    def _load(self, name):
+        """A collection saved on disk by an earlier process, or None."""
+        path = self._collection_path(name)
+        if path is None or not os.path.exists(os.path.join(path, "records.json")):
+            return None
+        collection = NumpyCollection.load(path, ivf_threshold=self.ivf_threshold, ivf_probes=self.ivf_probes)
+        self._collections[name] = collection
+        return collection
+
+    def get_or_create_collection(self, name: str, metadata: Dict = None, **kwargs) -> NumpyCollection:
+        if not _COLLECTION_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid collection name {name!r}")
+        with self._lock:
+            collection = self._collections.get(name) or self._load(name)
+            if collection is None:
+                collection = NumpyCollection(name, metadata, self.dtype, self._collection_path(name),
+                                             self.ivf_threshold, self.ivf_probes)
+                collection._save()
+                self._collections[name] = collection
+            return collection
+
+    def create_collection(self, name: str, metadata: Dict = None, get_or_create: bool = False, **kwargs) -> NumpyCollection:
+        if not get_or_create and name in self.list_collections():
+            raise ValueError(f"Collection {name} already exists")
+        return self.get_or_create_collection(name, metadata)
+
+    def get_collection(self, name: str, **kwargs) -> NumpyCollection:
+        with self._lock:
+            collection = self._collections.get(name) or self._load(name)
+        if collection is None:
+            raise ValueError(f"Collection {name} does not exist.")
+        return collection
+
+    def list_collections(self) -> List[str]:
+        with self._lock:
+            names = set(self._collections)
+        if self.path:
+            names.update(entry for entry in os.listdir(self.path)
+                         if os.path.exists(os.path.join(self.path, entry, "records.json")))
+        return sorted(names)
+
+    def delete_collection(self, name: str) -> None:
+        with self._lock:
+            self._collections.pop(name, None)
+            path = self._collection_path(name)
+        if path and os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def create_numpy_store() -> NumpyVectorStore:
+    """The store configured by the NUMPY_STORE_* settings."""
+    return NumpyVectorStore(NUMPY_STORE_DIRECTORY or None, NUMPY_STORE_DTYPE, NUMPY_STORE_IVF_THRESHOLD,
+                            NUMPY_STORE_IVF_PROBES)
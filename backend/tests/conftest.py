@@ -0,0 +1,4 @@
+import os, sys
+
+## the tests import the backend's packages the way its scripts do
+sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
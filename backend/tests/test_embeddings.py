@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+from tokenizers import Tokenizer, models, pre_tokenizers
+
+from store.chunking import CHUNK_TOKEN_BUDGET, chunk_token_budget
+from store.embeddings import LOCAL_EMBEDDING_MODEL_DIR, HashingEmbeddingProvider, LocalEmbeddingProvider, MiniLM
+
+"""
+MiniLM runs the model itself instead of going through chromadb's embedding function, so check that it
+still returns the vectors that function does.
+"""
+
+
+TEXTS = [
+    "best falafel in dubai",
+    "the stock market",
+    "x",
+    "the stock market " * 50 + "best falafel " * 100,  # longer than the 256 word pieces the model reads
+]
+
+
+@pytest.fixture
+def fake_model_dir(tmp_path, monkeypatch):
+    """A model directory with a small word-level tokenizer, and a model that looks each token up in a table."""
+    model_dir = tmp_path / "onnx"
+    model_dir.mkdir()
+    vocab = {"[PAD]": 0, "[UNK]": 1, **{word: i + 2 for i, word in enumerate("best falafel in dubai the stock market".split())}}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.save(str(model_dir / "tokenizer.json"))
+    # chromadb only checks that these exist
+    for name in ("config.json", "model.onnx", "special_tokens_map.json", "tokenizer_config.json", "vocab.txt"):
+        (model_dir / name).write_text("{}")
+
+    table = np.random.default_rng(0).normal(size=(len(vocab), 384)).astype(np.float32)
+
+    class TableSession:
+        def __init__(self, path, providers=None, sess_options=None):
+            pass
+
+        def run(self, outputs, inputs):
+            # the padding would change the result if it weren't masked out
+            return [table[inputs["input_ids"]] + inputs["attention_mask"][:, :, None] * 0.0]
+
+    import onnxruntime
+    monkeypatch.setattr(onnxruntime, "InferenceSession", TableSession)
+    return model_dir
+
+
+def test_matches_chromadb_with_a_fake_model(fake_model_dir):
+    stock = ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+    stock.DOWNLOAD_PATH = str(fake_model_dir.parent)
+
+    expected = np.array(stock(TEXTS))
+    actual = MiniLM(threads=1, model_dir=str(fake_model_dir)).encode(TEXTS, batch_size=3)
+
+    assert actual.shape == (len(TEXTS), 384)
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
+
+
+@pytest.mark.skipif(
+    not os.path.exists(os.path.join(LOCAL_EMBEDDING_MODEL_DIR, "model.onnx")),
+    reason="all-MiniLM-L6-v2 isn't downloaded",
+)
+def test_matches_chromadb_with_the_real_model():
+    expected = np.array(ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])(TEXTS))
+    actual = np.array(LocalEmbeddingProvider(threads=1, batch_size=3).embed(TEXTS))
+
+    np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+
+def test_chunks_fit_what_the_model_reads():
+    assert chunk_token_budget(LocalEmbeddingProvider(threads=1)) == min(CHUNK_TOKEN_BUDGET, 200)
+    assert chunk_token_budget(HashingEmbeddingProvider()) == CHUNK_TOKEN_BUDGET
@@ -0,0 +1,262 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+from store import numpy_store
+from store.numpy_store import NumpyCollection, NumpyVectorStore
+
+"""
+The numpy store stands in for Chroma, so besides its own persistence it is checked against Chroma's
+results for the same records.
+"""
+
+
+BACKEND = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _records(n, dimension=16, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"id{i}" for i in range(n)]
+    embeddings = rng.normal(size=(n, dimension)).astype(np.float32)
+    documents = [f"document {i}" for i in range(n)]
+    metadatas = [{"group": i % 3, "submission_id": f"s{i // 4}"} for i in range(n)]
+    return ids, embeddings, documents, metadatas
+
+
+def _state(collection):
+    result = collection.get(include=["documents", "metadatas", "embeddings"])
+    return result["ids"], result["documents"], result["metadatas"], np.asarray(result["embeddings"])
+
+
+def _assert_same_state(a, b):
+    assert a[:3] == b[:3]
+    np.testing.assert_allclose(a[3], b[3], atol=1e-6)
+
+
+# persistence
+
+
+def test_writes_survive_a_crash(tmp_path):
+    # a separate process writes and then dies without closing the store or saving a snapshot
+    script = textwrap.dedent(f"""
+        import os, sys
+        sys.path.append({BACKEND!r})
+        import numpy as np
+        from store.numpy_store import NumpyVectorStore
+        rng = np.random.default_rng(0)
+        collection = NumpyVectorStore({str(tmp_path)!r}, "float32").get_or_create_collection("crash", {{"hnsw:space": "cosine"}})
+        collection.add(ids=[f"id{{i}}" for i in range(40)], embeddings=rng.normal(size=(40, 8)).tolist(),
+                       documents=[f"doc {{i}}" for i in range(40)], metadatas=[{{"n": i}} for i in range(40)])
+        collection.update(ids=["id3"], metadatas=[{{"edited": True}}], documents=["changed"])
+        collection.upsert(ids=["id5", "new"], embeddings=rng.normal(size=(2, 8)).tolist(), documents=["five", "new"])
+        collection.delete(ids=["id0", "id1"])
+        collection.delete(where={{"n": {{"$gte": 35}}}})
+        os._exit(1)
+    """)
+    process = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    assert process.returncode == 1, process.stderr
+
+    collection = NumpyVectorStore(str(tmp_path), "float32").get_collection("crash")
+    ids = collection.get()["ids"]
+    assert ids == [f"id{i}" for i in range(2, 35)] + ["new"]
+    assert collection.get(ids=["id3"])["documents"] == ["changed"]
+    assert collection.get(ids=["id3"])["metadatas"] == [{"n": 3, "edited": True}]
+    assert collection.get(ids=["id5"])["documents"] == ["five"]
+    # every vector came back with its record, a record's own vector is its nearest neighbour
+    embeddings = collection.get(include=["embeddings"])["embeddings"]
+    assert collection.query(query_embeddings=embeddings, n_results=1)["ids"] == [[id] for id in ids]
+
+
+def test_a_torn_log_line_is_dropped(tmp_path):
+    ids, embeddings, documents, metadatas = _records(10, dimension=8)
+    store = NumpyVectorStore(str(tmp_path), "int8")
+    collection = store.get_or_create_collection("torn", {"hnsw:space": "cosine"})
+    collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+    expected = _state(collection)
+    # a write cut short by a crash leaves half a line at the end of the log
+    with open(collection._log_path(), "a") as f:
+        f.write('{"op": "add", "ids": ["torn"')
+    store.close()
+
+    store = NumpyVectorStore(str(tmp_path), "int8")
+    collection = store.get_collection("torn")
+    _assert_same_state(_state(collection), expected)
+    collection.add(ids=["after"], embeddings=embeddings[:1], documents=["after"])
+    store.close()
+
+    collection = NumpyVectorStore(str(tmp_path), "int8").get_collection("torn")
+    assert collection.count() == 11
+    assert "torn" not in collection.positions
+    assert collection.get(ids=["after"])["documents"] == ["after"]
+
+
+# deletes and compaction
+
+
+def test_delete_moves_the_remaining_rows_up(tmp_path):
+    ids, embeddings, documents, metadatas = _records(30)
+    collection = NumpyVectorStore(str(tmp_path), "float32").get_or_create_collection("deletes", {"hnsw:space": "l2"})
+    collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    collection.delete(ids=["id0", "id7", "missing"])
+    collection.delete(where={"group": 2})
+    kept = [i for i in range(30) if i not in (0, 7) and i % 3 != 2]
+
+    assert collection.count() == len(kept)
+    assert collection.get()["ids"] == [ids[i] for i in kept]
+    assert collection.positions == {ids[i]: row for row, i in enumerate(kept)}
+    np.testing.assert_allclose(collection.get(include=["embeddings"])["embeddings"], embeddings[kept], atol=1e-6)
+    # the l2 norms moved with their rows, so distances to the kept records are still right
+    result = collection.query(query_embeddings=embeddings[kept[:5]], n_results=1)
+    assert result["ids"] == [[ids[i]] for i in kept[:5]]
+    np.testing.assert_allclose(result["distances"], [[0.0]] * 5, atol=1e-4)
+    assert not collection.get(where={"group": 2})["ids"]
+
+
+def test_the_log_is_compacted_into_a_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(numpy_store, "LOG_COMPACT_MIN_BYTES", 2000)
+    ids, embeddings, documents, metadatas = _records(200, dimension=8)
+    store = NumpyVectorStore(str(tmp_path), "int8")
+    collection = store.get_or_create_collection("compact", {"hnsw:space": "cosine"})
+    generation = collection._generation
+    for start in range(0, 200, 10):
+        batch = slice(start, start + 10)
+        collection.add(ids=ids[batch], embeddings=embeddings[batch], documents=documents[batch], metadatas=metadatas[batch])
+        collection.delete(ids=[ids[start]])
+        collection.update(ids=[ids[start + 1]], metadatas=[{"updated": True}])
+
+    assert collection._generation > generation
+    logs = [name for name in os.listdir(collection.path) if name.endswith(".log")]
+    assert logs in ([], [os.path.basename(collection._log_path())])
+    expected = _state(collection)
+    assert len(expected[0]) == 180
+    store.close()
+
+    _assert_same_state(_state(NumpyVectorStore(str(tmp_path), "int8").get_collection("compact")), expected)
+
+
+# IVF
+
+
+def _blobs(n_per_blob, dimension=16, seed=0):
+    """Two tight, far apart groups of vectors, so k-means puts them in clusters of their own."""
+    rng = np.random.default_rng(seed)
+    centre = np.zeros(dimension, dtype=np.float32)
+    centre[0] = 10
+    a = centre + rng.normal(scale=0.1, size=(n_per_blob, dimension))
+    b = -centre + rng.normal(scale=0.1, size=(n_per_blob, dimension))
+    embeddings = np.concatenate([a, b]).astype(np.float32)
+    ids = [f"id{i}" for i in range(len(embeddings))]
+    metadatas = [{"blob": "a" if i < n_per_blob else "b"} for i in range(len(embeddings))]
+    return ids, embeddings, metadatas
+
+
+def test_ivf_falls_back_to_all_candidates_when_the_probed_clusters_are_empty():
+    ids, embeddings, metadatas = _blobs(100)
+    ivf = NumpyCollection("ivf", {"hnsw:space": "l2"}, dtype="float32", ivf_threshold=50, ivf_probes=1)
+    exact = NumpyCollection("exact", {"hnsw:space": "l2"}, dtype="float32", ivf_threshold=10 ** 9)
+    for collection in (ivf, exact):
+        collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas)
+
+    # the query sits in blob a, but only rows of blob b may match, and none of them is in the probed cluster
+    query = embeddings[:1]
+    result = ivf.query(query_embeddings=query, n_results=5, where={"blob": "b"})
+    assert ivf._centroids is not None
+    assert not np.isin(ivf._clusters[[ivf.positions[id] for id in result["ids"][0]]], ivf._nearest_probes(query[0])).any()
+    assert result["ids"] == exact.query(query_embeddings=query, n_results=5, where={"blob": "b"})["ids"]
+
+
+def test_ivf_falls_back_when_the_probed_cluster_is_empty():
+    # k-means starts several centres on the same duplicated vector, only one of them keeps the rows
+    rng = np.random.default_rng(0)
+    embeddings = np.concatenate([np.tile(rng.normal(size=(1, 16)), (150, 1)), rng.normal(size=(50, 16))])
+    ids = [f"id{i}" for i in range(len(embeddings))]
+    ivf = NumpyCollection("ivf", {"hnsw:space": "cosine"}, dtype="float32", ivf_threshold=50, ivf_probes=1)
+    exact = NumpyCollection("exact", {"hnsw:space": "cosine"}, dtype="float32", ivf_threshold=10 ** 9)
+    for collection in (ivf, exact):
+        collection.add(ids=ids, embeddings=embeddings)
+
+    result = ivf.query(query_embeddings=embeddings[:1], n_results=3)
+    probed = ivf._nearest_probes(ivf._prepare(embeddings[:1])[0])
+    assert not np.isin(ivf._clusters[:ivf.count()], probed).any()
+    assert result["ids"] == exact.query(query_embeddings=embeddings[:1], n_results=3)["ids"]
+
+
+def test_ivf_falls_back_when_a_cluster_has_fewer_rows_than_asked_for():
+    ids, embeddings, metadatas = _blobs(100)
+    ivf = NumpyCollection("ivf", {"hnsw:space": "cosine"}, dtype="float32", ivf_threshold=50, ivf_probes=1)
+    ivf.add(ids=ids, embeddings=embeddings, metadatas=metadatas)
+    ivf.query(query_embeddings=embeddings[:1], n_results=1)  # trains the index
+
+    # more results than the probed cluster holds, so every row is scored
+    probed = ivf._nearest_probes(ivf._prepare(embeddings[:1])[0])
+    in_probed = int(np.isin(ivf._clusters[:ivf.count()], probed).sum())
+    result = ivf.query(query_embeddings=embeddings[:1], n_results=in_probed + 1)
+    assert len(result["ids"][0]) == in_probed + 1
+
+
+def test_ivf_with_every_cluster_probed_is_exact():
+    ids, embeddings, documents, metadatas = _records(400)
+    ivf = NumpyCollection("ivf", {"hnsw:space": "cosine"}, dtype="float32", ivf_threshold=100, ivf_probes=1000)
+    exact = NumpyCollection("exact", {"hnsw:space": "cosine"}, dtype="float32", ivf_threshold=10 ** 9)
+    for collection in (ivf, exact):
+        collection.add(ids=ids, embeddings=embeddings)
+    queries = _records(5, seed=1)[1]
+    assert ivf.query(query_embeddings=queries, n_results=10)["ids"] == exact.query(query_embeddings=queries, n_results=10)["ids"]
+
+
+# against Chroma
+
+
+@pytest.fixture
+def chroma_client():
+    chromadb = pytest.importorskip("chromadb")
+    return chromadb.EphemeralClient()
+
+
+def _chroma_collection(client, name, space):
+    # HNSW is approximate, searching this widely makes it exact on a few hundred records
+    metadata = {"hnsw:space": space, "hnsw:construction_ef": 500, "hnsw:search_ef": 500}
+    return client.get_or_create_collection(name, metadata=metadata, embedding_function=None)
+
+
+@pytest.mark.parametrize("space", ["cosine", "l2", "ip"])
+def test_results_match_chroma(chroma_client, space):
+    ids, embeddings, documents, metadatas = _records(300)
+    queries = _records(8, seed=1)[1]
+    chroma = _chroma_collection(chroma_client, f"compare_{space}", space)
+    ours = NumpyVectorStore(None, "float32").get_or_create_collection(f"compare_{space}", {"hnsw:space": space})
+    for collection in (chroma, ours):
+        collection.add(ids=ids, embeddings=embeddings.tolist(), documents=documents, metadatas=metadatas)
+        collection.delete(ids=ids[:10])
+
+    for where in (None, {"group": 1}):
+        expected = chroma.query(query_embeddings=queries.tolist(), n_results=10, where=where)
+        actual = ours.query(query_embeddings=queries.tolist(), n_results=10, where=where)
+        assert actual["ids"] == expected["ids"]
+        assert actual["documents"] == expected["documents"]
+        assert actual["metadatas"] == expected["metadatas"]
+        np.testing.assert_allclose(actual["distances"], expected["distances"], rtol=1e-4, atol=1e-4)
+
+    expected = chroma.get(where={"submission_id": {"$in": ["s3", "s40"]}})
+    actual = ours.get(where={"submission_id": {"$in": ["s3", "s40"]}})
+    assert sorted(actual["ids"]) == sorted(expected["ids"])
+
+
+def test_int8_results_are_close_to_chroma(chroma_client):
+    ids, embeddings, documents, metadatas = _records(500, dimension=64)
+    queries = _records(20, dimension=64, seed=1)[1]
+    chroma = _chroma_collection(chroma_client, "compare_int8", "cosine")
+    ours = NumpyVectorStore(None, "int8").get_or_create_collection("compare_int8", {"hnsw:space": "cosine"})
+    for collection in (chroma, ours):
+        collection.add(ids=ids, embeddings=embeddings.tolist(), documents=documents)
+
+    expected = chroma.query(query_embeddings=queries.tolist(), n_results=10)
+    actual = ours.query(query_embeddings=queries.tolist(), n_results=10)
+    recall = np.mean([len(set(a) & set(e)) / 10 for a, e in zip(actual["ids"], expected["ids"])])
+    assert recall >= 0.9
+    np.testing.assert_allclose(actual["distances"], expected["distances"], atol=0.02)
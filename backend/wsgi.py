@@ -0,0 +1,81 @@
+import fcntl
+import os
+import threading
+
+from app import app
+
+# Register Blueprints or Routes
+from app import login_routes, reddit_routes, chatbot_routes, metrics_routes
+
+"""
+The production entry point. Serve it with gunicorn (see gunicorn.conf.py):
+
+    gunicorn -c gunicorn.conf.py asgi:app
+
+asgi.py serves /chat/stream natively and this app for everything else. app.py still runs Flask's
+development server for local work.
+"""
+
+
+INGESTION_LOCK_FILE = os.environ.get(
+    "INGESTION_LOCK_FILE",
+    os.path.join(os.path.abspath(os.path.dirname(__file__)), ".cache", "ingestion.lock"),
+)
+_ingestion_lock = None
+
+
+def _acquire_ingestion_lock():
+    """
+    When the vector store is shared, only one process per host should run the background ingestion
+    scheduler, otherwise every worker would fetch and embed the same subreddits into it. The first
+    process to take this file lock wins.
+    """
+    global _ingestion_lock
+    os.makedirs(os.path.dirname(INGESTION_LOCK_FILE), exist_ok=True)
+    lock_file = open(INGESTION_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _ingestion_lock = lock_file  # held for the life of the process
+    return True
+
+
+def reset_after_fork():
+    """
+    Replace the clients a forked worker inherited from the preloading master process.
+
+    Sockets, sqlite connections and background threads must not be shared across a fork.
+    """
+    from services.answer_cache import answer_cache
+    from services.metrics import metrics
+    from services.registry import registry
+    from store import chroma_db
+    from store.embedding_cache import embedding_cache
+
+    # the master's numbers would otherwise be counted once per worker
+    metrics.clear()
+    registry.reset()
+    chroma_db.reset_client()
+    answer_cache.reset()
+    embedding_cache.reset()
+
+
+def start_background_workers():
+    """Start the background jobs of this process: index warm-up, pre-ingestion and metrics snapshots."""
+    from services.metrics import start_snapshot_writer
+    start_snapshot_writer()
+
+    # Preload the persisted vector indexes in the background so the first query after a deploy is warm
+    if os.environ.get("CHROMA_WARM_UP", "1") == "1":
+        from store.chroma_db import warm_up_collections
+        threading.Thread(target=warm_up_collections, daemon=True).start()
+
+    # With INGESTION_ENABLED=1, keep the subreddits people actually use pre-ingested in the background. A
+    # process with a store of its own fills it itself, from its own traffic. With a shared store one process
+    # does it for all of them, ranking subreddits by the share of the traffic that reaches it.
+    from services.ingestion import INGESTION_ENABLED, ingestion_scheduler
+    from store.chroma_db import vector_store_is_shared
+    if INGESTION_ENABLED and (not vector_store_is_shared() or _acquire_ingestion_lock()):
+        ingestion_scheduler.start()